@@ -0,0 +1,295 @@
+"""Correct many texts at once, e.g. a whole class set of essays.
+
+Reads a CSV (with a ``text`` column and optionally an ``id`` column) or a JSONL file
+(``{"id": ..., "text": ...}`` per line), classifies and corrects every text with bounded
+concurrency and streams the results out as JSONL. Identical texts are only sent to the
+LLM once. The output file doubles as a checkpoint: run the same command again after an
+interruption and rows that already succeeded are skipped.
+
+Two modes reuse the apps' prompts:
+
+- ``langy``: the CEFR classification and few-shot correction chains from langy.py.
+- ``tutor``: the single JSON prompt from language_tutor.py (`convert_input_to_prompt`).
+
+Example Usage
+------------------------
+    python batch_correct.py essays.csv -o corrections.jsonl --concurrency 8
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Iterator
+
+import openai
+from dotenv import load_dotenv, find_dotenv
+
+from result_cache import get_result_cache, make_key, normalise_text
+
+MODES = ["langy", "tutor"]
+
+
+class _NullPlaceholder:
+    """Swallows the streaming output the Streamlit stages write to their placeholder."""
+
+    def markdown(self, body, **kwargs):
+        pass
+
+    def empty(self):
+        pass
+
+
+def read_rows(path: str | Path) -> Iterator[dict]:
+    """Yield {'id': ..., 'text': ...} rows from a CSV or JSONL file, one at a time.
+
+    Rows without an id are numbered by their position in the file.
+    """
+    path = Path(path)
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.suffix == ".jsonl":
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        for index, row in enumerate(rows):
+            yield {"id": str(row.get("id") or index), "text": row["text"]}
+
+
+def read_done_ids(path: str | Path) -> set[str]:
+    """Return the ids of rows that already succeeded in an output file."""
+    done = set()
+    if not Path(path).exists():
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by the interruption
+                continue
+            if not record.get("error"):
+                done.add(record["id"])
+    return done
+
+
+async def correct_with_langy(text: str) -> dict:
+    from langy_chains import classify_and_correct
+
+    placeholder = _NullPlaceholder()
+    level, corrections = await classify_and_correct(text, placeholder, placeholder)
+    return {
+        "level": level,
+        "corrected_text": corrections.corrected_text,
+        "reasons": corrections.reasons,
+    }
+
+
+async def correct_with_tutor(text: str) -> dict:
+    from language_tutor_prompts import (
+        convert_input_to_prompt,
+        get_system_prompt,
+        parse_json_response,
+    )
+    from streamlit_helpers import achat_completion
+
+    model = "gpt-3.5-turbo"
+    messages = [
+        {"role": "system", "content": get_system_prompt()},
+        {"role": "user", "content": convert_input_to_prompt(text)},
+    ]
+    # Same key as generate_response, so results are shared with language_tutor.py
+    cache = get_result_cache()
+    cache_key = make_key("chat", json.dumps(messages), "", model, 0)
+    response = cache.get(cache_key)
+    if response is None:
+        completion = await achat_completion(
+            model=model, messages=messages, temperature=0
+        )
+        response = completion.choices[0].message.content
+        cache.set(cache_key, response)
+    return parse_json_response(response)
+
+
+async def correct_rows(
+    rows: Iterable[dict],
+    mode: str = "langy",
+    concurrency: int = 8,
+    skip_ids: set[str] = frozenset(),
+) -> AsyncIterator[tuple[int, dict | None]]:
+    """Correct rows with at most concurrency texts in flight.
+
+    Identical texts (after `normalise_text`) that are in flight at the same time share
+    one LLM call; later repeats are served from the result cache.
+
+    Parameters
+    ----------
+    rows : Iterable[dict]
+        Rows with 'id' and 'text', e.g. from `read_rows`. Read lazily.
+    mode : str
+        'langy' or 'tutor', see the module docstring.
+    concurrency : int
+        Maximum number of texts being corrected at once.
+    skip_ids : set[str]
+        Ids of rows that are already done.
+
+    Yields
+    ------
+    tuple[int, dict | None]
+        (position of the row in rows, result record) as each row completes. Skipped
+        rows are yielded straight away with None as the record.
+    """
+    correct = correct_with_langy if mode == "langy" else correct_with_tutor
+    semaphore = asyncio.Semaphore(concurrency)
+    in_flight = {}
+
+    async def run_text(key: str, text: str) -> dict:
+        try:
+            async with semaphore:
+                return await correct(text)
+        finally:
+            del in_flight[key]
+
+    async def run_row(index: int, row: dict) -> tuple[int, dict]:
+        key = normalise_text(row["text"])
+        task = in_flight.get(key)
+        if task is None:
+            task = in_flight[key] = asyncio.ensure_future(run_text(key, row["text"]))
+        record = {"id": row["id"], "text": row["text"]}
+        try:
+            record.update(await task)
+        except Exception as error:
+            record["error"] = repr(error)
+        return index, record
+
+    # Don't read (and hold) the whole input at once
+    window = concurrency * 4
+    pending = set()
+    for index, row in enumerate(rows):
+        if row["id"] in skip_ids:
+            yield index, None
+            continue
+        pending.add(asyncio.ensure_future(run_row(index, row)))
+        if len(pending) >= window:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+
+async def run_batch_async(
+    input_path: str | Path,
+    output_path: str | Path,
+    mode: str = "langy",
+    concurrency: int = 8,
+    ordered: bool = True,
+    progress: bool = True,
+) -> dict:
+    """Correct every row of input_path, appending JSONL records to output_path.
+
+    Parameters
+    ----------
+    input_path : str | Path
+        CSV or JSONL file of texts.
+    output_path : str | Path
+        JSONL file to append results to. Rows it already has results for are skipped.
+    mode : str
+        'langy' or 'tutor'.
+    concurrency : int
+        Maximum number of texts being corrected at once.
+    ordered : bool
+        Write results in input order (buffering any that finish early), rather than
+        as they complete.
+    progress : bool
+        Print progress to stderr.
+
+    Returns
+    -------
+    dict
+        Counts of rows written, skipped and failed.
+    """
+    skip_ids = read_done_ids(output_path)
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    buffered = {}
+    next_index = 0
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as out:
+
+        def write(record):
+            if record is None:
+                counts["skipped"] += 1
+                return
+            counts["written"] += 1
+            counts["failed"] += bool(record.get("error"))
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+        async for index, record in correct_rows(
+            read_rows(input_path), mode, concurrency, skip_ids
+        ):
+            if ordered:
+                buffered[index] = record
+                while next_index in buffered:
+                    write(buffered.pop(next_index))
+                    next_index += 1
+            else:
+                write(record)
+            if progress:
+                rate = counts["written"] / (time.perf_counter() - start)
+                print(
+                    f"\r{counts['written']} written ({counts['failed']} failed), "
+                    f"{counts['skipped']} skipped, {rate:.2f} texts/s",
+                    end="",
+                    file=sys.stderr,
+                )
+    if progress:
+        print(file=sys.stderr)
+    return counts
+
+
+def run_batch(*args, **kwargs) -> dict:
+    """Blocking version of `run_batch_async`."""
+    return asyncio.run(run_batch_async(*args, **kwargs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Correct a file of texts in bulk.")
+    parser.add_argument("input", help="CSV (text[, id] columns) or JSONL file.")
+    parser.add_argument("-o", "--output", required=True, help="JSONL output file.")
+    parser.add_argument("--mode", choices=MODES, default="langy")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--order",
+        choices=["input", "completed"],
+        default="input",
+        help="Write results in input order or as they complete.",
+    )
+    parser.add_argument("--quiet", action="store_true", help="Don't show progress.")
+    args = parser.parse_args()
+
+    _ = load_dotenv(find_dotenv())
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    openai.organization = os.getenv("OPENAI_ORG_ID")
+    if openai.api_key is None:
+        sys.exit("Set OPENAI_API_KEY (e.g. in a .env file).")
+    counts = run_batch(
+        args.input,
+        args.output,
+        mode=args.mode,
+        concurrency=args.concurrency,
+        ordered=args.order == "input",
+        progress=not args.quiet,
+    )
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
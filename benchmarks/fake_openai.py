@@ -0,0 +1,327 @@
+"""A local stand-in for the OpenAI chat completions endpoint.
+
+Serves ``POST /v1/chat/completions``, streaming and non-streaming, with configurable
+latency and canned responses, so the apps can be benchmarked without spending API
+credits. Point openai at it with ``openai.api_base = server.api_base``.
+
+Example Usage
+------------------------
+>>> server = FakeOpenAIServer(token_latency=0.01).start()
+>>> openai.api_base = server.api_base
+>>> server.stop()
+
+Or run standalone::
+
+    python -m benchmarks.fake_openai --port 8001 --token-latency 0.02
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Substring of the conversation -> canned response. First match wins.
+DEFAULT_RESPONSES = {
+    "report_corrections": json.dumps(
+        {
+            "level": "A2",
+            "level_reason": "Short, simple sentences with basic vocabulary.",
+            "corrected_text": "Hallo, ich heiße Adam. Ich bin 25 Jahre alt.",
+            "corrections": [
+                {
+                    "original": "heisse",
+                    "corrected": "heiße",
+                    "reason": "'ss' after a long vowel is written 'ß'.",
+                },
+                {
+                    "original": "habe",
+                    "corrected": "bin",
+                    "reason": "Age is given with 'sein' in German.",
+                },
+            ],
+        }
+    ),
+    "running summary": "The customer ordered a normal waffle with syrup and a coffee "
+    "for pick up.",
+    "Extract the corrections": json.dumps(
+        {
+            "corrected_text": "Ich heiße Adam. Ich bin 25 Jahre alt.",
+            "reasons": ["Corrected 'heisse' to 'heiße'.", "Corrected 'habe' to 'bin'."],
+        }
+    ),
+    "Common European Framework": "## CEFR Level: A2\nThe text uses short, simple "
+    "sentences and basic everyday vocabulary about the writer. There are errors in "
+    "spelling and in the verb used to give an age, which are typical of a learner "
+    "at this level.",
+    "Let's think step by step": "\n## Corrected Text\n\nIch heiße Adam. Ich bin 25 "
+    "Jahre alt. Ich wohne seit 15 Jahren in England.\n\n## Reasons\n1. Corrected "
+    "spelling of 'heisse' to 'heiße' because 'ss' after a long vowel is written "
+    "'ß'.\n2. Corrected 'habe' to 'bin' because age is given with 'sein' in "
+    "German.\n3. Moved 'seit 15 Jahren' before 'in England' because time comes "
+    "before place.",
+    "reason for each correction": json.dumps(
+        {
+            "1": "'heisse' is spelled 'heiße' because 'ss' after a long vowel is 'ß'.",
+            "2": "Age is given with 'sein', so 'habe' becomes 'bin'.",
+        }
+    ),
+    "level_reason": json.dumps(
+        {
+            "level": "A2",
+            "level_reason": "Short, simple sentences with basic vocabulary.",
+            "corrected_text": "Hallo, ich heiße Adam. Ich bin 25 Jahre alt.",
+        }
+    ),
+    "Waffle House": "Great choice! One normal waffle with syrup, that's $11. Would "
+    "you like anything to drink, and is this for pick up or delivery?",
+}
+DEFAULT_RESPONSE = "OK."
+
+TOKEN = re.compile(r"\s*\S+|\s+")
+
+
+def count_tokens(text: str) -> int:
+    """Rough token count (words), good enough to compare runs against each other."""
+    return len(text.split())
+
+
+class FakeOpenAIServer:
+    """Threaded HTTP server that mimics the chat completions API."""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        first_token_latency: float = 0.3,
+        token_latency: float = 0.02,
+        responses: dict[str, str] | None = None,
+    ):
+        """Initialize the server.
+
+        Parameters
+        ----------
+        host : str
+            Interface to listen on.
+        port : int
+            Port to listen on. 0 picks a free port.
+        first_token_latency : float
+            Seconds before the first token is sent (or the response, if not streaming).
+        token_latency : float
+            Seconds between tokens. Non-streaming responses wait for every token.
+        responses : dict[str, str], optional
+            Substring of the conversation -> response. Defaults to `DEFAULT_RESPONSES`.
+        """
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.responses = DEFAULT_RESPONSES if responses is None else responses
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Requests being served right now, the most at once, and total time serving
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_base(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "peak_in_flight": self.peak_in_flight,
+                "busy_seconds": self.busy_seconds,
+            }
+
+    def reset_peak(self) -> None:
+        """Start measuring `peak_in_flight` again, e.g. between load test steps."""
+        with self._lock:
+            self.peak_in_flight = self.in_flight
+
+    def respond_to(self, messages: list[dict]) -> str:
+        content = "\n".join(m["content"] for m in messages)
+        for key, response in self.responses.items():
+            if key in content:
+                return response
+        return DEFAULT_RESPONSE
+
+    def _record(self, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def _enter(self) -> float:
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return time.perf_counter()
+
+    def _exit(self, start: float) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.busy_seconds += time.perf_counter() - start
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_error(404)
+                    return
+                start = server._enter()
+                try:
+                    self._complete()
+                finally:
+                    server._exit(start)
+
+            def _complete(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                messages = body.get("messages", [])
+                text = server.respond_to(messages)
+                tokens = TOKEN.findall(text)
+                prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+                server._record(prompt_tokens, count_tokens(text))
+                model = body.get("model", "gpt-3.5-turbo")
+                function = (body.get("functions") or [{}])[0].get("name")
+                if body.get("stream"):
+                    self._stream(tokens, model, function)
+                else:
+                    time.sleep(
+                        server.first_token_latency + server.token_latency * len(tokens)
+                    )
+                    self._send_json(
+                        {
+                            "id": f"chatcmpl-{uuid.uuid4().hex}",
+                            "object": "chat.completion",
+                            "created": int(time.time()),
+                            "model": model,
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": self._message(text, function),
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                            "usage": {
+                                "prompt_tokens": prompt_tokens,
+                                "completion_tokens": count_tokens(text),
+                                "total_tokens": prompt_tokens + count_tokens(text),
+                            },
+                        }
+                    )
+
+            def _message(self, text, function):
+                if function:
+                    return {
+                        "role": "assistant",
+                        "content": None,
+                        "function_call": {"name": function, "arguments": text},
+                    }
+                return {"role": "assistant", "content": text}
+
+            def _send_json(self, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, tokens, model, function=None):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+                if function:
+                    deltas = [
+                        {
+                            "role": "assistant",
+                            "function_call": {"name": function, "arguments": ""},
+                        }
+                    ] + [{"function_call": {"arguments": t}} for t in tokens]
+                else:
+                    deltas = [{"role": "assistant"}] + [{"content": t} for t in tokens]
+                time.sleep(server.first_token_latency)
+                for i, delta in enumerate(deltas):
+                    if i > 1:
+                        time.sleep(server.token_latency)
+                    self._write_event(chunk_id, model, delta, None)
+                self._write_event(chunk_id, model, {}, "stop")
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"")
+
+            def _write_event(self, chunk_id, model, delta, finish_reason):
+                event = {
+                    "id": chunk_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                    ],
+                }
+                self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument(
+        "--responses",
+        help="JSON file mapping a substring of the conversation to a response.",
+    )
+    args = parser.parse_args()
+    responses = None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = json.load(f)
+    server = FakeOpenAIServer(
+        args.host,
+        args.port,
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+        responses=responses,
+    )
+    print(f"Fake OpenAI API listening on {server.api_base}")
+    server._httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
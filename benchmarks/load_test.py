@@ -0,0 +1,278 @@
+"""Find how many concurrent sessions one app process can serve.
+
+Ramps up the number of simultaneous sessions against langy.py, language_tutor.py or
+waffle_bot.py, with OpenAI replaced by `FakeOpenAIServer`, and reports p50/p95/p99
+latency and throughput at each step. Two drivers are available:
+
+- ``apptest`` (default): every session runs the real Streamlit script with
+  ``streamlit.testing.v1.AppTest``, so each request is a full script rerun in its own
+  script thread, like a browser session over the websocket. The websocket transport
+  itself isn't exercised.
+- ``pipeline``: the headless pipelines of `benchmarks.run_benchmarks`, without
+  Streamlit. Useful to separate the cost of the script runs from the LLM pipeline.
+
+While each step runs, a probe thread samples how late a short sleep wakes up (a sign
+of GIL contention), the process's CPU use and the number of threads, and the fake
+server reports how many requests it served at once. The report then names the likely
+bottleneck where throughput stops scaling:
+
+- the shared client's concurrency or rate limit (``OPENAI_MAX_CONCURRENCY``,
+  ``OPENAI_REQUESTS_PER_MINUTE``),
+- the GIL / a CPU core, when the process keeps one core busy and sleeps wake late,
+- blocking I/O, when requests wait but neither the limit nor the CPU is saturated.
+
+Example Usage
+------------------------
+    python -m benchmarks.load_test --app langy --sessions 1 4 16 64 --duration 20
+    python -m benchmarks.load_test --app waffle_bot --driver pipeline
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import openai
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.run_benchmarks import (
+    SAMPLE_TEXT,
+    WAFFLE_TURNS,
+    Recorder,
+    make_pipeline,
+    percentile,
+)
+
+APPS = {
+    "langy": "langy.py",
+    "language_tutor": "language_tutor.py",
+    "waffle_bot": "waffle_bot.py",
+}
+
+# Throughput must grow by at least this share of the added sessions to count as scaling
+SCALING_EFFICIENCY = 0.5
+
+
+class AppSession:
+    """One browser session of a Streamlit app, driven with AppTest."""
+
+    def __init__(self, app: str, timeout: float = 120):
+        from streamlit.testing.v1 import AppTest
+
+        self.app = app
+        self.timeout = timeout
+        self.turn = 0
+        self.at = AppTest.from_file(APPS[app], default_timeout=timeout)
+        self.at.secrets["OPENAI_API_KEY"] = "fake-key"
+        self.at.secrets["OPENAI_ORG_ID"] = ""
+        self.at.run()
+
+    def __call__(self, recorder: Recorder) -> None:
+        at = self.at
+        if self.app == "langy":
+            at.chat_input[0].set_value(SAMPLE_TEXT).run()
+        elif self.app == "language_tutor":
+            at.text_area[0].input(SAMPLE_TEXT)
+            self._click("Correct Text")
+        else:
+            at.text_area[0].input(WAFFLE_TURNS[self.turn % len(WAFFLE_TURNS)])
+            self.turn += 1
+            self._click("Send")
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+
+    def _click(self, label: str) -> None:
+        button = next(b for b in self.at.button if b.label == label)
+        button.click().run()
+
+
+class Probe:
+    """Samples scheduling lag, CPU use and thread count from a background thread."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags = []
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "Probe":
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.wall_time = time.perf_counter() - self._wall
+        self.cpu_time = time.process_time() - self._cpu
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            time.sleep(self.interval)
+            # A thread waking from sleep has to take the GIL back before it runs
+            self.lags.append(time.perf_counter() - start - self.interval)
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    @property
+    def cores_used(self) -> float:
+        return self.cpu_time / self.wall_time if self.wall_time else 0.0
+
+
+def run_step(
+    app: str, driver: str, server: FakeOpenAIServer, sessions: int, duration: float
+) -> dict:
+    """Run sessions concurrent sessions for duration seconds, back to back requests."""
+    recorders, errors = [], []
+    lock = threading.Lock()
+    ready = threading.Barrier(sessions + 1)
+    started = threading.Event()
+    deadline = [0.0]
+
+    def session():
+        try:
+            pipeline = AppSession(app) if driver == "apptest" else make_pipeline(app)
+        except Exception as error:
+            with lock:
+                errors.append(repr(error))
+            ready.wait()
+            return
+        ready.wait()
+        started.wait()
+        while time.perf_counter() < deadline[0]:
+            recorder = Recorder()
+            try:
+                pipeline(recorder)
+            except Exception as error:
+                with lock:
+                    errors.append(repr(error))
+                continue
+            recorder.finish()
+            with lock:
+                recorders.append(recorder)
+
+    threads = [threading.Thread(target=session) for _ in range(sessions)]
+    for thread in threads:
+        thread.start()
+    # Sessions are set up (first script run) before the clock starts
+    ready.wait()
+    before = server.stats()
+    server.reset_peak()
+    with Probe() as probe:
+        deadline[0] = time.perf_counter() + duration
+        started.set()
+        for thread in threads:
+            thread.join()
+    after = server.stats()
+
+    latencies = [r.latency for r in recorders] or [0.0]
+    llm_seconds = after["busy_seconds"] - before["busy_seconds"]
+    return {
+        "sessions": sessions,
+        "requests": len(recorders),
+        "error_count": len(errors),
+        "errors": errors[:5],
+        "throughput_rps": len(recorders) / probe.wall_time,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "latency_p99_s": percentile(latencies, 99),
+        "llm_calls": after["requests"] - before["requests"],
+        "llm_calls_per_minute": 60
+        * (after["requests"] - before["requests"])
+        / probe.wall_time,
+        "peak_llm_in_flight": after["peak_in_flight"],
+        # Time spent inside the fake LLM per second of request latency
+        "llm_time_share": llm_seconds / max(sum(latencies), 1e-9),
+        "cores_used": probe.cores_used,
+        "scheduling_lag_p95_ms": 1000 * percentile(probe.lags or [0.0], 95),
+        "peak_threads": probe.peak_threads,
+    }
+
+
+def diagnose(
+    steps: list[dict], max_concurrency: int, requests_per_minute: float
+) -> dict:
+    """Find the step where throughput stops scaling and guess why."""
+    for previous, step in zip(steps, steps[1:]):
+        added = step["sessions"] / previous["sessions"]
+        gained = step["throughput_rps"] / max(previous["throughput_rps"], 1e-9)
+        if gained >= 1 + SCALING_EFFICIENCY * (added - 1):
+            continue
+        if step["llm_calls_per_minute"] >= 0.9 * requests_per_minute:
+            reason = (
+                f"LLM calls ran at the client's rate limit "
+                f"(OPENAI_REQUESTS_PER_MINUTE={requests_per_minute:.0f})."
+            )
+        elif step["peak_llm_in_flight"] >= max_concurrency:
+            reason = (
+                f"LLM requests in flight peaked at the client limit "
+                f"(OPENAI_MAX_CONCURRENCY={max_concurrency}); requests queue for it."
+            )
+        elif step["cores_used"] >= 0.85 or step["scheduling_lag_p95_ms"] >= 20:
+            reason = (
+                f"The process keeps {step['cores_used']:.2f} cores busy and sleeping "
+                f"threads wake {step['scheduling_lag_p95_ms']:.0f} ms late (p95): "
+                "Python code is contending for the GIL."
+            )
+        else:
+            reason = (
+                "Neither the client limit nor the CPU is saturated: time goes to "
+                "blocking I/O or waiting for threads (connection pools, locks, "
+                "Streamlit's script threads)."
+            )
+        return {"saturated_at_sessions": step["sessions"], "reason": reason}
+    return {"saturated_at_sessions": None, "reason": "Throughput kept scaling."}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the apps offline.")
+    parser.add_argument("--app", choices=list(APPS), default="langy")
+    parser.add_argument("--driver", choices=["apptest", "pipeline"], default="apptest")
+    parser.add_argument("--sessions", nargs="+", type=int, default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--duration", type=float, default=15, help="Seconds per step.")
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--output", default="load_test_results.json")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+    ).start()
+    openai.api_key = "fake-key"
+    openai.api_base = server.api_base
+    os.environ["OPENAI_API_BASE"] = server.api_base
+
+    from streamlit_helpers import OPENAI_MAX_CONCURRENCY, OPENAI_REQUESTS_PER_MINUTE
+
+    steps = []
+    try:
+        for sessions in args.sessions:
+            step = run_step(args.app, args.driver, server, sessions, args.duration)
+            steps.append(step)
+            print(
+                f"{args.app} x{sessions}: {step['throughput_rps']:.2f} req/s, "
+                f"latency p50 {step['latency_p50_s']:.2f}s "
+                f"p95 {step['latency_p95_s']:.2f}s p99 {step['latency_p99_s']:.2f}s, "
+                f"{step['cores_used']:.2f} cores, "
+                f"lag p95 {step['scheduling_lag_p95_ms']:.1f} ms, "
+                f"{step['peak_llm_in_flight']} LLM calls in flight, "
+                f"{step['error_count']} errors"
+            )
+    finally:
+        server.stop()
+
+    diagnosis = diagnose(steps, OPENAI_MAX_CONCURRENCY, OPENAI_REQUESTS_PER_MINUTE)
+    print(diagnosis["reason"])
+    with open(args.output, "w") as f:
+        json.dump(
+            {"config": vars(args), "steps": steps, "diagnosis": diagnosis}, f, indent=2
+        )
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
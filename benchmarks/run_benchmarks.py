@@ -0,0 +1,323 @@
+"""Benchmark the apps' LLM pipelines offline, against `FakeOpenAIServer`.
+
+Drives the pipelines behind langy.py, language_tutor.py and waffle_bot.py headlessly
+with N concurrent sessions (one thread each, like Streamlit's script threads) and
+reports time-to-first-output, total latency, throughput and tokens per request. Results
+are written as JSON; pass ``--baseline`` to compare against an earlier run.
+
+Example Usage
+------------------------
+    python -m benchmarks.run_benchmarks --sessions 1 4 16 --output bench.json
+    python -m benchmarks.run_benchmarks --baseline bench.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+# Keep the result cache out of the measurements unless asked for, and make sure no
+# real API key is picked up. Both must happen before the app modules are imported.
+if "--cache" not in sys.argv:
+    os.environ["LLM_CACHE_PATH"] = ""
+    os.environ["LLM_CACHE_MAX_ENTRIES"] = "0"
+os.environ["OPENAI_API_KEY"] = "fake-key"
+
+import openai
+
+from benchmarks.fake_openai import FakeOpenAIServer
+
+APPS = ["langy", "language_tutor", "language_tutor_two_calls", "waffle_bot"]
+
+SAMPLE_TEXT = (
+    "Hallo, ich heisse Adam. Ich habe 25 Jahre alt. Ich wohne in England seit 15 "
+    "Jahren aber ich wuerde gerne irgendwo anders wohnen."
+)
+WAFFLE_TURNS = [
+    "Hi, I'd like to order a waffle please.",
+    "A normal waffle with syrup and bacon.",
+    "And a coffee.",
+    "That's everything, it's for pick up.",
+    "I'll pay with cash.",
+]
+
+
+class Recorder:
+    """Times one request: when it started, first showed output, and finished."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_output = None
+        self.end = None
+
+    def output(self):
+        if self.first_output is None:
+            self.first_output = time.perf_counter()
+
+    def finish(self):
+        self.end = time.perf_counter()
+        self.output()
+
+    @property
+    def ttft(self) -> float:
+        return self.first_output - self.start
+
+    @property
+    def latency(self) -> float:
+        return self.end - self.start
+
+
+class RecordingPlaceholder:
+    """Stands in for an st.empty() placeholder, noting when output first appears."""
+
+    def __init__(self, recorder: Recorder):
+        self.recorder = recorder
+
+    def markdown(self, body, **kwargs):
+        self.recorder.output()
+
+    def empty(self):
+        pass
+
+
+def run_langy(recorder: Recorder, text: str = SAMPLE_TEXT) -> None:
+    import asyncio
+
+    from langy_chains import classify_and_correct
+    from text_diff import diff_texts
+
+    placeholder = RecordingPlaceholder(recorder)
+    _, corrections = asyncio.run(classify_and_correct(text, placeholder, placeholder))
+    diff_texts(text, corrections.corrected_text)
+
+
+def run_language_tutor(recorder: Recorder, text: str = SAMPLE_TEXT) -> None:
+    from incremental_json import IncrementalJSONParser
+    from language_tutor_prompts import (
+        CORRECTION_FUNCTION,
+        convert_input_to_function_prompt,
+        get_system_prompt,
+    )
+    from streamlit_helpers import stream_function_arguments
+    from text_diff import diff_texts
+
+    messages = [
+        {"role": "system", "content": get_system_prompt()},
+        {"role": "user", "content": convert_input_to_function_prompt(text)},
+    ]
+    parser = IncrementalJSONParser()
+    for chunk in stream_function_arguments(messages, CORRECTION_FUNCTION):
+        for event, key, value in parser.feed(chunk):
+            recorder.output()
+            if event == "field" and key == "corrected_text":
+                diff_texts(text, value)
+
+
+def run_language_tutor_two_calls(recorder: Recorder, text: str = SAMPLE_TEXT) -> None:
+    """The TUTOR_SINGLE_CALL=0 flow: a JSON response, then a second call for reasons."""
+    from language_tutor_prompts import (
+        convert_input_to_prompt,
+        get_reasoning_prompt,
+        get_system_prompt,
+        parse_json_response,
+    )
+    from streamlit_helpers import chat_completion
+    from text_diff import diff_texts
+
+    messages = [
+        {"role": "system", "content": get_system_prompt()},
+        {"role": "user", "content": convert_input_to_prompt(text)},
+    ]
+    completion = chat_completion(
+        model="gpt-3.5-turbo", messages=messages, temperature=0
+    )
+    response = completion.choices[0].message.content
+    recorder.output()
+    comparison = diff_texts(text, parse_json_response(response)["corrected_text"])
+    messages += [
+        {"role": "assistant", "content": response},
+        {"role": "user", "content": get_reasoning_prompt(comparison.edits)},
+    ]
+    completion = chat_completion(
+        model="gpt-3.5-turbo", messages=messages, temperature=0
+    )
+    parse_json_response(completion.choices[0].message.content)
+
+
+class WaffleSession:
+    """One customer working through `WAFFLE_TURNS`, one turn per request. Turns the
+    order engine understands don't reach the LLM, like in the app."""
+
+    def __init__(self):
+        from waffle_bot_prompts import GREETING, get_system_prompt
+        from waffle_orders import OrderSession
+
+        self.order = OrderSession()
+        self.messages = [
+            {"role": "system", "content": get_system_prompt()},
+            {"role": "assistant", "content": GREETING},
+        ]
+        self.turn = 0
+
+    def __call__(self, recorder: Recorder) -> None:
+        from streamlit_helpers import chat_completion
+
+        user_input = WAFFLE_TURNS[self.turn % len(WAFFLE_TURNS)]
+        self.turn += 1
+        if self.turn % len(WAFFLE_TURNS) == 1:
+            # A new customer
+            self.order.reset()
+        self.messages.append({"role": "user", "content": user_input})
+        output = self.order.handle(user_input)
+        if output is None:
+            completion = chat_completion(
+                model="gpt-3.5-turbo",
+                messages=self.order.build(self.messages),
+                temperature=0,
+            )
+            output = completion.choices[0].message.content
+        self.messages.append({"role": "assistant", "content": output})
+
+
+def make_pipeline(app: str):
+    """Return a callable that runs one request of app, given a `Recorder`."""
+    if app == "langy":
+        return run_langy
+    if app == "language_tutor":
+        return run_language_tutor
+    if app == "language_tutor_two_calls":
+        return run_language_tutor_two_calls
+    if app == "waffle_bot":
+        return WaffleSession()
+    raise ValueError(f"Unknown app: {app}")
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def benchmark(
+    app: str, server: FakeOpenAIServer, sessions: int, requests_per_session: int
+) -> dict:
+    """Run requests_per_session requests in each of sessions concurrent threads."""
+    recorders = []
+    errors = []
+    lock = threading.Lock()
+
+    def session():
+        pipeline = make_pipeline(app)
+        for _ in range(requests_per_session):
+            recorder = Recorder()
+            try:
+                pipeline(recorder)
+            except Exception as error:
+                with lock:
+                    errors.append(repr(error))
+                continue
+            recorder.finish()
+            with lock:
+                recorders.append(recorder)
+
+    before = server.stats()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=session) for _ in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+    after = server.stats()
+
+    completed = max(1, len(recorders))
+    ttfts = [r.ttft for r in recorders] or [0.0]
+    latencies = [r.latency for r in recorders] or [0.0]
+    return {
+        "sessions": sessions,
+        "requests": len(recorders),
+        "errors": errors[:10],
+        "error_count": len(errors),
+        "wall_time_s": wall_time,
+        "throughput_rps": len(recorders) / wall_time,
+        "ttft_p50_s": percentile(ttfts, 50),
+        "ttft_p95_s": percentile(ttfts, 95),
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "llm_calls_per_request": (after["requests"] - before["requests"]) / completed,
+        "prompt_tokens_per_request": (after["prompt_tokens"] - before["prompt_tokens"])
+        / completed,
+        "completion_tokens_per_request": (
+            after["completion_tokens"] - before["completion_tokens"]
+        )
+        / completed,
+    }
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """Print the change in the headline numbers against a baseline run."""
+    for app, runs in results["apps"].items():
+        baseline_runs = {r["sessions"]: r for r in baseline["apps"].get(app, [])}
+        for run in runs:
+            old = baseline_runs.get(run["sessions"])
+            if old is None:
+                continue
+            changes = []
+            for key in ["ttft_p50_s", "latency_p50_s", "throughput_rps"]:
+                if old[key]:
+                    changes.append(f"{key} {100 * (run[key] / old[key] - 1):+.1f}%")
+            print(f"{app} x{run['sessions']}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the apps.")
+    parser.add_argument("--apps", nargs="+", choices=APPS, default=APPS)
+    parser.add_argument("--sessions", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests-per-session", type=int, default=5)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument(
+        "--cache", action="store_true", help="Keep the result cache on."
+    )
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against.")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+    ).start()
+    openai.api_key = "fake-key"
+    openai.api_base = server.api_base
+    os.environ["OPENAI_API_BASE"] = server.api_base
+
+    results = {"config": vars(args), "apps": {}}
+    try:
+        for app in args.apps:
+            results["apps"][app] = []
+            for sessions in args.sessions:
+                run = benchmark(app, server, sessions, args.requests_per_session)
+                results["apps"][app].append(run)
+                print(
+                    f"{app} x{sessions}: ttft p50 {run['ttft_p50_s']:.3f}s, "
+                    f"latency p50 {run['latency_p50_s']:.3f}s "
+                    f"p95 {run['latency_p95_s']:.3f}s, "
+                    f"{run['throughput_rps']:.2f} req/s, "
+                    f"{run['prompt_tokens_per_request']:.0f}+"
+                    f"{run['completion_tokens_per_request']:.0f} tokens/req"
+                )
+    finally:
+        server.stop()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
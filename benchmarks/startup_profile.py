@@ -0,0 +1,135 @@
+"""Profile how long the apps take to start.
+
+Two measurements per app:
+
+- Imports: the modules the app imports at the top are imported in a fresh interpreter
+  with ``python -X importtime``, and the slowest top-level packages are listed. This is
+  what every cold start pays before the first line of the page is sent.
+- First paint (``--apptest``): the app is run with ``streamlit.testing.v1.AppTest`` in
+  this process, twice. The first run includes the imports above, the second shows what
+  a rerun costs once they are cached.
+
+Slow packages that show up here should be imported where they are used and loaded with
+`warmup.warm_up` after the intro instead.
+
+Example Usage
+------------------------
+    python -m benchmarks.startup_profile
+    python -m benchmarks.startup_profile --app langy --apptest --top 20
+"""
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.load_test import APPS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def top_level_imports(path: str) -> list[str]:
+    """Return the modules imported at module level (not in functions) of path."""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def parse_importtime(stderr: str) -> list[dict]:
+    """Parse ``-X importtime`` output into top-level packages with their cumulative
+    import time in seconds, slowest first."""
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative_us, name = line.split(":", 1)[1].split("|")
+        # Nested imports are indented under the module that imported them
+        if name.startswith("  "):
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(cumulative_us) / 1e6
+    return sorted(
+        ({"package": p, "seconds": s} for p, s in packages.items()),
+        key=lambda row: row["seconds"],
+        reverse=True,
+    )
+
+
+def profile_imports(app: str) -> dict:
+    """Import the app's top-level modules in a fresh interpreter and time them."""
+    modules = top_level_imports(os.path.join(ROOT, APPS[app]))
+    code = "".join(f"import {module}\n" for module in modules)
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    # The traceback, if any, follows the importtime lines
+    error = [line for line in process.stderr.splitlines() if "Error" in line]
+    return {
+        "modules": modules,
+        "wall_seconds": wall,
+        "packages": parse_importtime(process.stderr),
+        "error": error[-1] if process.returncode else None,
+    }
+
+
+def profile_first_paint(app: str) -> dict:
+    """Time the first and second run of the app script."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, APPS[app]), default_timeout=120)
+    at.secrets["OPENAI_API_KEY"] = "fake-key"
+    at.secrets["OPENAI_ORG_ID"] = ""
+    start = time.perf_counter()
+    at.run()
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    at.run()
+    second = time.perf_counter() - start
+    return {"first_run_seconds": first, "rerun_seconds": second}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the apps' start-up.")
+    parser.add_argument("--app", choices=list(APPS), nargs="+", default=list(APPS))
+    parser.add_argument("--apptest", action="store_true", help="Also time first paint.")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--output", default="startup_profile.json")
+    args = parser.parse_args()
+
+    results = {}
+    for app in args.app:
+        result = profile_imports(app)
+        print(f"{app}: top-level imports took {result['wall_seconds']:.2f}s")
+        if result["error"]:
+            print(f"  failed: {result['error']}")
+        for row in result["packages"][: args.top]:
+            print(f"  {row['seconds']:8.3f}s  {row['package']}")
+        if args.apptest:
+            result.update(profile_first_paint(app))
+            print(
+                f"  first run {result['first_run_seconds']:.2f}s, "
+                f"rerun {result['rerun_seconds']:.2f}s"
+            )
+        results[app] = result
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
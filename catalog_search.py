@@ -0,0 +1,389 @@
+"""Search the outdoor clothing catalog without stuffing it into a prompt.
+
+`data/OutdoorClothingCatalog_1000.csv` is streamed row by row, each description is
+split into chunks of a few paragraphs and every chunk is embedded locally. The
+embeddings are saved as a NumPy array that is memory-mapped on load, next to a JSON
+file with the chunk texts, so opening the index costs next to nothing and the OS only
+pages in what a search touches.
+
+Rebuilds are incremental: each row is hashed, and rows whose name and description
+haven't changed reuse their stored embeddings. Search scores chunks by cosine
+similarity, optionally blended with BM25 keyword scores, and returns the best chunk of
+each of the top products.
+
+Settings are read from the environment:
+
+- ``CATALOG_PATH``: the catalog CSV, default ``data/OutdoorClothingCatalog_1000.csv``.
+- ``CATALOG_INDEX_PATH``: directory the index is kept in, default
+  ``.cache/catalog_index``.
+- ``CATALOG_EMBEDDER``: ``hashing`` (default, no extra dependencies) or
+  ``sentence-transformers:<model name>``, e.g.
+  ``sentence-transformers:all-MiniLM-L6-v2``.
+- ``CATALOG_BM25_WEIGHT``: share of the score given to BM25, default 0.3. 0 disables
+  keyword scoring.
+
+Example Usage
+------------------------
+    python catalog_search.py build
+    python catalog_search.py search "waterproof jacket for hiking" -k 3
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+CATALOG_PATH = os.getenv("CATALOG_PATH", "data/OutdoorClothingCatalog_1000.csv")
+CATALOG_INDEX_PATH = os.getenv("CATALOG_INDEX_PATH", ".cache/catalog_index")
+CATALOG_EMBEDDER = os.getenv("CATALOG_EMBEDDER", "hashing")
+CATALOG_BM25_WEIGHT = float(os.getenv("CATALOG_BM25_WEIGHT", 0.3))
+
+# Descriptions are split on blank lines and paragraphs merged up to this many chars
+CHUNK_CHARS = 600
+
+TOKEN = re.compile(r"[a-z0-9]+(?:['’][a-z]+)?")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN.findall(text.lower())
+
+
+def read_catalog(path: str | Path = CATALOG_PATH) -> Iterator[dict]:
+    """Yield {'id', 'name', 'description'} rows one at a time."""
+    # Some descriptions are long enough to trip the csv module's default limit
+    csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+    with open(path, newline="", encoding="utf-8") as f:
+        for index, row in enumerate(csv.DictReader(f)):
+            yield {
+                "id": str(row.get("") or index),
+                "name": row["name"],
+                "description": row["description"],
+            }
+
+
+def chunk_description(text: str, max_chars: int = CHUNK_CHARS) -> list[str]:
+    """Split a description into chunks of whole paragraphs of up to max_chars."""
+    chunks, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks or [text.strip()]
+
+
+class HashingEmbedder:
+    """Embed texts by hashing their words and word pairs into a fixed-size vector.
+
+    Needs nothing beyond NumPy and is fast enough to embed the whole catalog in a
+    couple of seconds. It matches words rather than meanings; use a sentence
+    transformer for real semantic search.
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            pairs = [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            features = Counter(tokens + pairs)
+            for feature, count in features.items():
+                h = zlib.crc32(feature.encode())
+                sign = 1.0 if h & 1 else -1.0
+                vectors[row, (h >> 1) % self.dim] += sign * (1 + math.log(count))
+        return _normalise(vectors)
+
+
+class SentenceTransformerEmbedder:
+    """Embed texts with a local sentence-transformers model."""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+        self.name = f"sentence-transformers-{model_name}"
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=64, convert_to_numpy=True)
+        return _normalise(vectors.astype(np.float32))
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def get_embedder(spec: str = CATALOG_EMBEDDER):
+    """Build the embedder named by spec, see ``CATALOG_EMBEDDER``."""
+    if spec.startswith("sentence-transformers:"):
+        return SentenceTransformerEmbedder(spec.split(":", 1)[1])
+    if spec == "hashing":
+        return HashingEmbedder()
+    raise ValueError(f"Unknown embedder: {spec}")
+
+
+class BM25:
+    """Okapi BM25 keyword scores over a fixed set of documents."""
+
+    def __init__(self, documents: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        lengths = []
+        for doc, text in enumerate(documents):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append((doc, count))
+        self.lengths = np.array(lengths, dtype=np.float32)
+        self.average_length = float(self.lengths.mean()) if lengths else 0.0
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.lengths), dtype=np.float32)
+        n = len(self.lengths)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            docs, counts = map(np.array, zip(*postings))
+            norm = self.k1 * (
+                1 - self.b + self.b * self.lengths[docs] / self.average_length
+            )
+            scores[docs] += idf * counts * (self.k1 + 1) / (counts + norm)
+        return scores
+
+
+@dataclass(frozen=True)
+class SearchResult:
+    product_id: str
+    name: str
+    text: str
+    score: float
+
+
+def _row_hash(row: dict) -> str:
+    return hashlib.sha256(f"{row['name']}\0{row['description']}".encode()).hexdigest()
+
+
+class CatalogIndex:
+    """A persistent chunk embedding index over the catalog.
+
+    Example Usage
+    ------------------------
+    >>> index = CatalogIndex.build()  # Only re-embeds rows that changed
+    >>> index.search("warm waterproof jacket", k=3)
+    """
+
+    def __init__(self, directory: Path, embedder, vectors: np.ndarray, meta: dict):
+        self.directory = directory
+        self.embedder = embedder
+        self.vectors = vectors
+        self.meta = meta
+        self._bm25 = None
+        self._bm25_lock = threading.Lock()
+
+    @staticmethod
+    def _paths(directory: Path) -> tuple[Path, Path]:
+        return directory / "vectors.npy", directory / "meta.json"
+
+    @classmethod
+    def load(cls, directory: str | Path = CATALOG_INDEX_PATH, embedder=None):
+        """Open an index built by `build`. The vectors are memory-mapped, not read."""
+        directory = Path(directory)
+        vectors_path, meta_path = cls._paths(directory)
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        embedder = embedder or get_embedder()
+        if embedder.name != meta["embedder"]:
+            raise ValueError(
+                f"Index was built with {meta['embedder']}, not {embedder.name}. "
+                "Rebuild it with `python catalog_search.py build`."
+            )
+        vectors = np.load(vectors_path, mmap_mode="r")
+        return cls(directory, embedder, vectors, meta)
+
+    @classmethod
+    def build(
+        cls,
+        catalog_path: str | Path = CATALOG_PATH,
+        directory: str | Path = CATALOG_INDEX_PATH,
+        embedder=None,
+        batch_size: int = 256,
+    ) -> "CatalogIndex":
+        """Build or update the index, re-embedding only rows that changed."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        vectors_path, meta_path = cls._paths(directory)
+        embedder = embedder or get_embedder()
+
+        # Embeddings of unchanged rows are copied over from the previous build
+        reusable = {}
+        if meta_path.exists() and vectors_path.exists():
+            with open(meta_path, encoding="utf-8") as f:
+                old_meta = json.load(f)
+            if old_meta["embedder"] == embedder.name:
+                old_vectors = np.load(vectors_path, mmap_mode="r")
+                for row_hash, start, end in old_meta["rows"].values():
+                    reusable[row_hash] = np.array(old_vectors[start:end])
+
+        chunks, rows, parts = [], {}, []
+        pending_texts, pending_slots = [], []
+
+        def embed_pending():
+            if pending_texts:
+                vectors = embedder.embed(pending_texts)
+                for slot, vector in zip(pending_slots, vectors):
+                    parts[slot[0]][slot[1]] = vector
+                pending_texts.clear()
+                pending_slots.clear()
+
+        for row in read_catalog(catalog_path):
+            row_hash = _row_hash(row)
+            texts = chunk_description(row["description"])
+            start = len(chunks)
+            chunks.extend(
+                {"id": row["id"], "name": row["name"], "text": text} for text in texts
+            )
+            rows[row["id"]] = (row_hash, start, len(chunks))
+            if row_hash in reusable and len(reusable[row_hash]) == len(texts):
+                parts.append(reusable[row_hash])
+                continue
+            parts.append([None] * len(texts))
+            for i, text in enumerate(texts):
+                # The product name gives each chunk its context
+                pending_texts.append(f"{row['name']}\n{text}")
+                pending_slots.append((len(parts) - 1, i))
+            if len(pending_texts) >= batch_size:
+                embed_pending()
+        embed_pending()
+
+        dim = len(parts[0][0]) if chunks else embedder.embed([""]).shape[1]
+        tmp_path = directory / "vectors.tmp.npy"
+        vectors = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float32, shape=(len(chunks), dim)
+        )
+        offset = 0
+        for part in parts:
+            part = np.asarray(part, dtype=np.float32)
+            vectors[offset : offset + len(part)] = part
+            offset += len(part)
+        vectors.flush()
+        del vectors
+        os.replace(tmp_path, vectors_path)
+        meta = {"embedder": embedder.name, "rows": rows, "chunks": chunks}
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        return cls.load(directory, embedder)
+
+    @property
+    def bm25(self) -> BM25:
+        """Built on first use, since pure vector search doesn't need it."""
+        with self._bm25_lock:
+            if self._bm25 is None:
+                self._bm25 = BM25(
+                    [f"{c['name']}\n{c['text']}" for c in self.meta["chunks"]]
+                )
+            return self._bm25
+
+    def search(
+        self, query: str, k: int = 5, bm25_weight: float = CATALOG_BM25_WEIGHT
+    ) -> list[SearchResult]:
+        """Return the best matching chunk of each of the k best matching products.
+
+        Parameters
+        ----------
+        query : str
+            What the customer is looking for.
+        k : int
+            Number of products to return.
+        bm25_weight : float
+            Share of the score given to BM25 keyword matching, between 0 and 1.
+        """
+        if not len(self.vectors):
+            return []
+        scores = self.vectors @ self.embedder.embed([query])[0]
+        if bm25_weight:
+            keyword = self.bm25.scores(query)
+            if keyword.max() > 0:
+                keyword /= keyword.max()
+            scores = (1 - bm25_weight) * scores + bm25_weight * keyword
+        # Look at a few more chunks than needed, since products have several
+        candidates = min(len(scores), k * 8)
+        top = np.argpartition(-scores, candidates - 1)[:candidates]
+        results, seen = [], set()
+        for i in top[np.argsort(-scores[top])]:
+            chunk = self.meta["chunks"][i]
+            if chunk["id"] in seen:
+                continue
+            seen.add(chunk["id"])
+            results.append(
+                SearchResult(
+                    chunk["id"], chunk["name"], chunk["text"], float(scores[i])
+                )
+            )
+            if len(results) == k:
+                break
+        return results
+
+
+@lru_cache(maxsize=1)
+def get_catalog_index() -> CatalogIndex:
+    """Open the index on first use, building it if there isn't one yet."""
+    try:
+        return CatalogIndex.load()
+    except (FileNotFoundError, ValueError):
+        return CatalogIndex.build()
+
+
+def catalog_context(query: str, k: int = 3) -> str:
+    """Format the top k products for query as context for a chat prompt."""
+    return "\n\n".join(
+        f"Product: {result.name}\n{result.text}"
+        for result in get_catalog_index().search(query, k)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the outdoor clothing catalog.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Build or update the index.")
+    build_parser.add_argument("--catalog", default=CATALOG_PATH)
+    search_parser = commands.add_parser("search", help="Search the index.")
+    search_parser.add_argument("query")
+    search_parser.add_argument("-k", type=int, default=5)
+    search_parser.add_argument("--bm25-weight", type=float, default=CATALOG_BM25_WEIGHT)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = CatalogIndex.build(args.catalog)
+        rows, chunks = len(index.meta["rows"]), len(index.vectors)
+        print(f"Indexed {rows} products, {chunks} chunks")
+    else:
+        for result in get_catalog_index().search(args.query, args.k, args.bm25_weight):
+            print(f"{result.score:.3f}  {result.name}\n    {result.text[:200]!r}")
+
+
+if __name__ == "__main__":
+    main()
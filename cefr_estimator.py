@@ -0,0 +1,361 @@
+"""Estimate a text's CEFR level locally, in milliseconds.
+
+The LLM classifier in langy_chains.py costs a full streamed call per submission. This
+estimator scores a handful of surface features (sentence length, word length, long and
+rare words, subordinate clauses, vocabulary variety) with a small ordinal logistic
+model and returns a level with a confidence. When it is confident enough, Langy shows
+the estimate straight away and only asks the LLM for its reasoning on request.
+
+The built-in weights are a rough, uncalibrated prior: they give a level for
+``estimate`` but never replace the LLM classifier. Only a model trained on texts with
+known levels is used in Langy::
+
+    python cefr_estimator.py train levelled_texts.csv -o cefr_model.json
+
+``train`` holds out every fifth text and reports how often estimates that clear
+``CEFR_MIN_CONFIDENCE`` are right on them. Langy only uses the model while that
+accuracy is at least the confidence, so retrain after changing the setting.
+
+Settings are read from the environment:
+
+- ``CEFR_MODEL_PATH``: model JSON written by ``train``, default ``cefr_model.json``.
+  If it doesn't exist, Langy always asks the LLM.
+- ``CEFR_FREQUENCY_LIST``: word list of the target language, most frequent first, one
+  word per line. Enables the rare-word feature.
+- ``CEFR_MIN_CONFIDENCE``: confidence needed to skip the LLM classifier, default 0.8.
+  Set above 1 to always use the LLM. Only applies to a trained model validated at
+  this confidence.
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+from text_diff import split_sentences
+
+CEFR_MODEL_PATH = os.getenv("CEFR_MODEL_PATH", "cefr_model.json")
+CEFR_FREQUENCY_LIST = os.getenv("CEFR_FREQUENCY_LIST", "")
+CEFR_MIN_CONFIDENCE = float(os.getenv("CEFR_MIN_CONFIDENCE", 0.8))
+
+LEVELS = ["A1", "A2", "B1", "B2", "C1", "C2"]
+
+# Words outside this many of the most frequent count as rare
+COMMON_WORDS = 2000
+
+WORD = re.compile(r"[^\W\d_]+(?:['’-][^\W\d_]+)*")
+
+# Subordinating conjunctions and relative pronouns, a proxy for clause complexity
+CLAUSE_MARKERS = {
+    # German
+    "weil", "dass", "obwohl", "wenn", "ob", "als", "während", "nachdem", "bevor",
+    "damit", "sodass", "falls", "seit", "seitdem", "bis", "welche", "welcher",
+    # French
+    "parce", "que", "qui", "dont", "lorsque", "quand", "puisque", "bien", "afin",
+    # Spanish
+    "porque", "aunque", "cuando", "mientras", "donde", "cual", "quien",
+    # English
+    "because", "although", "which", "whereas", "while", "whom", "whose", "unless",
+}  # fmt: skip
+
+FEATURES = [
+    "words_per_sentence",
+    "chars_per_word",
+    "long_word_ratio",
+    "type_token_ratio",
+    "rare_word_ratio",
+    "clauses_per_sentence",
+    "commas_per_sentence",
+]
+
+# Hand-set prior: mean/scale standardise each feature, the weighted sum is a level
+# score and the thresholds sit between the levels on that score. Its probabilities
+# aren't calibrated, so `confident_estimate` doesn't use it.
+DEFAULT_MODEL = {
+    "features": FEATURES,
+    "mean": [13.0, 5.2, 0.15, 0.75, 0.15, 0.7, 1.0],
+    "scale": [5.0, 0.8, 0.08, 0.1, 0.1, 0.5, 0.8],
+    "weights": [1.0, 0.6, 0.5, 0.2, 0.6, 0.5, 0.25],
+    "thresholds": [-2.5, -1.0, 0.5, 2.0, 3.5],
+}
+
+
+@dataclass(frozen=True)
+class CEFREstimate:
+    level: str
+    confidence: float
+    probabilities: dict[str, float]
+    features: dict[str, float | None]
+
+
+@lru_cache(maxsize=1)
+def _frequency_ranks(path: str) -> dict[str, int]:
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        words = (line.split()[0].lower() for line in f if line.strip())
+        return {word: rank for rank, word in enumerate(words)}
+
+
+def extract_features(text: str) -> dict[str, float | None]:
+    """Compute `FEATURES` for text. A feature that can't be computed is None."""
+    sentences = [s for s in split_sentences(text) if WORD.search(s)] or [text]
+    words = WORD.findall(text)
+    if not words:
+        return dict.fromkeys(FEATURES)
+    lower = [word.lower() for word in words]
+    ranks = _frequency_ranks(CEFR_FREQUENCY_LIST)
+    return {
+        "words_per_sentence": len(words) / len(sentences),
+        "chars_per_word": sum(map(len, words)) / len(words),
+        "long_word_ratio": sum(len(word) >= 9 for word in words) / len(words),
+        # Guiraud's index, which depends less on text length than types/tokens
+        "type_token_ratio": len(set(lower)) / math.sqrt(len(words)) / 10,
+        "rare_word_ratio": (
+            sum(ranks.get(word, COMMON_WORDS) >= COMMON_WORDS for word in lower)
+            / len(words)
+            if ranks
+            else None
+        ),
+        "clauses_per_sentence": sum(word in CLAUSE_MARKERS for word in lower)
+        / len(sentences),
+        "commas_per_sentence": text.count(",") / len(sentences),
+    }
+
+
+def _sigmoid(x: float) -> float:
+    if x < -30:
+        return 0.0
+    if x > 30:
+        return 1.0
+    return 1 / (1 + math.exp(-x))
+
+
+class CEFREstimator:
+    """Ordinal logistic regression over `FEATURES`.
+
+    Example Usage
+    ------------------------
+    >>> estimate = CEFREstimator().estimate("Ich heiße Adam. Ich bin 25 Jahre alt.")
+    >>> estimate.level
+    'A1'
+    """
+
+    def __init__(self, model: dict = DEFAULT_MODEL):
+        self.model = model
+        self.trained = model is not DEFAULT_MODEL
+
+    def validated(self, min_confidence: float = CEFR_MIN_CONFIDENCE) -> bool:
+        """Whether estimates that clear min_confidence were right at least that often
+        on the texts held out by ``train``."""
+        check = self.model.get("validation")
+        if not check or check["min_confidence"] != min_confidence:
+            return False
+        accuracy = check["confident_accuracy"]
+        return accuracy is not None and accuracy >= min_confidence
+
+    @classmethod
+    def load(cls, path: str = CEFR_MODEL_PATH) -> "CEFREstimator":
+        """Load a trained model, falling back to the built-in weights."""
+        if path and os.path.exists(path):
+            with open(path) as f:
+                return cls(json.load(f))
+        return cls()
+
+    def _standardise(self, features: dict[str, float | None]) -> list[float]:
+        model = self.model
+        columns = zip(model["features"], model["mean"], model["scale"])
+        return [
+            0.0 if features[name] is None else (features[name] - mean) / scale
+            for name, mean, scale in columns
+        ]
+
+    def _probabilities(self, x: list[float]) -> list[float]:
+        score = sum(w * v for w, v in zip(self.model["weights"], x))
+        cumulative = [_sigmoid(t - score) for t in self.model["thresholds"]] + [1.0]
+        return [b - a for a, b in zip([0.0] + cumulative, cumulative)]
+
+    def estimate(self, text: str) -> CEFREstimate:
+        features = extract_features(text)
+        probabilities = self._probabilities(self._standardise(features))
+        best = max(range(len(LEVELS)), key=probabilities.__getitem__)
+        return CEFREstimate(
+            level=LEVELS[best],
+            confidence=probabilities[best],
+            probabilities=dict(zip(LEVELS, probabilities)),
+            features=features,
+        )
+
+
+def train(
+    texts: list[str], levels: list[str], epochs: int = 500, learning_rate: float = 0.1
+) -> dict:
+    """Fit a model to texts with known CEFR levels by gradient descent.
+
+    Returns
+    -------
+    dict
+        The model, in the layout of `DEFAULT_MODEL`, to save as JSON.
+    """
+    rows = [extract_features(text) for text in texts]
+    labels = [LEVELS.index(level.strip().upper()[:2]) for level in levels]
+    mean, scale = [], []
+    for name in FEATURES:
+        values = [row[name] for row in rows if row[name] is not None] or [0.0]
+        m = sum(values) / len(values)
+        s = math.sqrt(sum((v - m) ** 2 for v in values) / len(values)) or 1.0
+        mean.append(m)
+        scale.append(s)
+    model = {
+        "features": FEATURES,
+        "mean": mean,
+        "scale": scale,
+        "weights": [0.0] * len(FEATURES),
+        "thresholds": [-2.0, -1.0, 0.0, 1.0, 2.0],
+    }
+    estimator = CEFREstimator(model)
+    xs = [estimator._standardise(row) for row in rows]
+    for _ in range(epochs):
+        grad_w = [0.0] * len(FEATURES)
+        grad_t = [0.0] * len(LEVELS[:-1])
+        for x, label in zip(xs, labels):
+            score = sum(w * v for w, v in zip(model["weights"], x))
+            # P(label) = sigmoid(upper - score) - sigmoid(lower - score)
+            upper = model["thresholds"][label] if label < 5 else None
+            lower = model["thresholds"][label - 1] if label > 0 else None
+            su = _sigmoid(upper - score) if upper is not None else 1.0
+            sl = _sigmoid(lower - score) if lower is not None else 0.0
+            p = max(su - sl, 1e-9)
+            du = su * (1 - su) / p
+            dl = sl * (1 - sl) / p
+            # Gradients of the negative log likelihood
+            for i, v in enumerate(x):
+                grad_w[i] += (du - dl) * v
+            if upper is not None:
+                grad_t[label] -= du
+            if lower is not None:
+                grad_t[label - 1] += dl
+        n = len(xs)
+        model["weights"] = [
+            w - learning_rate * g / n for w, g in zip(model["weights"], grad_w)
+        ]
+        thresholds = [
+            t - learning_rate * g / n for t, g in zip(model["thresholds"], grad_t)
+        ]
+        # Keep the thresholds in order
+        for i in range(1, len(thresholds)):
+            thresholds[i] = max(thresholds[i], thresholds[i - 1] + 1e-3)
+        model["thresholds"] = thresholds
+    return model
+
+
+@lru_cache(maxsize=1)
+def get_estimator() -> CEFREstimator:
+    return CEFREstimator.load()
+
+
+@lru_cache(maxsize=256)
+def confident_estimate(text: str) -> CEFREstimate | None:
+    """Return the local estimate for text if a trained model is configured, its
+    validation met `CEFR_MIN_CONFIDENCE` and the estimate clears it."""
+    estimator = get_estimator()
+    if not estimator.validated():
+        return None
+    estimate = estimator.estimate(text)
+    if estimate.confidence >= CEFR_MIN_CONFIDENCE:
+        return estimate
+    return None
+
+
+def calibration(
+    estimator: CEFREstimator,
+    texts: list[str],
+    levels: list[str],
+    min_confidence: float = CEFR_MIN_CONFIDENCE,
+) -> dict:
+    """Check estimator's confidence against texts with known levels.
+
+    Returns
+    -------
+    dict
+        ``accuracy`` over all texts, ``coverage``: the share of texts whose estimate
+        clears min_confidence (and so would skip the LLM), ``confident_accuracy``:
+        how often those are right (None if there are none), and ``bins``: accuracy
+        per confidence band of 0.1, to compare with the band's confidence.
+    """
+    estimates = [estimator.estimate(text) for text in texts]
+    right = [
+        estimate.level == level.strip().upper()[:2]
+        for estimate, level in zip(estimates, levels)
+    ]
+    confident = [r for e, r in zip(estimates, right) if e.confidence >= min_confidence]
+    bins = {}
+    for estimate, is_right in zip(estimates, right):
+        band = f"{min(int(estimate.confidence * 10), 9) / 10:.1f}"
+        bins.setdefault(band, []).append(is_right)
+    return {
+        "min_confidence": min_confidence,
+        "accuracy": sum(right) / len(right),
+        "coverage": len(confident) / len(right),
+        "confident_accuracy": sum(confident) / len(confident) if confident else None,
+        "bins": {
+            band: {"n": len(values), "accuracy": sum(values) / len(values)}
+            for band, values in sorted(bins.items())
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local CEFR level estimator.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser(
+        "train", help="Fit a model to a CSV with text and level columns."
+    )
+    train_parser.add_argument("data")
+    train_parser.add_argument("-o", "--output", default=CEFR_MODEL_PATH)
+    train_parser.add_argument("--epochs", type=int, default=500)
+    estimate_parser = commands.add_parser("estimate", help="Estimate a text's level.")
+    estimate_parser.add_argument("text")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        with open(args.data, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        # Every fifth text is held out to check the confidence
+        held_out, rows = rows[::5], [row for i, row in enumerate(rows) if i % 5]
+        model = train(
+            [row["text"] for row in rows],
+            [row["level"] for row in rows],
+            epochs=args.epochs,
+        )
+        model["validation"] = calibration(
+            CEFREstimator(model),
+            [row["text"] for row in held_out],
+            [row["level"] for row in held_out],
+        )
+        with open(args.output, "w") as f:
+            json.dump(model, f, indent=2)
+        check = model["validation"]
+        print(
+            f"Model written to {args.output}. On {len(held_out)} held-out texts: "
+            f"accuracy {check['accuracy']:.1%}, {check['coverage']:.1%} clear "
+            f"confidence {check['min_confidence']}"
+        )
+        if check["confident_accuracy"] is not None:
+            print(f"  and {check['confident_accuracy']:.1%} of those are right")
+            if check["confident_accuracy"] < check["min_confidence"]:
+                print(
+                    "  Overconfident: raise CEFR_MIN_CONFIDENCE or add training data"
+                    " before using this model."
+                )
+    else:
+        estimate = get_estimator().estimate(args.text)
+        print(json.dumps(estimate.__dict__, indent=2))
+
+
+if __name__ == "__main__":
+    main()
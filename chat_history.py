@@ -0,0 +1,171 @@
+"""Keep chat conversations inside a token budget.
+
+Rather than sending the whole conversation on every turn, `RollingHistory` sends the
+system prompt, a running summary of older turns and as many of the latest turns as fit
+in the budget. Turns are folded into the summary once, as they fall out of the window,
+so the summary is updated incrementally instead of being recomputed every turn.
+"""
+
+from functools import lru_cache
+
+# Every message costs a few tokens on top of its content for the role and separators
+TOKENS_PER_MESSAGE = 4
+
+SUMMARY_PROMPT = """You keep a running summary of a customer's conversation with a
+restaurant order bot. Update the summary with the new messages below. Keep the current
+state of the order (items, options, sizes, drinks, pick up or delivery, address,
+payment) and anything else the bot still needs to know. Drop small talk.
+Reply with the updated summary only.
+
+Current summary: ####{summary}####
+
+New messages: ####{messages}####
+"""
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """Load the tokenizer on first use, it is slow to import."""
+    try:
+        import tiktoken
+    except ImportError:  # Fall back to an estimate if tiktoken isn't installed
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Count the tokens in text. Cached, so each message is only tokenised once."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str = "gpt-3.5-turbo") -> str:
+    """Return the start of text that fits in max_tokens tokens."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        # Matches the estimate of `count_tokens`
+        return text[: max(max_tokens - 1, 0) * 4]
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+
+def count_message_tokens(message: dict, model: str = "gpt-3.5-turbo") -> int:
+    return count_tokens(message["content"], model) + TOKENS_PER_MESSAGE
+
+
+def summarise_messages(summary: str, messages: list[dict]) -> str:
+    """Fold messages into the running summary with one LLM call."""
+    from llm_tracing import get_tracer
+    from streamlit_helpers import OPENAI_RETRIES, chat_completion
+
+    conversation = "\n".join(f'{m["role"]}: {m["content"]}' for m in messages)
+    with get_tracer().span("summary", "gpt-3.5-turbo") as span:
+        completion = chat_completion(
+            model="gpt-3.5-turbo",
+            messages=[
+                {
+                    "role": "user",
+                    "content": SUMMARY_PROMPT.format(
+                        summary=summary or "Nothing yet.", messages=conversation
+                    ),
+                }
+            ],
+            temperature=0,
+        )
+        span.retries = OPENAI_RETRIES.get()
+        span.prompt_tokens = completion.usage.prompt_tokens
+        span.completion_tokens = completion.usage.completion_tokens
+    return completion.choices[0].message.content
+
+
+class RollingHistory:
+    """Build the messages to send for a conversation, within a token budget.
+
+    Example Usage
+    ------------------------
+    >>> history = RollingHistory(token_budget=1500)
+    >>> messages_to_send = history.build(st.session_state["messages"])
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 2000,
+        min_recent_messages: int = 2,
+        summarise=summarise_messages,
+        model: str = "gpt-3.5-turbo",
+    ):
+        """Initialize the history.
+
+        Parameters
+        ----------
+        token_budget : int
+            Maximum number of prompt tokens to send, including the system prompt.
+        min_recent_messages : int
+            The latest messages that are always sent, even if over budget.
+        summarise : Callable[[str, list[dict]], str] | None
+            Takes the current summary and the messages leaving the window, returns the
+            updated summary. None drops the messages leaving the window, for apps that
+            keep the state they need elsewhere.
+        model : str
+            Model whose tokenizer is used to count tokens.
+        """
+        self.token_budget = token_budget
+        self.min_recent_messages = min_recent_messages
+        self.summarise = summarise
+        self.model = model
+        self.summary = ""
+        # Number of conversation messages (after the system prompt) in the summary
+        self.summarised_upto = 0
+
+    def reset(self) -> None:
+        self.summary = ""
+        self.summarised_upto = 0
+
+    def build(self, messages, pinned: list[dict] = ()) -> list[dict]:
+        """Return the messages to send for the conversation so far.
+
+        Parameters
+        ----------
+        messages : Sequence[dict]
+            The full conversation. The first message is the system prompt. Only the
+            messages that are sent or summarised are read.
+        pinned : list[dict]
+            Messages sent right after the system prompt every turn, e.g. the current
+            order. They count against the budget.
+        """
+        system, pinned = messages[:1], list(pinned)
+        budget = self.token_budget - sum(
+            count_message_tokens(m, self.model) for m in system + pinned
+        )
+        if self.summary:
+            budget -= count_tokens(self.summary, self.model) + TOKENS_PER_MESSAGE
+
+        # Keep the latest turns that fit, but never go back into summarised turns.
+        # Indices are into messages, the conversation starts after the system prompt.
+        start, end = len(messages), 1 + self.summarised_upto
+        while start > end:
+            cost = count_message_tokens(messages[start - 1], self.model)
+            recent = len(messages) - start
+            if cost > budget and recent >= self.min_recent_messages:
+                break
+            budget -= cost
+            start -= 1
+
+        if start > end and self.summarise is not None:
+            self.summary = self.summarise(self.summary, messages[end:start])
+        self.summarised_upto = max(start - 1, self.summarised_upto)
+
+        summary = []
+        if self.summary:
+            summary = [
+                {
+                    "role": "system",
+                    "content": f"Summary of the conversation so far: {self.summary}",
+                }
+            ]
+        return system + pinned + summary + messages[start:]
@@ -0,0 +1,118 @@
+"""Parse Langy's markdown corrections locally, while they stream in.
+
+`correct_text` always answers in the same layout (see its few-shot examples)::
+
+    ## Corrected Text
+
+    <corrected text>
+
+    ## Reasons
+    1. <reason>
+    2. <reason>
+
+so there is no need to pay for another LLM call just to pull the corrected text and
+reasons back out of it.
+"""
+
+import re
+
+from pydantic import BaseModel, Field
+
+HEADING = re.compile(r"^\s*#{1,6}\s*(?P<title>.+?)\s*#*\s*$")
+LIST_ITEM = re.compile(r"^\s*(?:\d+[.)]|[-*])\s+(?P<item>.*)$")
+
+
+class Output(BaseModel):
+    corrected_text: str = Field(description="The corrected text (no heading)")
+    reasons: list[str] = Field(description="The list of reasons.")
+
+
+class CorrectionParseError(ValueError):
+    """Raised when the text does not follow the corrected text/reasons layout."""
+
+
+class CorrectionStreamParser:
+    """Incrementally fill an `Output` from markdown tokens as they arrive.
+
+    Example Usage
+    ------------------------
+    >>> parser = CorrectionStreamParser()
+    >>> for token in ["## Corrected Text\\n\\nIch bin", " 25.\\n## Reasons\\n1. Verb"]:
+    ...     parser.feed(token)
+    >>> parser.parse().reasons
+    ['Verb']
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._section = None
+        self._corrected_lines = []
+        self._reasons = []
+
+    def feed(self, token: str) -> None:
+        """Add a streamed token. Only complete lines are parsed."""
+        self._pending += token
+        if "\n" not in token:
+            return
+        *lines, self._pending = self._pending.split("\n")
+        for line in lines:
+            self._parse_line(line)
+
+    def close(self) -> None:
+        """Parse whatever is left over once the stream has finished."""
+        if self._pending:
+            self._parse_line(self._pending)
+            self._pending = ""
+
+    @property
+    def corrected_text(self) -> str:
+        return "\n".join(self._corrected_lines).strip()
+
+    @property
+    def reasons(self) -> list[str]:
+        return [reason.strip() for reason in self._reasons if reason.strip()]
+
+    def parse(self) -> Output:
+        """Return the parsed output. Call after the stream has finished.
+
+        Raises
+        ------
+        CorrectionParseError
+            If either section is missing or empty.
+        """
+        self.close()
+        if not self.corrected_text:
+            raise CorrectionParseError("No '## Corrected Text' section found.")
+        if not self.reasons:
+            raise CorrectionParseError("No '## Reasons' section found.")
+        return Output(corrected_text=self.corrected_text, reasons=self.reasons)
+
+    def _parse_line(self, line: str) -> None:
+        if line.strip().startswith("```"):
+            return
+        heading = HEADING.match(line)
+        if heading:
+            title = heading.group("title").lower()
+            if title.startswith("corrected text"):
+                self._section = "corrected"
+            elif title.startswith("reason"):
+                self._section = "reasons"
+            else:
+                self._section = None
+            return
+        if self._section == "corrected":
+            self._corrected_lines.append(line.rstrip())
+        elif self._section == "reasons":
+            item = LIST_ITEM.match(line)
+            if item:
+                self._reasons.append(item.group("item"))
+            elif line.strip() and self._reasons:
+                # Reasons that wrap onto a second line
+                self._reasons[-1] += " " + line.strip()
+
+
+def parse_correction_markdown(text: str) -> Output:
+    """Parse a complete `correct_text` response into an `Output`."""
+    parser = CorrectionStreamParser()
+    parser.feed(text)
+    return parser.parse()
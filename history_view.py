@@ -0,0 +1,115 @@
+"""Render a chat history at a cost that doesn't grow with its length.
+
+Streamlit rebuilds every element on every rerun, so drawing each past message as its
+own chat bubble makes a long conversation slower with every turn. `render_history`
+draws only the latest `HISTORY_RECENT` messages as full elements. Older messages are
+folded into an expander that shows one page of them at a time as a single markdown
+fragment, built once per page and memoised, so a rerun costs the same however long
+the conversation is.
+
+Settings are read from the environment:
+
+- ``HISTORY_RECENT``: messages drawn as full elements, default 6.
+- ``HISTORY_PAGE_SIZE``: older messages per page, default 20.
+"""
+
+import html
+import os
+from functools import lru_cache
+from typing import Callable
+
+import streamlit as st
+
+HISTORY_RECENT = int(os.getenv("HISTORY_RECENT", 6))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 20))
+
+DEFAULT_LABELS = {"user": "You", "assistant": "Assistant"}
+
+
+@lru_cache(maxsize=256)
+def render_page(
+    messages: tuple[tuple[str, str], ...],
+    labels: tuple[tuple[str, str], ...],
+    escape: bool = False,
+) -> str:
+    """Join (role, content) pairs into one markdown fragment.
+
+    Parameters
+    ----------
+    messages : tuple[tuple[str, str], ...]
+        The page's messages as (role, content), hashable so pages are memoised.
+    labels : tuple[tuple[str, str], ...]
+        (role, label) pairs; the label is shown in bold before each message.
+    escape : bool
+        Escape HTML in the contents, for plain text messages.
+
+    Example Usage
+    ------------------------
+    >>> render_page((("user", "Hallo"),), (("user", "You"),))
+    '**You:** Hallo'
+    """
+    labels = dict(labels)
+    return "\n\n---\n\n".join(
+        f"**{labels.get(role, role.title())}:** "
+        + (html.escape(content) if escape else content)
+        for role, content in messages
+    )
+
+
+def render_history(
+    messages: list[dict],
+    render_message: Callable[[int, dict], None],
+    labels: dict[str, str] = DEFAULT_LABELS,
+    escape: bool = False,
+    recent: int = HISTORY_RECENT,
+    page_size: int = HISTORY_PAGE_SIZE,
+    key: str = "history",
+) -> None:
+    """Draw the conversation, with older messages paged into an expander.
+
+    System messages aren't shown.
+
+    Parameters
+    ----------
+    messages : list[dict]
+        The conversation, typically ``st.session_state["messages"]``.
+    render_message : Callable[[int, dict], None]
+        Draws one recent message, given its index in messages.
+    labels : dict[str, str]
+        Name shown for each role in the older messages.
+    escape : bool
+        Escape HTML in older messages, for apps whose messages are plain text.
+    recent : int
+        How many of the latest messages render_message draws.
+    page_size : int
+        How many older messages are shown per page.
+    key : str
+        Widget key prefix, to tell several histories on one page apart.
+
+    Example Usage
+    ------------------------
+    >>> def render_message(index, message):
+    ...     with st.chat_message(message["role"]):
+    ...         st.markdown(message["content"])
+    >>> render_history(st.session_state["messages"], render_message)
+    """
+    shown = [i for i, message in enumerate(messages) if message["role"] != "system"]
+    older, latest = shown[: max(len(shown) - recent, 0)], shown[-recent:]
+    if older:
+        pages = (len(older) + page_size - 1) // page_size
+        with st.expander(f"Earlier messages ({len(older)})"):
+            page = pages
+            if pages > 1:
+                page = st.number_input("Page", 1, pages, value=pages, key=f"{key}_page")
+            # Pages are aligned to the start, so a full page's fragment never changes
+            start = (page - 1) * page_size
+            indices = older[start : start + page_size]
+            fragment = render_page(
+                tuple((messages[i]["role"], messages[i]["content"]) for i in indices),
+                tuple(labels.items()),
+                escape,
+            )
+            st.markdown(fragment, unsafe_allow_html=True)
+    if recent > 0:
+        for index in latest:
+            render_message(index, messages[index])
@@ -0,0 +1,120 @@
+"""Parse a streamed JSON object field by field, as it arrives.
+
+`IncrementalJSONParser` reports each top-level field of an object as soon as its value
+is complete, and each item of a top-level array field as soon as that item is complete,
+so the UI can render the start of a structured response before the rest has arrived.
+"""
+
+import json
+
+
+class _Frame:
+    """An open object or array."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.key = None
+        self.expect_key = kind == "object"
+        self.value_start = None
+
+
+class IncrementalJSONParser:
+    """Incrementally parse a JSON object.
+
+    Example Usage
+    ------------------------
+    >>> parser = IncrementalJSONParser()
+    >>> parser.feed('{"level": "A2", "reasons": ["a"')
+    [('field', 'level', 'A2')]
+    >>> for event in parser.feed(', "b"]}'):
+    ...     print(event)
+    ('item', 'reasons', 'a')
+    ('item', 'reasons', 'b')
+    ('field', 'reasons', ['a', 'b'])
+    >>> parser.result
+    {'level': 'A2', 'reasons': ['a', 'b']}
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.result = {}
+        self.done = False
+        self._pos = 0
+        self._in_string = False
+        self._escape = False
+        self._key_start = None
+        self._stack = []
+
+    def feed(self, chunk: str) -> list[tuple[str, str, object]]:
+        """Add a chunk of the JSON text. Anything after the object is ignored.
+
+        Returns
+        -------
+        list[tuple[str, str, object]]
+            Events completed by this chunk, in order: ('field', key, value) for a
+            top-level field and ('item', key, value) for an item of a top-level array.
+        """
+        self.buffer += chunk
+        events = []
+        for i in range(self._pos, len(self.buffer)):
+            if self.done:
+                break
+            self._step(i, self.buffer[i], events)
+        self._pos = len(self.buffer)
+        return events
+
+    def _step(self, i: int, char: str, events: list) -> None:
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if self._key_start is not None:
+                    frame = self._stack[-1]
+                    frame.key = json.loads(self.buffer[self._key_start : i + 1])
+                    frame.expect_key = False
+                    self._key_start = None
+            return
+        if not self._stack:
+            # Skip anything (e.g. whitespace or a code fence) before the object
+            if char == "{":
+                self._stack.append(_Frame("object"))
+            return
+        frame = self._stack[-1]
+        if char == '"':
+            self._in_string = True
+            if frame.expect_key:
+                self._key_start = i
+            elif frame.value_start is None:
+                frame.value_start = i
+        elif char in "{[":
+            if frame.value_start is None:
+                frame.value_start = i
+            self._stack.append(_Frame("object" if char == "{" else "array"))
+        elif char == ",":
+            self._end_value(frame, i, events)
+        elif char in "}]":
+            self._end_value(frame, i, events)
+            self._stack.pop()
+            if not self._stack:
+                self.done = True
+        elif char != ":" and not char.isspace() and frame.value_start is None:
+            frame.value_start = i
+
+    def _end_value(self, frame: _Frame, end: int, events: list) -> None:
+        """Emit the value that ends at end, if it belongs to the top level."""
+        start = frame.value_start
+        frame.value_start = None
+        frame.expect_key = frame.kind == "object"
+        if start is None:
+            return
+        depth = len(self._stack)
+        if depth == 1:
+            value = json.loads(self.buffer[start:end])
+            self.result[frame.key] = value
+            events.append(("field", frame.key, value))
+        elif depth == 2 and frame.kind == "array":
+            value = json.loads(self.buffer[start:end])
+            events.append(("item", self._stack[0].key, value))
@@ -0,0 +1,379 @@
+"""Run LLM work in the background, outside Streamlit's script runs.
+
+Streamlit reruns the whole script whenever the user interacts with the page. If the
+LLM call runs inside the script, a click mid-stream either aborts the call (wasting
+what was already paid for) or starts it again, and the script thread is blocked for
+the whole generation.
+
+Instead, the apps submit a job to the process-wide `JobManager` and keep its id in
+``st.session_state``. The job runs on a background event loop (coroutines) or thread
+pool (blocking functions) and publishes what it produces as events. Every script run
+drains the events from the start with its own cursor, so a rerun picks the stream up
+again instead of starting over. Identical requests in flight at the same time share
+one job, and a job is cancelled once every session waiting on it has cancelled.
+
+Job state lives in a backend. `LocalJobBackend` keeps it in memory; `RedisJobBackend`
+keeps it in Redis (or anything with the same API, e.g. ``fakeredis`` in tests) so
+several app processes can share jobs. Settings are read from the environment:
+
+- ``JOBS_MAX_WORKERS``: threads for blocking jobs, default 32.
+- ``JOBS_REDIS_URL``: use Redis at this URL instead of memory.
+- ``JOBS_TTL``: seconds finished jobs are kept, default 3600.
+
+Example Usage
+------------------------
+>>> manager = get_job_manager()
+>>> job_id = manager.submit(correct, text, key=f"correct:{text}")
+>>> for event in manager.stream(job_id):
+...     placeholder.markdown(event["markdown"])
+>>> manager.result(job_id)
+"""
+
+import asyncio
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterator
+
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", 32))
+JOBS_REDIS_URL = os.getenv("JOBS_REDIS_URL", "")
+JOBS_TTL = int(os.getenv("JOBS_TTL", 3600))
+
+# Seconds between checks whether a running coroutine job has been cancelled
+CANCEL_POLL_INTERVAL = 0.2
+
+FINISHED = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled."""
+
+
+class JobFailed(RuntimeError):
+    """Raised by `JobManager.result` when the job raised an exception."""
+
+
+class LocalJobBackend:
+    """Keeps jobs in memory. Only shared within one process."""
+
+    def __init__(self, ttl: int = JOBS_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+        self._keys = {}
+        self._changed = threading.Condition()
+
+    def claim(self, key: str | None, job_id: str) -> str:
+        """Register job_id, or return the id of the in-flight job with the same key.
+
+        Either way the caller is counted as one more subscriber of the job.
+        """
+        with self._changed:
+            self._expire()
+            owner = self._keys.get(key) if key is not None else None
+            if owner is None:
+                owner = job_id
+                self._jobs[job_id] = {
+                    "status": "queued",
+                    "events": [],
+                    "result": None,
+                    "error": None,
+                    "subscribers": 0,
+                    "cancel": False,
+                    "key": key,
+                    "finished_at": None,
+                }
+                if key is not None:
+                    self._keys[key] = job_id
+            self._jobs[owner]["subscribers"] += 1
+            return owner
+
+    def set_status(self, job_id: str, status: str, result=None, error=None) -> None:
+        with self._changed:
+            job = self._jobs[job_id]
+            job.update(status=status, result=result, error=error)
+            if status in FINISHED:
+                job["finished_at"] = time.monotonic()
+                if self._keys.get(job["key"]) == job_id:
+                    del self._keys[job["key"]]
+            self._changed.notify_all()
+
+    def append(self, job_id: str, event: Any) -> None:
+        with self._changed:
+            self._jobs[job_id]["events"].append(event)
+            self._changed.notify_all()
+
+    def read(self, job_id: str, offset: int, timeout: float) -> tuple[list, str]:
+        """Return the events from offset on and the job status, waiting up to timeout
+        for something new if there isn't anything yet. The status of an unknown or
+        expired job is None."""
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return [], None
+            self._changed.wait_for(
+                lambda: len(job["events"]) > offset or job["status"] in FINISHED,
+                timeout,
+            )
+            return job["events"][offset:], job["status"]
+
+    def get(self, job_id: str) -> dict | None:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def unsubscribe(self, job_id: str) -> int:
+        """Drop one subscriber and return how many are left."""
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None:  # Expired, so already finished
+                return 0
+            job["subscribers"] -= 1
+            if job["subscribers"] <= 0:
+                job["cancel"] = True
+            return job["subscribers"]
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return job is None or job["cancel"]
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        for job_id in [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job["finished_at"] is not None and job["finished_at"] < cutoff
+        ]:
+            del self._jobs[job_id]
+
+
+class RedisJobBackend:
+    """Keeps jobs in Redis, so processes behind a load balancer can share them.
+
+    Events are a Redis list per job and are polled, so cross-process streaming has
+    up to poll_interval of extra latency.
+    """
+
+    def __init__(self, client, ttl: int = JOBS_TTL, poll_interval: float = 0.05):
+        """Initialize the backend.
+
+        Parameters
+        ----------
+        client : redis.Redis
+            A client created with ``decode_responses=True``, or a compatible fake.
+        ttl : int
+            Seconds a job's data is kept after it was last written.
+        poll_interval : float
+            Seconds between checks for new events while reading.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisJobBackend":
+        import redis
+
+        return cls(redis.Redis.from_url(url, decode_responses=True))
+
+    def claim(self, key: str | None, job_id: str) -> str:
+        owner = job_id
+        if key is not None:
+            if not self.client.set(f"jobs:key:{key}", job_id, nx=True, ex=self.ttl):
+                owner = self.client.get(f"jobs:key:{key}") or job_id
+        if owner == job_id:
+            self.client.hset(
+                f"jobs:{job_id}", mapping={"status": "queued", "key": key or ""}
+            )
+        self.client.hincrby(f"jobs:{owner}", "subscribers", 1)
+        self.client.expire(f"jobs:{owner}", self.ttl)
+        return owner
+
+    def set_status(self, job_id: str, status: str, result=None, error=None) -> None:
+        fields = {"status": status, "result": json.dumps(result), "error": error or ""}
+        self.client.hset(f"jobs:{job_id}", mapping=fields)
+        if status in FINISHED:
+            key = self.client.hget(f"jobs:{job_id}", "key")
+            if key and self.client.get(f"jobs:key:{key}") == job_id:
+                self.client.delete(f"jobs:key:{key}")
+
+    def append(self, job_id: str, event: Any) -> None:
+        self.client.rpush(f"jobs:{job_id}:events", json.dumps(event))
+        self.client.expire(f"jobs:{job_id}:events", self.ttl)
+
+    def read(self, job_id: str, offset: int, timeout: float) -> tuple[list, str]:
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.client.lrange(f"jobs:{job_id}:events", offset, -1)
+            status = self.client.hget(f"jobs:{job_id}", "status")
+            if (
+                events
+                or status is None
+                or status in FINISHED
+                or time.monotonic() >= deadline
+            ):
+                return [json.loads(event) for event in events], status
+            time.sleep(self.poll_interval)
+
+    def get(self, job_id: str) -> dict | None:
+        job = self.client.hgetall(f"jobs:{job_id}")
+        if not job:
+            return None
+        return {
+            "status": job["status"],
+            "result": json.loads(job.get("result") or "null"),
+            "error": job.get("error") or None,
+            "subscribers": int(job.get("subscribers", 0)),
+        }
+
+    def unsubscribe(self, job_id: str) -> int:
+        if not self.client.exists(f"jobs:{job_id}"):  # Expired, so already finished
+            return 0
+        remaining = self.client.hincrby(f"jobs:{job_id}", "subscribers", -1)
+        if remaining <= 0:
+            self.client.hset(f"jobs:{job_id}", "cancel", 1)
+        return remaining
+
+    def cancel_requested(self, job_id: str) -> bool:
+        return self.client.hget(f"jobs:{job_id}", "cancel") == "1"
+
+
+class JobManager:
+    """Runs jobs on a background event loop and thread pool."""
+
+    def __init__(self, backend=None, max_workers: int = JOBS_MAX_WORKERS):
+        self.backend = backend or LocalJobBackend()
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+        self._loop = asyncio.new_event_loop()
+        self._tasks = {}
+        threading.Thread(
+            target=self._loop.run_forever, name="job-loop", daemon=True
+        ).start()
+
+    def submit(self, fn: Callable, *args, key: str | None = None, **kwargs) -> str:
+        """Start fn(*args, emit=..., **kwargs) in the background and return the job id.
+
+        fn is a coroutine function or a plain function. It publishes events (anything
+        JSON-serialisable) by calling ``emit(event)``, and its return value is the
+        job's result. If a job with the same key is still running, its id is
+        returned instead and no new work is started.
+        """
+        job_id = uuid.uuid4().hex
+        owner = self.backend.claim(key, job_id)
+        if owner != job_id:
+            return owner
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(job_id, fn, args, kwargs), self._loop
+        )
+        self._tasks[job_id] = future
+        future.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+        return job_id
+
+    async def _run(self, job_id: str, fn: Callable, args, kwargs) -> None:
+        cancelled = threading.Event()
+
+        def emit(event):
+            # Callers such as LangChain's callback manager may swallow the exception,
+            # so the cancellation is also remembered and checked once fn returns
+            if self.backend.cancel_requested(job_id):
+                cancelled.set()
+                raise JobCancelled(job_id)
+            self.backend.append(job_id, event)
+
+        self.backend.set_status(job_id, "running")
+        try:
+            if inspect.iscoroutinefunction(fn):
+                task = asyncio.ensure_future(fn(*args, emit=emit, **kwargs))
+                watcher = asyncio.ensure_future(self._watch(job_id, task))
+                try:
+                    result = await task
+                finally:
+                    watcher.cancel()
+            else:
+                result = await self._loop.run_in_executor(
+                    self._pool, partial(fn, *args, emit=emit, **kwargs)
+                )
+            if cancelled.is_set():
+                raise JobCancelled(job_id)
+        except (JobCancelled, asyncio.CancelledError):
+            self.backend.set_status(job_id, "cancelled")
+        except Exception as error:
+            self.backend.set_status(job_id, "failed", error=repr(error))
+        else:
+            self.backend.set_status(job_id, "done", result=result)
+
+    async def _watch(self, job_id: str, task: asyncio.Future) -> None:
+        """Cancel task once the job is cancelled, also from another process."""
+        while not task.done():
+            await asyncio.sleep(CANCEL_POLL_INTERVAL)
+            if self.backend.cancel_requested(job_id):
+                task.cancel()
+                return
+
+    def stream(self, job_id: str, offset: int = 0, timeout: float = 600) -> Iterator:
+        """Yield the job's events from offset on as they arrive, until it finishes."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            events, status = self.backend.read(job_id, offset, timeout=1.0)
+            yield from events
+            offset += len(events)
+            # An unknown or expired job has nothing more to send
+            if status is None or status in FINISHED and not events:
+                return
+
+    def status(self, job_id: str) -> str | None:
+        job = self.backend.get(job_id)
+        return None if job is None else job["status"]
+
+    def result(self, job_id: str) -> Any:
+        """Return the result of a finished job.
+
+        Raises
+        ------
+        JobCancelled
+            If the job was cancelled.
+        JobFailed
+            If the job raised an exception, or has expired.
+        """
+        job = self.backend.get(job_id)
+        if job is None:
+            raise JobFailed(f"job {job_id} is unknown or has expired")
+        if job["status"] == "cancelled":
+            raise JobCancelled(job_id)
+        if job["status"] == "failed":
+            raise JobFailed(job["error"])
+        return job["result"]
+
+    def cancel(self, job_id: str) -> None:
+        """Stop waiting for a job. It is cancelled once no session is waiting on it.
+
+        Coroutine jobs stop at their next await, blocking ones at their next emit (or,
+        if that is swallowed, run to the end and are then marked cancelled). A job
+        that has already finished or expired is left as it is.
+        """
+        if self.backend.unsubscribe(job_id) > 0:
+            return
+        future = self._tasks.get(job_id)
+        if future is not None:
+            future.cancel()
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """Return the process-wide job manager, using Redis if JOBS_REDIS_URL is set."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            backend = None
+            if JOBS_REDIS_URL:
+                backend = RedisJobBackend.from_url(JOBS_REDIS_URL)
+            _manager = JobManager(backend)
+        return _manager
@@ -1,16 +1,45 @@
-import json
-from json.decoder import JSONDecodeError
+import os
 
 import openai
 import streamlit as st
-from redlines import Redlines
 from streamlit_chat import message
-from streamlit_helpers import generate_response, footer, link
+from streamlit_helpers import (
+    function_arguments_job,
+    generate_response,
+    footer,
+    link,
+)
 from htbuilder import br
 
+from chat_history import count_tokens
+from incremental_json import IncrementalJSONParser
+from jobs import JobCancelled, JobFailed, get_job_manager
+from language_tutor_prompts import (
+    CORRECTION_FUNCTION,
+    convert_input_to_function_prompt,
+    convert_input_to_prompt,
+    get_reasoning_prompt,
+    get_system_prompt,
+    parse_json_response,
+)
+from llm_tracing import render_trace_panel
+from session_store import Conversation, share_prefix
+from text_diff import diff_texts
+from warmup import warm_up
+
 openai.api_key = st.secrets["OPENAI_API_KEY"]
 openai.organization = st.secrets["OPENAI_ORG_ID"]
 
+# Get level, corrections and reasons in one streamed function call instead of two
+# sequential JSON responses
+SINGLE_CALL = os.getenv("TUTOR_SINGLE_CALL", "1") == "1"
+
+CEFR_LINK = (
+    "See [Common European Framework of Reference for Languages]"
+    "(https://en.wikipedia.org/wiki/Common_European_Framework_of_Reference_for_Languages)"
+    " for more information on language levels."
+)
+
 # Setting page title and header
 title = "Langy - The Interactive AI Language Tutor"
 st.set_page_config(page_title=title, page_icon=":mortar_board:")
@@ -24,52 +53,16 @@ Enter some text, then I'll correct it, and explain my reasoning.
 I'm not perfect. Sometimes you'll get odd responses. Running it again usually helps. 🔄"""
 st.markdown(intro)
 
+# Load the tokenizer while the user reads the intro
+warm_up("tokenizer", count_tokens, "")
+
 # Add footer
-source_link = "https://github.com/codeananda/ChatGPT_Projects/blob/main/language_tutor.py"
+source_link = (
+    "https://github.com/codeananda/ChatGPT_Projects/blob/main/language_tutor.py"
+)
 footer(source_link)
 
 
-def get_system_prompt():
-    """Define system prompt for the chatbot. It is a language tutor there to correct
-    mistakes in a foreign language."""
-    system_prompt = """
-    You are a friendly language language tutor here to help students improve
-    their writing skills.
-    
-    All your output must be in JSON format.
-    Under no circumstances should you output anything extra. Only JSON object, at all times.
-    """
-    return system_prompt
-
-
-def convert_input_to_prompt(input_text):
-    """Convert users input text in a foregin language, into a prompt that classifies
-    the text level, gives a reason, and provides corrections."""
-
-    prompt = f"""
-    Please perform the following analysis on the student's input text, delimited by 
-    ####
-    Input text: ####{input_text}####
-    
-    Steps
-    1. Classify the level of the input text as A1 (Lower Beginner), A2 (Upper Beginner), 
-    B1 (Lower Intermediate), B2 (Upper Intermediate), C1 (Lower Advanced), or C2 (Upper Advanced).
-    2. Give a reason for the classification.
-    3. Correct the grammar and spelling of the input text. Find all mistakes and provide
-    all possible corrections so that it is perfect and as if a native speaker had written
-    it.
-    
-    Output Format
-    Output the results as a JSON object with the following fields:
-    1. level,
-    2. level_reason,
-    3. corrected_text,
-    
-    Do not output anything else other than the JSON object.
-    """
-    return prompt
-
-
 def write_response_to_screen(
     user_input: str, response: str, placeholder: st.delta_generator.DeltaGenerator
 ):
@@ -87,47 +80,18 @@ def write_response_to_screen(
     with placeholder.container():
         st.markdown(f"## Input Text")
         st.markdown(user_input)
-        try:
-            response = json.loads(response)
-        except JSONDecodeError:
-            first_brace = response.find("{")
-            last_brace = response.rfind("}")
-            response = response[first_brace : last_brace + 1]
-            response = json.loads(response)
-        comparison = Redlines(user_input, response["corrected_text"])
-        corrected_text = comparison.output_markdown
+        response = parse_json_response(response)
+        comparison = diff_texts(user_input, response["corrected_text"])
+        corrected_text = comparison.markdown
         st.markdown(f'## Level: {response["level"]}')
         st.markdown(f'{response["level_reason"]}')
-        st.markdown(
-            "See [Common European Framework of Reference for Languages]"
-            "(https://en.wikipedia.org/wiki/Common_European_Framework_of_Reference_for_Languages)"
-            " for more information on language levels."
-        )
+        st.markdown(CEFR_LINK)
         st.markdown(f"## Corrected Text")
         st.markdown(corrected_text, unsafe_allow_html=True)
         st.markdown("## Correction Reasons")
-        reasoning_prompt = f"""
-        Please provide a reason for each correction in the corrected text delimited by
-        ####. Each incorrect bit is wrapped in <span> HTML tags and the style attribute
-        contains text-decoration:line-through. Only provide reasons for these corrections.
-        Do not repeat yourself. If the user inputs words in multiple languages, translate them
-        to the target language. 
-        
-        Corrected text: ####{corrected_text}####
-        
-        Provide output as a JSON with a numeric key for each correction and each value being
-        a string with the reason for the correction.
-        
-        Do not output anything else other than the JSON object.
-        """
-        reason_response = generate_response(reasoning_prompt)
-        try:
-            reason_response = json.loads(reason_response)
-        except JSONDecodeError:
-            first_brace = reason_response.find("{")
-            last_brace = reason_response.rfind("}")
-            reason_response = reason_response[first_brace : last_brace + 1]
-            reason_response = json.loads(reason_response)
+        reasoning_prompt = get_reasoning_prompt(comparison.edits)
+        reason_response = generate_response(reasoning_prompt, stage="tutor_reasons")
+        reason_response = parse_json_response(reason_response)
         for i, reason in reason_response.items():
             if "no correction" in reason.lower():
                 continue
@@ -135,17 +99,87 @@ def write_response_to_screen(
     return response
 
 
-initial_state = [
-    {"role": "system", "content": get_system_prompt()},
-]
+def submit_structured_response(user_input: str) -> str:
+    """Start getting the level, corrected text and a reason for each correction in
+    one streamed function call, as a background job. Returns the job id."""
+    messages = [
+        {"role": "system", "content": get_system_prompt()},
+        {"role": "user", "content": convert_input_to_function_prompt(user_input)},
+    ]
+    return get_job_manager().submit(
+        function_arguments_job,
+        messages,
+        CORRECTION_FUNCTION,
+        stage="tutor_structured",
+        key=f"tutor_structured:{user_input}",
+    )
+
+
+def write_structured_response_to_screen(
+    user_input: str, placeholder: st.delta_generator.DeltaGenerator, job_id: str
+):
+    """Render the job started by `submit_structured_response`, each part as soon as
+    it has arrived. After a rerun the job's stream is rendered again from the start.
+
+    Parameters
+    ----------
+    user_input : str
+        The user's input text.
+    placeholder : st.delta_generator.DeltaGenerator
+        The placeholder to write the response to. Likely created with st.empty().
+    job_id : str
+        The id returned by `submit_structured_response`.
+    """
+    parser = IncrementalJSONParser()
+    manager = get_job_manager()
+    with placeholder.container():
+        st.markdown(f"## Input Text")
+        st.markdown(user_input)
+        level_space = st.empty()
+        level_reason_space = st.empty()
+        st.markdown(CEFR_LINK)
+        st.markdown(f"## Corrected Text")
+        corrected_text_space = st.empty()
+        st.markdown("## Correction Reasons")
+        n_reasons = 0
+        for chunk in manager.stream(job_id):
+            for event, key, value in parser.feed(chunk):
+                if event == "field" and key == "level":
+                    level_space.markdown(f"## Level: {value}")
+                elif event == "field" and key == "level_reason":
+                    level_reason_space.markdown(value)
+                elif event == "field" and key == "corrected_text":
+                    corrected_text_space.markdown(
+                        diff_texts(user_input, value).markdown, unsafe_allow_html=True
+                    )
+                elif event == "item" and key == "corrections":
+                    reason = value.get("reason", "")
+                    if not reason or "no correction" in reason.lower():
+                        continue
+                    n_reasons += 1
+                    st.markdown(f"{n_reasons}. {reason}")
+    try:
+        manager.result(job_id)
+    except (JobCancelled, JobFailed) as error:
+        placeholder.error(f"The correction failed: {error!r}")
+        return None
+    return parser.result
+
+
+# Every correction starts a fresh conversation from the shared system prompt
+initial_state = share_prefix([{"role": "system", "content": get_system_prompt()}])
 
 if "messages" not in st.session_state:
-    st.session_state["messages"] = initial_state
+    st.session_state["messages"] = Conversation(initial_state)
 
 # Let user clear the current conversation
 clear_button = st.sidebar.button("Clear Conversation", key="clear")
 if clear_button:
-    st.session_state["messages"] = initial_state
+    st.session_state["messages"] = Conversation(initial_state)
+    if "job" in st.session_state:
+        get_job_manager().cancel(st.session_state.pop("job")["id"])
+
+render_trace_panel()
 
 # Create placeholder space above for output
 output_space = st.empty()
@@ -159,10 +193,24 @@ with st.form(key="my_form", clear_on_submit=True):
 if submit_button and user_input:
     # st.markdown(f'This is the current user input: {user_input}')
     # Clear input area after submit
-    st.session_state["messages"] = initial_state
-    response = generate_response(convert_input_to_prompt(user_input))
-    # response
-    write_response_to_screen(user_input, response, output_space)
+    st.session_state["messages"] = Conversation(initial_state)
+    if SINGLE_CALL:
+        if "job" in st.session_state:
+            get_job_manager().cancel(st.session_state["job"]["id"])
+        job_id = submit_structured_response(user_input)
+        st.session_state["job"] = {"id": job_id, "input": user_input}
+    else:
+        response = generate_response(
+            convert_input_to_prompt(user_input), stage="tutor_correct"
+        )
+        # response
+        write_response_to_screen(user_input, response, output_space)
+
+# The correction runs in the background, so it carries on through a rerun
+if "job" in st.session_state:
+    job = st.session_state["job"]
+    write_structured_response_to_screen(job["input"], output_space, job["id"])
+    del st.session_state["job"]
 
 # st.session_state["messages"]
 
@@ -0,0 +1,157 @@
+"""Prompts for the language tutor (language_tutor.py).
+
+Kept out of the Streamlit script so they can be imported without running the app.
+"""
+
+import json
+from json.decoder import JSONDecodeError
+
+
+def get_system_prompt():
+    """Define system prompt for the chatbot. It is a language tutor there to correct
+    mistakes in a foreign language."""
+    system_prompt = """
+    You are a friendly language language tutor here to help students improve
+    their writing skills.
+    
+    All your output must be in JSON format.
+    Under no circumstances should you output anything extra. Only JSON object, at all times.
+    """
+    return system_prompt
+
+
+def convert_input_to_prompt(input_text):
+    """Convert users input text in a foregin language, into a prompt that classifies
+    the text level, gives a reason, and provides corrections."""
+
+    prompt = f"""
+    Please perform the following analysis on the student's input text, delimited by 
+    ####
+    Input text: ####{input_text}####
+    
+    Steps
+    1. Classify the level of the input text as A1 (Lower Beginner), A2 (Upper Beginner), 
+    B1 (Lower Intermediate), B2 (Upper Intermediate), C1 (Lower Advanced), or C2 (Upper Advanced).
+    2. Give a reason for the classification.
+    3. Correct the grammar and spelling of the input text. Find all mistakes and provide
+    all possible corrections so that it is perfect and as if a native speaker had written
+    it.
+    
+    Output Format
+    Output the results as a JSON object with the following fields:
+    1. level,
+    2. level_reason,
+    3. corrected_text,
+    
+    Do not output anything else other than the JSON object.
+    """
+    return prompt
+
+
+def get_reasoning_prompt(edits):
+    """Ask for a reason for each correction.
+
+    Parameters
+    ----------
+    edits : list[text_diff.Edit]
+        The changes between the input and corrected text, from `text_diff.diff_texts`.
+    """
+    corrections = "\n".join(
+        f"{i}. '{edit.original}' -> '{edit.corrected}'"
+        for i, edit in enumerate(edits, start=1)
+    )
+    reasoning_prompt = f"""
+        Please provide a reason for each correction delimited by ####. Each correction
+        is numbered and shows the original words and what they were changed to. Only
+        provide reasons for these corrections. Do not repeat yourself. If the user
+        inputs words in multiple languages, translate them to the target language.
+
+        Corrections: ####
+        {corrections}
+        ####
+
+        Provide output as a JSON with the number of each correction as the key and
+        each value being a string with the reason for the correction.
+
+        Do not output anything else other than the JSON object.
+        """
+    return reasoning_prompt
+
+
+def parse_json_response(response: str) -> dict:
+    """Parse a JSON response, ignoring any text the model added around the object."""
+    try:
+        return json.loads(response)
+    except JSONDecodeError:
+        first_brace = response.find("{")
+        last_brace = response.rfind("}")
+        return json.loads(response[first_brace : last_brace + 1])
+
+
+# Everything language_tutor needs, in one function-calling response. Fields are in
+# the order they are rendered, so level and corrected text can be shown while the
+# per-correction reasons are still streaming.
+CORRECTION_FUNCTION = {
+    "name": "report_corrections",
+    "description": "Report the CEFR level of a student's text and correct it.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "level": {
+                "type": "string",
+                "enum": ["A1", "A2", "B1", "B2", "C1", "C2"],
+                "description": "The CEFR level of the input text.",
+            },
+            "level_reason": {
+                "type": "string",
+                "description": "The reason for the classification.",
+            },
+            "corrected_text": {
+                "type": "string",
+                "description": "The input text with every mistake corrected, as if a "
+                "native speaker had written it.",
+            },
+            "corrections": {
+                "type": "array",
+                "description": "One entry per change made to the input text.",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "original": {"type": "string"},
+                        "corrected": {"type": "string"},
+                        "reason": {
+                            "type": "string",
+                            "description": "Why the change was needed.",
+                        },
+                    },
+                    "required": ["original", "corrected", "reason"],
+                },
+            },
+        },
+        "required": ["level", "level_reason", "corrected_text", "corrections"],
+    },
+}
+
+
+def convert_input_to_function_prompt(input_text):
+    """Like `convert_input_to_prompt`, but the output format is given by
+    `CORRECTION_FUNCTION` and each correction comes with its reason."""
+
+    prompt = f"""
+    Please perform the following analysis on the student's input text, delimited by 
+    ####
+    Input text: ####{input_text}####
+    
+    Steps
+    1. Classify the level of the input text as A1 (Lower Beginner), A2 (Upper Beginner), 
+    B1 (Lower Intermediate), B2 (Upper Intermediate), C1 (Lower Advanced), or C2 (Upper Advanced).
+    2. Give a reason for the classification.
+    3. Correct the grammar and spelling of the input text. Find all mistakes and provide
+    all possible corrections so that it is perfect and as if a native speaker had written
+    it.
+    4. Give a reason for each correction. Only give reasons for words/phrases that changed.
+    If the user inputs words in multiple languages, translate them to the target language.
+    
+    Report the results with the {CORRECTION_FUNCTION["name"]} function.
+    """
+    return prompt
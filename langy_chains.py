@@ -0,0 +1,539 @@
+"""Prompts, parsers, chains and pipeline stages for Langy.
+
+Streamlit re-executes langy.py on every interaction, so everything that doesn't change
+between requests lives here instead: this module is only imported once per process and
+the LangChain objects are built once by `get_chains` and shared between sessions.
+Per-request state, like the streaming callback, is passed in at call time.
+"""
+
+import asyncio
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Any
+
+import streamlit as st
+from langchain import PromptTemplate
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chains import LLMChain
+from langchain.chat_models import ChatOpenAI
+from langchain.output_parsers import PydanticOutputParser
+from langchain.prompts import (
+    ChatPromptTemplate,
+    HumanMessagePromptTemplate,
+)
+from langchain.schema import LLMResult
+
+from cefr_estimator import CEFREstimate, confident_estimate
+from chat_history import count_tokens
+from correction_parser import CorrectionParseError, CorrectionStreamParser, Output
+from langy_prompts import (
+    CEFR_TEXT,
+    CLASSIFY_TEMPLATE,
+    NO_CHANGES,
+    PARSE_TEMPLATE,
+    get_correction_template,
+    select_few_shot,
+)
+from llm_tracing import get_tracer, get_tracing_handler
+from prefilter import get_prefilter
+from prompt_budget import (
+    check_budget,
+    fit_to_budget,
+    prompt_limit,
+    render_few_shot_history,
+    stage_cost,
+)
+from result_cache import get_result_cache, make_key
+from streamlit_helpers import ChatCompletionClient
+from text_diff import split_sentences
+
+# Re-render a streaming message at most this often, or after this many tokens
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_TOKENS = 20
+
+# Texts longer than this are corrected in chunks of about LANGY_CHUNK_TOKENS in parallel
+LONG_TEXT_TOKENS = int(os.getenv("LANGY_LONG_TEXT_TOKENS", 300))
+CHUNK_TOKENS = int(os.getenv("LANGY_CHUNK_TOKENS", 120))
+
+
+class StreamingStreamlitCallbackHandler(BaseCallbackHandler):
+    """Callback handler for streaming. Only works with LLMs that support streaming."""
+
+    # Called on the event loop thread in async chains. Streamlit elements can only be
+    # updated from the script thread, so don't let LangChain hand this to an executor.
+    run_inline = True
+
+    def __init__(
+        self,
+        message_placeholder: st.delta_generator.DeltaGenerator,
+        message_contents: str = "",
+        parser: CorrectionStreamParser | None = None,
+        flush_interval: float = STREAM_FLUSH_INTERVAL,
+        flush_tokens: int = STREAM_FLUSH_TOKENS,
+    ):
+        """Initialize the callback handler.
+
+        Every render re-sends the whole message to the browser, so tokens are buffered
+        and the placeholder is only updated every flush_interval seconds or
+        flush_tokens tokens, whichever comes first.
+
+        Parameters
+        ----------
+        message_placeholder: st.delta_generator.DeltaGenerator
+            The placeholder where the messages will be streamed to. Typically an
+            st.empty() object.
+        parser: CorrectionStreamParser, optional
+            If given, every token is also fed to this parser.
+        flush_interval: float
+            Maximum seconds between renders.
+        flush_tokens: int
+            Maximum tokens between renders.
+        """
+        self.message_placeholder = message_placeholder
+        self.parser = parser
+        self.flush_interval = flush_interval
+        self.flush_tokens = flush_tokens
+        self._chunks = [message_contents]
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def message_contents(self) -> str:
+        return "".join(self._chunks)
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Run on new LLM token. Only available when streaming is enabled."""
+        self._chunks.append(token)
+        self._pending += 1
+        if self.parser is not None:
+            self.parser.feed(token)
+        if (
+            self._pending >= self.flush_tokens
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self, cursor: str = "▌") -> None:
+        """Render everything received so far."""
+        self.message_placeholder.markdown(self.message_contents + cursor)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        """Run when LLM ends running."""
+        self.flush(cursor="")
+
+    def replay(self, text: str) -> None:
+        """Stream a cached response word by word, so it looks the same as a live one."""
+        for token in re.findall(r"\s*\S+|\s+", text):
+            self.on_llm_new_token(token)
+        self.on_llm_end(None)
+
+
+@dataclass(frozen=True)
+class Chains:
+    """The LangChain objects shared by every Langy session."""
+
+    llm: ChatOpenAI
+    classify: LLMChain
+    correct: LLMChain
+    parse: LLMChain
+    parse_output_parser: PydanticOutputParser
+    few_shot_history: str
+    few_shot_tokens: int
+
+
+@st.cache_resource
+def get_chains() -> Chains:
+    """Build the chains once per process. Streaming callbacks are attached per call."""
+    # Retries, timeouts and rate limiting are handled by the shared client layer
+    llm = ChatOpenAI(temperature=0, streaming=True, max_retries=1)
+    llm.client = ChatCompletionClient
+
+    classify_prompt = ChatPromptTemplate(
+        messages=[HumanMessagePromptTemplate.from_template(CLASSIFY_TEMPLATE)],
+        input_variables=["text"],
+    )
+    classify = LLMChain(llm=llm, prompt=classify_prompt, output_key="reason_level")
+
+    # Leave room in the prompt for a text of LONG_TEXT_TOKENS, longer ones are chunked
+    template = get_correction_template()
+    few_shot_history, few_shot_tokens = render_few_shot_history(
+        select_few_shot(),
+        max_tokens=prompt_limit(llm.model_name)
+        - count_tokens(template)
+        - LONG_TEXT_TOKENS,
+    )
+    # The instructions and few-shot history are identical for every request and come
+    # before the user's text, so the provider can reuse its cached prompt prefix.
+    correction_prompt = PromptTemplate(
+        input_variables=["input"],
+        template=template,
+        partial_variables={"history": few_shot_history},
+    )
+    correct = LLMChain(llm=llm, prompt=correction_prompt, output_key="response")
+
+    parse_output_parser = PydanticOutputParser(pydantic_object=Output)
+    parse_prompt = ChatPromptTemplate(
+        messages=[HumanMessagePromptTemplate.from_template(PARSE_TEMPLATE)],
+        input_variables=["text"],
+        partial_variables={
+            "format_instructions": parse_output_parser.get_format_instructions()
+        },
+    )
+    parse_llm = ChatOpenAI(temperature=0, max_retries=1)
+    parse_llm.client = ChatCompletionClient
+    parse = LLMChain(llm=parse_llm, prompt=parse_prompt, output_key="output")
+    return Chains(
+        llm=llm,
+        classify=classify,
+        correct=correct,
+        parse=parse,
+        parse_output_parser=parse_output_parser,
+        few_shot_history=few_shot_history,
+        few_shot_tokens=few_shot_tokens,
+    )
+
+
+def format_estimate(estimate: CEFREstimate) -> str:
+    """Render a local `CEFREstimate` like the LLM classifier's heading."""
+    return (
+        f"## CEFR Level: {estimate.level}\n"
+        f"Estimated from sentence length, vocabulary and sentence structure "
+        f"({estimate.confidence:.0%} confidence)."
+    )
+
+
+async def classify_text_level(prompt, message_placeholder, use_estimate=True) -> str:
+    """Classify the prompt based on the Common European Framework of Reference. Prompt
+    is assumed to be text in a foreign language that the user wants help with.
+
+    If use_estimate and the local `cefr_estimator` is confident, its level is returned
+    straight away without an LLM call. See `confident_estimate`.
+    """
+    estimate = confident_estimate(prompt) if use_estimate else None
+    if estimate is not None:
+        get_tracer().increment("cefr_estimates_total", "classify")
+        reason_level = format_estimate(estimate) + CEFR_TEXT
+        message_placeholder.markdown(reason_level)
+        return reason_level
+
+    chains = get_chains()
+    handler = StreamingStreamlitCallbackHandler(message_placeholder)
+    # The level of a text too long for the prompt is judged on its start
+    prompt = fit_to_budget("classify", prompt, chains.llm.model_name)
+
+    cache = get_result_cache()
+    cache_key = make_key(
+        "classify",
+        prompt,
+        CLASSIFY_TEMPLATE,
+        chains.llm.model_name,
+        chains.llm.temperature,
+    )
+    reason_level = cache.get(cache_key)
+    if reason_level is None:
+        response = await chains.classify.acall(
+            {"text": prompt},
+            callbacks=[handler, get_tracing_handler("classify", cache="miss")],
+        )
+        reason_level = response["reason_level"]
+        cache.set(cache_key, reason_level)
+    else:
+        with get_tracer().span("classify", chains.llm.model_name) as span:
+            span.cache = "hit"
+            handler.replay(reason_level)
+    # Add cefr_text explanation to bottom
+    reason_level += CEFR_TEXT
+    message_placeholder.markdown(reason_level)
+    return reason_level
+
+
+async def correct_text(
+    prompt, message_placeholder, message_contents="", parser=None
+) -> str:
+    """Correct the prompt and give a numbered reason for each correction, in the
+    markdown layout shown by `langy_prompts.FEW_SHOT_EXAMPLES`."""
+    chains = get_chains()
+    check_budget("correct", prompt, chains.llm.model_name)
+    handler = StreamingStreamlitCallbackHandler(
+        message_placeholder, message_contents=message_contents, parser=parser
+    )
+
+    cache = get_result_cache()
+    few_shot = [text for example in select_few_shot() for text in example]
+    cache_key = make_key(
+        "correct",
+        prompt,
+        get_correction_template() + "".join(few_shot),
+        chains.llm.model_name,
+        chains.llm.temperature,
+    )
+    response = cache.get(cache_key)
+    if response is not None:
+        with get_tracer().span("correct", chains.llm.model_name) as span:
+            span.cache = "hit"
+            handler.replay(response)
+        return response
+
+    output = await chains.correct.acall(
+        {"input": prompt},
+        callbacks=[handler, get_tracing_handler("correct", cache="miss")],
+    )
+    response = output["response"]
+    cache.set(cache_key, response)
+    return response
+
+
+def _split_long_sentences(text: str, max_tokens: int) -> list[str]:
+    """Split text into sentences, and sentences over max_tokens into runs of words."""
+    pieces = []
+    for sentence in split_sentences(text):
+        if count_tokens(sentence) <= max_tokens:
+            pieces.append(sentence)
+            continue
+        current = ""
+        for word in re.findall(r"\S+\s*|\s+", sentence):
+            if current and count_tokens(current + word) > max_tokens:
+                pieces.append(current)
+                current = ""
+            current += word
+        pieces.append(current)
+    return pieces
+
+
+def split_chunks(text: str, max_tokens: int = CHUNK_TOKENS) -> list[str]:
+    """Split text into chunks of whole sentences of up to max_tokens tokens.
+
+    Chunks never span a paragraph break and keep their trailing whitespace, so joining
+    them gives back the text. A sentence longer than max_tokens is split between words.
+
+    Example Usage
+    ------------------------
+    >>> split_chunks("Ich bin hier. Du bist da.\\n\\nEr ist weg.", max_tokens=12)
+    ['Ich bin hier. Du bist da.\\n\\n', 'Er ist weg.']
+    """
+    chunks, current, tokens = [], "", 0
+    for sentence in _split_long_sentences(text, max_tokens):
+        sentence_tokens = count_tokens(sentence)
+        if current and tokens + sentence_tokens > max_tokens:
+            chunks.append(current)
+            current, tokens = "", 0
+        current += sentence
+        tokens += sentence_tokens
+        if "\n\n" in sentence:
+            chunks.append(current)
+            current, tokens = "", 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class _LongTextView:
+    """Renders the corrections of every chunk of a long text into one placeholder.
+
+    Each chunk streams into its own `_ChunkPlaceholder`; chunks that haven't produced a
+    corrected text yet are shown as they were written.
+    """
+
+    def __init__(self, message_placeholder, chunks: list[str], parsers: list):
+        self.message_placeholder = message_placeholder
+        self.chunks = chunks
+        self.parsers = parsers
+        self._last_render = 0.0
+
+    def render(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_render < STREAM_FLUSH_INTERVAL:
+            return
+        self._last_render = now
+        texts, reasons = [], []
+        for chunk, parser in zip(self.chunks, self.parsers):
+            text = parser.corrected_text or chunk.strip()
+            texts.append(text + chunk[len(chunk.rstrip()) :])
+            reasons.extend(parser.reasons)
+        body = "## Corrected Text\n\n" + "".join(texts).strip()
+        body += "\n\n## Reasons\n" + "".join(
+            f"{i}. {reason}\n" for i, reason in enumerate(reasons, start=1)
+        )
+        self.message_placeholder.markdown(body + ("" if force else "▌"))
+
+
+class _ChunkPlaceholder:
+    """Stands in for a placeholder for one chunk, re-rendering the whole view."""
+
+    def __init__(self, view: _LongTextView):
+        self.view = view
+
+    def markdown(self, body, **kwargs):
+        self.view.render()
+
+
+def merge_chunk_corrections(chunks: list[str], corrections: list[Output]) -> Output:
+    """Join the corrections of each chunk back into one `Output`.
+
+    Chunks the model left unchanged contribute no reasons, so the merged list doesn't
+    fill up with "No corrections needed" entries.
+    """
+    texts, reasons = [], []
+    for chunk, output in zip(chunks, corrections):
+        texts.append(output.corrected_text + chunk[len(chunk.rstrip()) :])
+        if output.corrected_text.strip() != chunk.strip():
+            reasons.extend(output.reasons)
+    return Output(
+        corrected_text="".join(texts).strip(), reasons=reasons or [NO_CHANGES]
+    )
+
+
+async def correct_long_text(prompt, message_placeholder) -> tuple[str, Output]:
+    """Correct a long text in chunks of sentences, all at the same time.
+
+    Every chunk is sent with the same instructions and few-shot history as
+    `correct_text`, so the latency depends on the chunk size rather than the length of
+    the text. Chunks are cached individually, so after an edit only the chunks that
+    changed go to the LLM again. If a `prefilter.Prefilter` is configured, sentences
+    it finds clean are passed through without an LLM call.
+
+    Returns
+    -------
+    tuple[str, Output]
+        The merged response as markdown and the merged corrections.
+    """
+    # Chunks always fit in the correction prompt, even if LANGY_CHUNK_TOKENS is large
+    budget = stage_cost("correct", get_chains().llm.model_name).max_input_tokens
+    chunks = split_chunks(prompt, max_tokens=min(CHUNK_TOKENS, budget))
+    prefilter = get_prefilter()
+    clean = [False] * len(chunks)
+    if prefilter is not None:
+        chunks, clean = prefilter.partition(chunks)
+    parsers = [CorrectionStreamParser() for _ in chunks]
+    view = _LongTextView(message_placeholder, chunks, parsers)
+
+    async def correct_chunk(chunk, is_clean, parser):
+        audit = is_clean and prefilter.should_audit()
+        if is_clean and not audit:
+            return Output(corrected_text=chunk.strip(), reasons=[])
+        response = await correct_text(chunk, _ChunkPlaceholder(view), parser=parser)
+        try:
+            output = parser.parse()
+        except CorrectionParseError:
+            output = await parse_corrections(response)
+        if audit:
+            prefilter.record_audit(chunk, output.corrected_text)
+        return output
+
+    corrections = await asyncio.gather(
+        *(
+            correct_chunk(chunk, is_clean, parser)
+            for chunk, is_clean, parser in zip(chunks, clean, parsers)
+        )
+    )
+    view.render(force=True)
+    merged = merge_chunk_corrections(chunks, corrections)
+    response = "## Corrected Text\n\n" + merged.corrected_text + "\n\n## Reasons\n"
+    response += "".join(
+        f"{i}. {reason}\n" for i, reason in enumerate(merged.reasons, start=1)
+    )
+    return response, merged
+
+
+async def classify_and_correct(prompt, level_placeholder, correction_placeholder):
+    """Classify the CEFR level of the prompt and correct it at the same time.
+
+    The classification does not depend on the correction, so both LLM calls are
+    started together and each streams into its own placeholder. Texts over
+    `LONG_TEXT_TOKENS` tokens, and every text when a prefilter is configured, are
+    corrected in parallel chunks by `correct_long_text`.
+
+    Parameters
+    ----------
+    prompt: str
+        Text in a foreign language that the user wants help with.
+    level_placeholder: st.delta_generator.DeltaGenerator
+        Placeholder the CEFR classification is streamed to.
+    correction_placeholder: st.delta_generator.DeltaGenerator
+        Placeholder the corrections are streamed to.
+
+    Returns
+    -------
+    tuple[str, Output]
+        The CEFR classification and the parsed corrections.
+    """
+    if count_tokens(prompt) > LONG_TEXT_TOKENS or get_prefilter() is not None:
+        text_class, (_, corrections) = await asyncio.gather(
+            classify_text_level(prompt, level_placeholder),
+            correct_long_text(prompt, correction_placeholder),
+        )
+        return text_class, corrections
+
+    parser = CorrectionStreamParser()
+    text_class, text_correct = await asyncio.gather(
+        classify_text_level(prompt, level_placeholder),
+        correct_text(prompt, correction_placeholder, parser=parser),
+    )
+    try:
+        corrections = parser.parse()
+    except CorrectionParseError:
+        # The model strayed from the few-shot layout, let the LLM extract it instead
+        corrections = await parse_corrections(text_correct)
+    return text_class, corrections
+
+
+async def parse_corrections(correction_and_reasons) -> Output:
+    """Extract the corrections/reasons from input and store in Pydantic object.
+
+    Only used as a fallback when `CorrectionStreamParser` can't parse the response."""
+    chains = get_chains()
+    check_budget("parse", correction_and_reasons, chains.llm.model_name)
+    output = await chains.parse.acall(
+        {"text": correction_and_reasons}, callbacks=[get_tracing_handler("parse")]
+    )
+    results = chains.parse_output_parser.parse(output["output"])
+    return results
+
+
+class EventPlaceholder:
+    """Stands in for an st.empty() inside a background job.
+
+    Streamlit elements can only be updated from the script thread, so a job publishes
+    what it would have rendered as ``{"channel": ..., "markdown": ...}`` events and
+    the script run draining the job renders them into the placeholder of that channel.
+    """
+
+    def __init__(self, emit, channel: str):
+        self.emit = emit
+        self.channel = channel
+
+    def markdown(self, body, **kwargs):
+        self.emit({"channel": self.channel, "markdown": body})
+
+    def empty(self):
+        self.markdown("")
+
+
+async def explain_job(prompt: str, emit) -> str:
+    """Ask the LLM to classify and explain the level of prompt, as a
+    `jobs.JobManager` job. The classification is the result."""
+    return await classify_text_level(
+        prompt, EventPlaceholder(emit, "level"), use_estimate=False
+    )
+
+
+async def correction_job(prompt: str, emit) -> dict:
+    """Run `classify_and_correct` as a `jobs.JobManager` job.
+
+    Returns
+    -------
+    dict
+        The CEFR classification under "level", and the corrected text and reasons.
+    """
+    text_class, corrections = await classify_and_correct(
+        prompt, EventPlaceholder(emit, "level"), EventPlaceholder(emit, "correction")
+    )
+    return {
+        "level": text_class,
+        "corrected_text": corrections.corrected_text,
+        "reasons": corrections.reasons,
+    }
@@ -0,0 +1,178 @@
+"""Prompts for Langy (langy.py), used by langy_chains.py.
+
+Kept out of langy_chains.py so they can be imported (e.g. by prompt_budget.py) without
+LangChain.
+
+The correction prompt comes in two variants, picked with ``LANGY_PROMPT_VARIANT``:
+``full`` (default) and ``compact``, with shorter instructions that state the output
+layout, so fewer or no few-shot examples are needed. ``LANGY_FEW_SHOT`` picks the
+few-shot examples sent by position, e.g. ``0,3``; empty sends none. All are sent by
+default. See ``python prompt_budget.py`` for what each choice costs.
+"""
+
+import os
+from textwrap import dedent
+
+LANGY_PROMPT_VARIANT = os.getenv("LANGY_PROMPT_VARIANT", "full")
+LANGY_FEW_SHOT = os.getenv("LANGY_FEW_SHOT")
+
+NO_CHANGES = "No corrections needed. The text is grammatically correct and natural."
+
+CLASSIFY_TEMPLATE = """Classify the text based on the Common European Framework of Reference
+    for Languages (CEFR), provide detailed reasons for your answer.
+
+    Text: {text}
+
+    Format the output as markdown like this
+
+    ```markdown
+    ## CEFR Level: <level>
+    <reason>
+    ```
+     """
+
+CEFR_TEXT = (
+    "\n\nSee [Common European Framework of Reference for Languages]"
+    "(https://en.wikipedia.org/wiki/Common_European_Framework_of_Reference_for_Languages)"
+    " for more information on language levels."
+)
+
+CORRECTION_TEMPLATE = """The following is a friendly conversation between a human and an AI. The
+    AI is helping the human improve their foreign language writing skills. The human provides texts
+    written in a foreign language and the AI corrects the spelling and grammar of the texts
+    and provides detailed reasons for each correction.
+
+    The AI keeps in in mind spelling, grammar, naturalness (how much it sounds like a native
+    speaker), correct capitalisation, correct placement of commas or other punctuation and
+    anything else necessary for correct writing.
+
+    The AI only provides corrections for words/phrases that have changed. If the original
+    text is the same as the corrected text, then the AI does not provide a correction.
+
+    The AI knows that each sentence may contain multiple errors and provides corrections for
+    all errors in the sentence. It also knows that some sentences will not contain any errors
+    and does not provide corrections for those sentences.
+
+    The AI does not give answers like "changed X to Y because this is how it is done in German".
+    Instead, it explains the reason for the change, e.g. "changed X to Y because Z".
+
+    If the AI does not know the answer to a question, it truthfully says it does not know.
+
+    Current conversation:
+    {history}
+    Human: {input}
+    AI: Let's think step by step"""
+
+# (input, output) pairs shown to the model before the user's text
+FEW_SHOT_EXAMPLES = [
+    (
+        "Hallo, ich heisse Adam. Ich habe 25 Jahre alt.",
+        dedent(
+            """
+    Let's think step by step
+    ## Corrected Text
+
+    Ich heiße Adam. Ich bin 25 Jahre alt.
+
+    ## Reasons
+    1. Corrected spelling of 'heisse' to 'heiße' because 'ss' can be combined to form 'ß' in German.
+    2. Corrected 'alt' to 'bin' because 'bin' is the correct verb to use when stating one's age in German."""
+        ),
+    ),
+    (
+        "Ich bin 25 Jahre alt",
+        dedent(
+            """
+    Let's think step by step
+    ## Corrected Text
+
+    Ich bin 25 Jahre alt.
+
+    ## Reasons
+    1. Added full stop to the end of the sentence because it is a complete sentence."""
+        ),
+    ),
+    (
+        "Ich habe eine Katze. Sie ist schwarz und klein.",
+        dedent(
+            """
+    Let's think step by step
+    ## Corrected Text
+
+    Ich habe eine Katze. Sie ist schwarz und klein.
+
+    ## Reasons
+    1. No corrections needed. The text is grammatically correct and natural."""
+        ),
+    ),
+    (
+        "Ich wohne auf England fuer 15 Jahren.",
+        dedent(
+            """
+    Let's think step by step
+    ## Corrected Text
+
+    Ich wohne in England seit 15 Jahren.
+
+    ## Reasons
+    1. Corrected 'auf' to 'in' because 'in' is the correct preposition to use when talking about living in a country.
+    2. Corrected 'fuer' to 'seit' because 'seit' is the correct preposition to use when talking about the duration of time.
+    """
+        ),
+    ),
+]
+
+PARSE_TEMPLATE = """Extract the corrections and reasons for them from the text.
+
+    Text: ####{text}####
+
+    {format_instructions}
+     """
+
+
+COMPACT_CORRECTION_TEMPLATE = """You are a language tutor. Correct the spelling,
+    grammar, naturalness, capitalisation and punctuation of the human's text, which is
+    written in a foreign language. Give a numbered reason for each change that explains
+    why it was needed. Only list words that changed. Reply in this layout:
+
+    ## Corrected Text
+
+    <corrected text>
+
+    ## Reasons
+    1. <reason>
+
+    If nothing needs changing, the only reason is: "{no_changes}"
+
+    {history}
+    Human: {input}
+    AI: Let's think step by step"""
+
+CORRECTION_TEMPLATES = {
+    "full": CORRECTION_TEMPLATE,
+    "compact": COMPACT_CORRECTION_TEMPLATE.replace("{no_changes}", NO_CHANGES),
+}
+
+
+def get_correction_template(variant: str = LANGY_PROMPT_VARIANT) -> str:
+    """Return the correction prompt template of variant ('full' or 'compact')."""
+    try:
+        return CORRECTION_TEMPLATES[variant]
+    except KeyError:
+        variants = list(CORRECTION_TEMPLATES)
+        raise ValueError(
+            f"Unknown prompt variant {variant!r}, use one of {variants}"
+        ) from None
+
+
+def select_few_shot(spec: str | None = LANGY_FEW_SHOT) -> list[tuple[str, str]]:
+    """Return the `FEW_SHOT_EXAMPLES` picked by spec, comma separated positions.
+
+    Example Usage
+    ------------------------
+    >>> [text for text, _ in select_few_shot("1,3")]
+    ['Ich bin 25 Jahre alt', 'Ich wohne auf England fuer 15 Jahren.']
+    """
+    if spec is None:
+        return list(FEW_SHOT_EXAMPLES)
+    return [FEW_SHOT_EXAMPLES[int(i)] for i in spec.split(",") if i.strip()]
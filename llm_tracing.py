@@ -0,0 +1,264 @@
+"""Latency and token tracing for every LLM call.
+
+Each call is recorded as a `Span`: stage name, model, prompt and completion tokens,
+time to first token, total duration, retries and whether the result cache was hit.
+LangChain calls are traced with the callback handler from `get_tracing_handler`,
+direct OpenAI calls with the `Tracer.span` context manager.
+
+Spans can be exported, configured through the environment:
+
+- ``LLM_TRACE_PATH``: append every span as a JSON line to this file.
+- ``LLM_METRICS_PORT``: serve Prometheus-style metrics on ``/metrics`` on this port.
+- ``LLM_TRACE_PANEL``: set to 1 to show recent spans in the Streamlit sidebar.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from uuid import UUID
+
+from chat_history import count_tokens
+
+LLM_TRACE_PATH = os.getenv("LLM_TRACE_PATH", "")
+LLM_METRICS_PORT = int(os.getenv("LLM_METRICS_PORT", 0))
+LLM_TRACE_PANEL = os.getenv("LLM_TRACE_PANEL", "") == "1"
+
+
+@dataclass
+class Span:
+    """One LLM call."""
+
+    stage: str
+    model: str = ""
+    started_at: float = field(default_factory=time.time)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    ttft: float | None = None
+    duration: float = 0.0
+    retries: int = 0
+    cache: str | None = None
+    error: str | None = None
+
+
+class Tracer:
+    """Collects spans, keeps the most recent ones in memory and exports them."""
+
+    def __init__(self, path: str = LLM_TRACE_PATH, max_recent: int = 200):
+        self.path = path
+        self.recent = deque(maxlen=max_recent)
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self.recent.append(span)
+            labels = (span.stage, span.model, span.cache or "none")
+            self._counters["llm_calls_total", labels] += 1
+            self._counters["llm_call_duration_seconds_sum", labels] += span.duration
+            self._counters["llm_prompt_tokens_total", labels] += span.prompt_tokens
+            self._counters[
+                "llm_completion_tokens_total", labels
+            ] += span.completion_tokens
+            self._counters["llm_retries_total", labels] += span.retries
+            if span.ttft is not None:
+                self._counters["llm_ttft_seconds_sum", labels] += span.ttft
+                self._counters["llm_ttft_seconds_count", labels] += 1
+            if span.error:
+                self._counters["llm_errors_total", labels] += 1
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(asdict(span)) + "\n")
+
+    def increment(self, name: str, stage: str, value: float = 1) -> None:
+        """Add to a counter that isn't tied to one LLM call, e.g. skipped sentences."""
+        with self._lock:
+            self._counters[name, (stage, "", "none")] += value
+
+    @contextmanager
+    def span(self, stage: str, model: str = ""):
+        """Time a block as one span. Fill in tokens, cache etc. on the yielded span.
+
+        Example Usage
+        ------------------------
+        >>> with get_tracer().span("chat", model) as span:
+        ...     completion = chat_completion(model=model, messages=messages)
+        ...     span.completion_tokens = completion.usage.completion_tokens
+        """
+        span = Span(stage=stage, model=model)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as error:
+            span.error = repr(error)
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            if span.ttft is None:
+                # Not streamed, so the first token arrives with the whole response
+                span.ttft = span.duration
+            self.record(span)
+
+    def metrics(self) -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+        lines = []
+        for (name, (stage, model, cache)), value in sorted(counters.items()):
+            labels = f'stage="{stage}",model="{model}",cache="{cache}"'
+            lines.append(f"{name}{{{labels}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve_metrics(self, port: int) -> ThreadingHTTPServer:
+        """Serve `metrics` on http://0.0.0.0:port/metrics from a daemon thread."""
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                data = tracer.metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        httpd = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """Return the process-wide tracer, starting the metrics endpoint on first use."""
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer()
+            if LLM_METRICS_PORT:
+                _tracer.serve_metrics(LLM_METRICS_PORT)
+        return _tracer
+
+
+def get_tracing_handler(stage: str, cache: str | None = None):
+    """Return a LangChain callback handler that records a `Span` for every LLM call.
+
+    Parameters
+    ----------
+    stage: str
+        Name of the pipeline stage, e.g. 'classify'.
+    cache: str, optional
+        'hit' or 'miss' if the stage is behind the result cache.
+    """
+    return _tracing_handler_class()(stage, cache)
+
+
+# LangChain is slow to import and only Langy's chains need the callback handler, so
+# its class is only defined on first use
+@lru_cache(maxsize=None)
+def _tracing_handler_class() -> type:
+    from langchain.callbacks.base import BaseCallbackHandler
+    from langchain.schema import LLMResult
+
+    class TracingCallbackHandler(BaseCallbackHandler):
+        """Record a `Span` for every LLM call in a LangChain chain.
+
+        Streaming ChatOpenAI calls don't report token usage, so tokens are counted
+        locally when the API doesn't return them.
+        """
+
+        run_inline = True
+
+        def __init__(self, stage: str, cache: str | None = None):
+            """Initialize the callback handler.
+
+            Parameters
+            ----------
+            stage: str
+                Name of the pipeline stage, e.g. 'classify'.
+            cache: str, optional
+                'hit' or 'miss' if the stage is behind the result cache.
+            """
+            self.stage = stage
+            self.cache = cache
+            self._runs = {}
+
+        def _start(self, run_id: UUID, prompt: str, kwargs: dict) -> None:
+            params = kwargs.get("invocation_params") or {}
+            span = Span(
+                stage=self.stage,
+                model=params.get("model_name") or params.get("model", ""),
+                cache=self.cache,
+            )
+            span.prompt_tokens = count_tokens(prompt)
+            self._runs[run_id] = (span, time.perf_counter(), [])
+
+        def on_llm_start(
+            self, serialized: dict, prompts: list[str], *, run_id: UUID, **kwargs: Any
+        ) -> None:
+            self._start(run_id, "\n".join(prompts), kwargs)
+
+        def on_chat_model_start(
+            self, serialized: dict, messages: list, *, run_id: UUID, **kwargs: Any
+        ) -> None:
+            prompt = "\n".join(m.content for batch in messages for m in batch)
+            self._start(run_id, prompt, kwargs)
+
+        def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+            span, start, tokens = self._runs[run_id]
+            if span.ttft is None:
+                span.ttft = time.perf_counter() - start
+            tokens.append(token)
+
+        def on_llm_end(
+            self, response: LLMResult, *, run_id: UUID, **kwargs: Any
+        ) -> None:
+            from streamlit_helpers import OPENAI_RETRIES
+
+            span, start, tokens = self._runs.pop(run_id)
+            span.duration = time.perf_counter() - start
+            span.retries = OPENAI_RETRIES.get()
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            span.prompt_tokens = usage.get("prompt_tokens", span.prompt_tokens)
+            span.completion_tokens = usage.get(
+                "completion_tokens", count_tokens("".join(tokens))
+            )
+            if span.ttft is None:
+                span.ttft = span.duration
+            get_tracer().record(span)
+
+        def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+            span, start, _ = self._runs.pop(run_id)
+            span.duration = time.perf_counter() - start
+            span.error = repr(error)
+            get_tracer().record(span)
+
+    return TracingCallbackHandler
+
+
+def render_trace_panel() -> None:
+    """Show the most recent spans in the Streamlit sidebar, if LLM_TRACE_PANEL=1."""
+    if not LLM_TRACE_PANEL:
+        return
+    import streamlit as st
+
+    with st.sidebar.expander("LLM traces"):
+        spans = [asdict(span) for span in reversed(get_tracer().recent)]
+        if spans:
+            st.dataframe(spans)
+        else:
+            st.write("No LLM calls yet.")
@@ -0,0 +1,342 @@
+"""Skip the LLM for sentences a local checker is confident are already correct.
+
+Many submitted sentences need no corrections, and paying the model to say so is slow
+and expensive. With a prefilter enabled, Langy checks every sentence offline first and
+only sends the suspect ones to `correct_text`; clean sentences are passed through as
+they are.
+
+The word checkers only look at spelling, capitalisation and end punctuation. A
+sentence whose only errors are grammar (wrong verb, case, word order or gender, e.g.
+"Ich habe 25 Jahre alt.") scores 1.0 and is skipped even at the strictest threshold,
+so its errors are never corrected or reported. Set ``LANGY_PREFILTER_GRAMMAR`` to also
+run LanguageTool's rules on every sentence that would be skipped. Without it, only
+enable a prefilter where that trade-off is acceptable. At least `MIN_AUDIT_RATE` of
+the skipped sentences are always audited, so misses show up either way.
+
+Checkers are pluggable: subclass `SentenceChecker` and implement `known`. Two ship
+here, configured through the environment:
+
+- ``LANGY_PREFILTER``: ``hunspell`` (needs the ``hunspell`` package) or ``wordlist``
+  (a plain word list, or a Hunspell ``.dic`` file read without its affix rules).
+  Unset to send everything to the LLM.
+- ``LANGY_PREFILTER_DICT``: the dictionary. For ``hunspell`` the path without the
+  ``.dic``/``.aff`` extension, e.g. ``/usr/share/hunspell/de_DE``.
+- ``LANGY_PREFILTER_GRAMMAR``: LanguageTool language code, e.g. ``de-DE`` (needs
+  the ``language_tool_python`` package and Java). Sentences with any grammar match
+  score 0. Unset to check words only.
+- ``LANGY_PREFILTER_THRESHOLD``: score a sentence needs to be skipped, default 1.0
+  (every word known). No threshold catches grammar-only errors, see above.
+- ``LANGY_PREFILTER_AUDIT_RATE``: fraction of skipped sentences still sent to the LLM
+  to count misses (clean-looking sentences the LLM did correct), default 0.05 and
+  never below `MIN_AUDIT_RATE`.
+
+Skip and miss counts are exported with the LLM metrics (see llm_tracing.py). To tune
+the threshold offline, run this module on `batch_correct.py` output::
+
+    python prefilter.py corrections.jsonl --thresholds 0.9 0.95 1.0
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+from text_diff import split_sentences
+
+LANGY_PREFILTER = os.getenv("LANGY_PREFILTER", "")
+LANGY_PREFILTER_DICT = os.getenv("LANGY_PREFILTER_DICT", "")
+LANGY_PREFILTER_GRAMMAR = os.getenv("LANGY_PREFILTER_GRAMMAR", "")
+LANGY_PREFILTER_THRESHOLD = float(os.getenv("LANGY_PREFILTER_THRESHOLD", 1.0))
+LANGY_PREFILTER_AUDIT_RATE = float(os.getenv("LANGY_PREFILTER_AUDIT_RATE", 0.05))
+
+# Skipped sentences are always audited at least this often
+MIN_AUDIT_RATE = 0.01
+
+WORD = re.compile(r"[^\W\d_]+(?:['’-][^\W\d_]+)*")
+SENTENCE_END = re.compile(r"[.!?][\"'”»)\]]*$")
+
+
+class SentenceChecker(ABC):
+    """Scores how confident we are that a sentence has no errors."""
+
+    @abstractmethod
+    def known(self, word: str) -> bool:
+        """Return whether word is spelled correctly."""
+
+    def score(self, sentence: str) -> float:
+        """Return a score from 0 (surely has errors) to 1 (surely correct).
+
+        A sentence must start with a capital and end with punctuation, otherwise it
+        scores 0. The score is then the fraction of its words that are known. Only
+        the first word may match the dictionary in lower case, since capitalisation
+        is one of the things the tutor corrects.
+        """
+        sentence = sentence.strip()
+        words = WORD.findall(sentence)
+        if not words:
+            return 1.0
+        if not sentence[0].isupper() or not SENTENCE_END.search(sentence):
+            return 0.0
+        known = sum(
+            self.known(word) or (i == 0 and self.known(word.lower()))
+            for i, word in enumerate(words)
+        )
+        return known / len(words)
+
+
+class WordListChecker(SentenceChecker):
+    """Check words against a set of known words."""
+
+    def __init__(self, words):
+        self.words = set(words)
+
+    @classmethod
+    def from_file(cls, path: str) -> "WordListChecker":
+        """Read one word per line. Hunspell .dic files work too: the word count on the
+        first line and any /FLAGS are ignored, so only the stems are known."""
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            return cls(
+                line.split("/")[0].strip()
+                for line in f
+                if line.strip() and not line.strip().isdigit()
+            )
+
+    def known(self, word: str) -> bool:
+        return word in self.words
+
+
+class HunspellChecker(SentenceChecker):
+    """Check words with a Hunspell dictionary, including its affix rules."""
+
+    def __init__(self, path: str):
+        import hunspell
+
+        self._hunspell = hunspell.HunSpell(f"{path}.dic", f"{path}.aff")
+        # The hunspell bindings aren't thread-safe
+        self._lock = threading.Lock()
+
+    def known(self, word: str) -> bool:
+        with self._lock:
+            return self._hunspell.spell(word)
+
+
+class GrammarChecker(SentenceChecker):
+    """Score with another checker, but 0 for sentences LanguageTool finds any
+    grammar, style or spelling match in."""
+
+    def __init__(self, checker: SentenceChecker, language: str):
+        import language_tool_python
+
+        self.checker = checker
+        self._tool = language_tool_python.LanguageTool(language)
+        self._lock = threading.Lock()
+
+    def known(self, word: str) -> bool:
+        return self.checker.known(word)
+
+    def score(self, sentence: str) -> float:
+        score = self.checker.score(sentence)
+        # LanguageTool is the slow part, don't ask it about sentences already suspect
+        if score == 0.0:
+            return score
+        with self._lock:
+            matches = self._tool.check(sentence)
+        return 0.0 if matches else score
+
+
+CHECKERS = {"hunspell": HunspellChecker, "wordlist": WordListChecker.from_file}
+
+
+@dataclass
+class PrefilterStats:
+    checked: int = 0
+    skipped: int = 0
+    audited: int = 0
+    misses: int = 0
+
+    @property
+    def skip_rate(self) -> float:
+        return self.skipped / self.checked if self.checked else 0.0
+
+    @property
+    def miss_rate(self) -> float:
+        """Share of audited skips the LLM did correct."""
+        return self.misses / self.audited if self.audited else 0.0
+
+
+class Prefilter:
+    """Split texts into sentences that need the LLM and ones that can be skipped.
+
+    Example Usage
+    ------------------------
+    >>> prefilter = Prefilter(WordListChecker(["Ich", "habe", "eine", "Katze"]))
+    >>> prefilter.partition(["Ich habe eine Katze. Ich habe 25 Jahre alt."])
+    (['Ich habe eine Katze. ', 'Ich habe 25 Jahre alt.'], [True, False])
+    """
+
+    def __init__(
+        self,
+        checker: SentenceChecker,
+        threshold: float = LANGY_PREFILTER_THRESHOLD,
+        audit_rate: float = LANGY_PREFILTER_AUDIT_RATE,
+    ):
+        """Initialize the prefilter.
+
+        Parameters
+        ----------
+        checker : SentenceChecker
+            Scores each sentence.
+        threshold : float
+            Sentences scoring at least this are skipped.
+        audit_rate : float
+            Fraction of skipped sentences sent to the LLM anyway, to count misses.
+            Raised to `MIN_AUDIT_RATE` if lower.
+        """
+        self.checker = checker
+        self.threshold = threshold
+        self.audit_rate = max(audit_rate, MIN_AUDIT_RATE)
+        self.stats = PrefilterStats()
+        self._lock = threading.Lock()
+
+    def is_clean(self, sentence: str) -> bool:
+        clean = self.checker.score(sentence) >= self.threshold
+        with self._lock:
+            self.stats.checked += 1
+            self.stats.skipped += clean
+        self._count("prefilter_sentences_total")
+        if clean:
+            self._count("prefilter_skipped_total")
+        return clean
+
+    def partition(self, chunks: list[str]) -> tuple[list[str], list[bool]]:
+        """Split each chunk into runs of clean and suspect sentences.
+
+        Returns
+        -------
+        tuple[list[str], list[bool]]
+            The runs, which join back into the original text, and whether each is
+            clean.
+        """
+        runs, clean = [], []
+        for chunk in chunks:
+            last = None
+            for sentence in split_sentences(chunk):
+                is_clean = self.is_clean(sentence)
+                if is_clean == last:
+                    runs[-1] += sentence
+                else:
+                    runs.append(sentence)
+                    clean.append(is_clean)
+                last = is_clean
+        return runs, clean
+
+    def should_audit(self) -> bool:
+        return random.random() < self.audit_rate
+
+    def record_audit(self, original: str, corrected: str) -> None:
+        """Count a skipped run the LLM was asked about anyway."""
+        miss = original.strip() != corrected.strip()
+        with self._lock:
+            self.stats.audited += 1
+            self.stats.misses += miss
+        self._count("prefilter_audited_total")
+        if miss:
+            self._count("prefilter_misses_total")
+
+    @staticmethod
+    def _count(name: str) -> None:
+        from llm_tracing import get_tracer
+
+        get_tracer().increment(name, "prefilter")
+
+
+_prefilter = None
+_prefilter_lock = threading.Lock()
+
+
+def get_checker(
+    name: str, path: str, grammar: str = LANGY_PREFILTER_GRAMMAR
+) -> SentenceChecker:
+    """Build the checker called name from `CHECKERS`, wrapped in a
+    `GrammarChecker` if a grammar language is given."""
+    checker = CHECKERS[name](path)
+    if grammar:
+        checker = GrammarChecker(checker, grammar)
+    return checker
+
+
+def get_prefilter() -> Prefilter | None:
+    """Return the configured prefilter, or None if LANGY_PREFILTER isn't set."""
+    global _prefilter
+    if not LANGY_PREFILTER:
+        return None
+    with _prefilter_lock:
+        if _prefilter is None:
+            _prefilter = Prefilter(get_checker(LANGY_PREFILTER, LANGY_PREFILTER_DICT))
+        return _prefilter
+
+
+def evaluate(checker: SentenceChecker, pairs, thresholds: list[float]) -> list[dict]:
+    """Report the skip rate and misses of each threshold on (original, corrected)
+    sentence pairs, where a miss is a skipped sentence that was corrected."""
+    scored = [
+        (checker.score(original), original.strip() != corrected.strip())
+        for original, corrected in pairs
+    ]
+    report = []
+    for threshold in thresholds:
+        skipped = [changed for score, changed in scored if score >= threshold]
+        report.append(
+            {
+                "threshold": threshold,
+                "sentences": len(scored),
+                "skip_rate": len(skipped) / len(scored) if scored else 0.0,
+                "misses": sum(skipped),
+                "miss_rate": sum(skipped) / len(skipped) if skipped else 0.0,
+            }
+        )
+    return report
+
+
+def read_sentence_pairs(path: str):
+    """Yield (original, corrected) sentence pairs from `batch_correct.py` output.
+
+    Texts whose correction changed the number of sentences can't be paired up and
+    are left out.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("error"):
+                continue
+            original = split_sentences(record["text"])
+            corrected = split_sentences(record["corrected_text"])
+            if len(original) == len(corrected):
+                yield from zip(original, corrected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the prefilter threshold.")
+    parser.add_argument("corrections", help="JSONL output of batch_correct.py.")
+    parser.add_argument("--checker", choices=list(CHECKERS), default=LANGY_PREFILTER)
+    parser.add_argument("--dict", default=LANGY_PREFILTER_DICT)
+    parser.add_argument("--grammar", default=LANGY_PREFILTER_GRAMMAR)
+    parser.add_argument(
+        "--thresholds", nargs="+", type=float, default=[0.8, 0.9, 0.95, 1.0]
+    )
+    args = parser.parse_args()
+    if not args.checker or not args.dict:
+        parser.error("Pass --checker and --dict, or set LANGY_PREFILTER(_DICT).")
+    checker = get_checker(args.checker, args.dict, args.grammar)
+    for row in evaluate(
+        checker, read_sentence_pairs(args.corrections), args.thresholds
+    ):
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
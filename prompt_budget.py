@@ -0,0 +1,435 @@
+"""Count what each prompt costs in tokens and keep requests within budget.
+
+Every LLM stage sends a fixed part (instructions, few-shot examples, format
+instructions, function schemas) plus the user's text. This module renders each stage's
+prompt exactly as it is sent, counts it with the local tokenizer (tiktoken) and works
+out how much text fits in the model's context window once ``LLM_COMPLETION_RESERVE``
+tokens are kept free for the answer. Langy uses it to size its few-shot history and to
+keep texts within budget.
+
+Settings are read from the environment:
+
+- ``LLM_CONTEXT_TOKENS``: context window to budget for, default the model's own
+  (`MODEL_CONTEXT_TOKENS`).
+- ``LLM_COMPLETION_RESERVE``: tokens kept free for the answer, default 1000.
+
+Report the fixed and variable cost of every stage, for a prompt variant and selection
+of few-shot examples (see langy_prompts.py)::
+
+    python prompt_budget.py report --variant compact --few-shot 0,3
+
+Compare what smaller correction prompts cost in quality on a local evaluation set of
+texts with reference corrections (calls the API, or ``OPENAI_API_BASE``)::
+
+    python prompt_budget.py eval data/correction_eval.jsonl \\
+        --configs full:all compact:all compact:0,3 compact:none
+"""
+
+import argparse
+import asyncio
+import difflib
+import json
+import os
+import sys
+from dataclasses import dataclass
+from functools import lru_cache
+
+from chat_history import TOKENS_PER_MESSAGE, count_tokens, truncate_tokens
+from langy_prompts import (
+    CLASSIFY_TEMPLATE,
+    LANGY_FEW_SHOT,
+    LANGY_PROMPT_VARIANT,
+    PARSE_TEMPLATE,
+    get_correction_template,
+    select_few_shot,
+)
+from text_diff import split_sentences
+
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+}
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", 0))
+LLM_COMPLETION_RESERVE = int(os.getenv("LLM_COMPLETION_RESERVE", 1000))
+
+# Every reply is primed with a few tokens for the assistant role
+TOKENS_PER_REPLY = 3
+
+STAGES = ["classify", "correct", "parse", "tutor_structured", "waffle_chat", "reviews"]
+
+# Measures how the prompt grows with the text in `report`
+SAMPLE_TEXT = (
+    "Hallo, ich heisse Adam. Ich habe 25 Jahre alt. Ich wohne in England seit 15 "
+    "Jahren aber ich wuerde gerne irgendwo anders wohnen."
+)
+
+
+class PromptBudgetError(ValueError):
+    """Raised when a request would not fit in the model's context window."""
+
+
+def context_limit(model: str = "gpt-3.5-turbo") -> int:
+    return LLM_CONTEXT_TOKENS or MODEL_CONTEXT_TOKENS.get(model, 4096)
+
+
+def prompt_limit(model: str = "gpt-3.5-turbo") -> int:
+    """Tokens a prompt may use, leaving `LLM_COMPLETION_RESERVE` for the answer."""
+    return context_limit(model) - LLM_COMPLETION_RESERVE
+
+
+def render_few_shot_history(
+    examples: list[tuple[str, str]], max_tokens: int | None = None
+) -> tuple[str, int]:
+    """Render (input, output) examples as conversation history.
+
+    Uses the layout of LangChain's ``ConversationTokenBufferMemory`` and, like it,
+    drops the oldest examples until the history fits in max_tokens.
+
+    Returns
+    -------
+    tuple[str, int]
+        The rendered history and its number of tokens.
+
+    Example Usage
+    ------------------------
+    >>> render_few_shot_history([("Ich habe 25", "Ich bin 25.")])[0]
+    'Human: Ich habe 25\\nAI: Ich bin 25.'
+    """
+    lines = [
+        line
+        for example_input, example_output in examples
+        for line in (f"Human: {example_input}", f"AI: {example_output}")
+    ]
+    history = "\n".join(lines)
+    while max_tokens is not None and lines and count_tokens(history) > max_tokens:
+        lines = lines[2:]
+        history = "\n".join(lines)
+    return history, count_tokens(history)
+
+
+@lru_cache(maxsize=1)
+def parse_format_instructions() -> str:
+    """The format instructions the parse stage appends, from LangChain if installed."""
+    from correction_parser import Output
+
+    try:
+        from langchain.output_parsers import PydanticOutputParser
+    except ImportError:
+        return json.dumps(Output.schema())
+    return PydanticOutputParser(pydantic_object=Output).get_format_instructions()
+
+
+def render_stage(
+    stage: str,
+    text: str,
+    variant: str = LANGY_PROMPT_VARIANT,
+    few_shot: str | None = LANGY_FEW_SHOT,
+) -> tuple[list[dict], list[dict]]:
+    """Return the messages and function definitions stage sends for text."""
+    if stage == "classify":
+        return [{"role": "user", "content": CLASSIFY_TEMPLATE.format(text=text)}], []
+    if stage == "correct":
+        history, _ = render_few_shot_history(select_few_shot(few_shot))
+        template = get_correction_template(variant)
+        prompt = template.format(history=history, input=text)
+        return [{"role": "user", "content": prompt}], []
+    if stage == "parse":
+        prompt = PARSE_TEMPLATE.format(
+            text=text, format_instructions=parse_format_instructions()
+        )
+        return [{"role": "user", "content": prompt}], []
+    if stage == "tutor_structured":
+        from language_tutor_prompts import (
+            CORRECTION_FUNCTION,
+            convert_input_to_function_prompt,
+            get_system_prompt,
+        )
+
+        messages = [
+            {"role": "system", "content": get_system_prompt()},
+            {"role": "user", "content": convert_input_to_function_prompt(text)},
+        ]
+        return messages, [CORRECTION_FUNCTION]
+    if stage == "waffle_chat":
+        from waffle_bot_prompts import get_system_prompt
+
+        messages = [
+            {"role": "system", "content": get_system_prompt()},
+            {"role": "user", "content": text},
+        ]
+        return messages, []
+    if stage == "reviews":
+        from review_extraction import EXTRACTION_FUNCTION, get_messages
+
+        review = {"id": "0", "product": "", "review": text}
+        return get_messages([review]), [EXTRACTION_FUNCTION]
+    raise ValueError(f"Unknown stage {stage!r}, use one of {STAGES}")
+
+
+def count_request_tokens(messages: list[dict], functions: list[dict] = ()) -> int:
+    """Prompt tokens of a chat request, as counted by the API (within a few tokens).
+
+    Function definitions are counted as their JSON, which overestimates slightly.
+    """
+    tokens = TOKENS_PER_REPLY
+    tokens += sum(count_tokens(m["content"]) + TOKENS_PER_MESSAGE for m in messages)
+    tokens += sum(count_tokens(json.dumps(function)) for function in functions)
+    return tokens
+
+
+@dataclass
+class StageCost:
+    stage: str
+    fixed_tokens: int
+    tokens_per_input_token: float
+    prompt_limit: int
+
+    @property
+    def max_input_tokens(self) -> int:
+        """How many tokens of text fit in the stage's prompt."""
+        free = self.prompt_limit - self.fixed_tokens
+        return max(int(free / max(self.tokens_per_input_token, 1.0)), 0)
+
+
+@lru_cache(maxsize=64)
+def stage_cost(
+    stage: str,
+    model: str = "gpt-3.5-turbo",
+    variant: str = LANGY_PROMPT_VARIANT,
+    few_shot: str | None = LANGY_FEW_SHOT,
+) -> StageCost:
+    """Measure the fixed cost of stage and how its prompt grows with the text."""
+    fixed = count_request_tokens(*render_stage(stage, "", variant, few_shot))
+    with_sample = count_request_tokens(
+        *render_stage(stage, SAMPLE_TEXT, variant, few_shot)
+    )
+    per_token = (with_sample - fixed) / count_tokens(SAMPLE_TEXT)
+    return StageCost(stage, fixed, per_token, prompt_limit(model))
+
+
+def check_budget(stage: str, text: str, model: str = "gpt-3.5-turbo") -> None:
+    """Raise `PromptBudgetError` if text doesn't fit in stage's prompt."""
+    cost = stage_cost(stage, model)
+    tokens = count_tokens(text)
+    if tokens > cost.max_input_tokens:
+        raise PromptBudgetError(
+            f"{stage}: the text has {tokens} tokens, the prompt only has room for "
+            f"{cost.max_input_tokens} with {model}"
+        )
+
+
+def fit_to_budget(stage: str, text: str, model: str = "gpt-3.5-turbo") -> str:
+    """Return text cut down to the sentences that fit in stage's prompt. If even the
+    first sentence doesn't fit, it is cut at the budget instead.
+
+    Example Usage
+    ------------------------
+    >>> text = fit_to_budget("classify", "wort " * 5000)
+    >>> 0 < count_tokens(text) <= stage_cost("classify").max_input_tokens
+    True
+    """
+    budget = stage_cost(stage, model).max_input_tokens
+    if count_tokens(text) <= budget:
+        return text
+    kept, used = [], 0
+    for sentence in split_sentences(text):
+        used += count_tokens(sentence)
+        if used > budget:
+            break
+        kept.append(sentence)
+    return "".join(kept) or truncate_tokens(text, budget, model)
+
+
+def read_eval_set(path: str) -> list[dict]:
+    """Read {'text': ..., 'corrected': ...} records from a JSONL file."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _edits(original: str, corrected: str) -> set[tuple]:
+    a, b = original.split(), corrected.split()
+    matcher = difflib.SequenceMatcher(a=a, b=b, autojunk=False)
+    return {
+        (i1, i2, tuple(b[j1:j2]))
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    }
+
+
+def edit_f1(original: str, predicted: str, reference: str) -> float:
+    """F1 of the word-level edits predicted makes to original, against reference's.
+
+    Example Usage
+    ------------------------
+    >>> edit_f1("Ich habe 25 Jahre", "Ich bin 25 Jahre", "Ich bin 25 Jahre")
+    1.0
+    >>> edit_f1("Ich habe 25 Jahre", "Ich habe 25 Jahre", "Ich bin 25 Jahre")
+    0.0
+    """
+    predicted_edits = _edits(original, predicted)
+    reference_edits = _edits(original, reference)
+    if not predicted_edits and not reference_edits:
+        return 1.0
+    matched = len(predicted_edits & reference_edits)
+    if not matched:
+        return 0.0
+    precision = matched / len(predicted_edits)
+    recall = matched / len(reference_edits)
+    return 2 * precision * recall / (precision + recall)
+
+
+async def correct_for_eval(
+    text: str, variant: str, few_shot: str | None, model: str = "gpt-3.5-turbo"
+) -> tuple[str, int, int]:
+    """Correct text with a correction prompt variant, as `langy_chains.correct_text`
+    would, sharing its result cache entries.
+
+    Returns
+    -------
+    tuple[str, int, int]
+        The corrected text, prompt tokens and completion tokens.
+    """
+    from correction_parser import CorrectionStreamParser
+    from result_cache import get_result_cache, make_key
+    from streamlit_helpers import achat_completion
+
+    messages, _ = render_stage("correct", text, variant, few_shot)
+    examples = select_few_shot(few_shot)
+    cache = get_result_cache()
+    cache_key = make_key(
+        "correct",
+        text,
+        get_correction_template(variant)
+        + "".join(part for example in examples for part in example),
+        model,
+        0,
+    )
+    response = cache.get(cache_key)
+    if response is None:
+        completion = await achat_completion(
+            model=model, messages=messages, temperature=0
+        )
+        response = completion.choices[0].message.content
+        cache.set(cache_key, response)
+    parser = CorrectionStreamParser()
+    parser.feed(response)
+    corrected = parser.parse().corrected_text
+    return corrected, count_request_tokens(messages), count_tokens(response)
+
+
+async def evaluate(
+    records: list[dict],
+    variant: str,
+    few_shot: str | None,
+    model: str = "gpt-3.5-turbo",
+    concurrency: int = 8,
+) -> dict:
+    """Correct every record with one prompt configuration and score it.
+
+    Returns
+    -------
+    dict
+        Mean edit F1, exact match rate, mean prompt and completion tokens, and the
+        number of responses that couldn't be parsed.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(record):
+        async with semaphore:
+            try:
+                return await correct_for_eval(record["text"], variant, few_shot, model)
+            except Exception as error:
+                return error
+
+    results = await asyncio.gather(*(run(record) for record in records))
+    scores, exact, prompt_tokens, completion_tokens, failed = [], 0, [], [], 0
+    for record, result in zip(records, results):
+        if isinstance(result, Exception):
+            failed += 1
+            scores.append(0.0)
+            continue
+        corrected, prompt, completion = result
+        scores.append(edit_f1(record["text"], corrected, record["corrected"]))
+        exact += corrected.split() == record["corrected"].split()
+        prompt_tokens.append(prompt)
+        completion_tokens.append(completion)
+    return {
+        "variant": variant,
+        "few_shot": "all" if few_shot is None else few_shot or "none",
+        "edit_f1": sum(scores) / len(scores),
+        "exact_match": exact / len(records),
+        "prompt_tokens": sum(prompt_tokens) / max(len(prompt_tokens), 1),
+        "completion_tokens": sum(completion_tokens) / max(len(completion_tokens), 1),
+        "failed": failed,
+    }
+
+
+def parse_config(config: str) -> tuple[str, str | None]:
+    """Parse 'variant:few_shot', few_shot being 'all', 'none' or positions."""
+    variant, _, few_shot = config.partition(":")
+    if few_shot in ("", "all"):
+        return variant, None
+    return variant, "" if few_shot == "none" else few_shot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt token costs and budgets.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_parser = commands.add_parser("report", help="Token cost of every stage.")
+    report_parser.add_argument("--variant", default=LANGY_PROMPT_VARIANT)
+    report_parser.add_argument(
+        "--few-shot", default=LANGY_FEW_SHOT, help="e.g. 0,3 or none; all by default."
+    )
+    report_parser.add_argument("--model", default="gpt-3.5-turbo")
+    eval_parser = commands.add_parser(
+        "eval", help="Quality and cost of correction prompt variants."
+    )
+    eval_parser.add_argument("data", help="JSONL with text and corrected fields.")
+    eval_parser.add_argument(
+        "--configs", nargs="+", default=["full:all", "compact:all", "compact:none"]
+    )
+    eval_parser.add_argument("--model", default="gpt-3.5-turbo")
+    eval_parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == "report":
+        # An empty LANGY_FEW_SHOT means no examples, as in `select_few_shot`
+        few_shot = "all" if args.few_shot is None else args.few_shot or "none"
+        _, few_shot = parse_config(f"{args.variant}:{few_shot}")
+        print(f"Prompt limit: {prompt_limit(args.model)} tokens ({args.model})")
+        for stage in STAGES:
+            try:
+                cost = stage_cost(stage, args.model, args.variant, few_shot)
+            except ImportError as error:
+                print(f"{stage:18} skipped: {error}")
+                continue
+            print(
+                f"{stage:18} fixed {cost.fixed_tokens:5d} tokens, "
+                f"{cost.tokens_per_input_token:.2f} per input token, "
+                f"room for {cost.max_input_tokens} input tokens"
+            )
+        return
+
+    import openai
+    from dotenv import load_dotenv, find_dotenv
+
+    _ = load_dotenv(find_dotenv())
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    openai.organization = os.getenv("OPENAI_ORG_ID")
+    if os.getenv("OPENAI_API_BASE"):
+        openai.api_base = os.getenv("OPENAI_API_BASE")
+    if openai.api_key is None:
+        sys.exit("Set OPENAI_API_KEY (e.g. in a .env file).")
+    records = read_eval_set(args.data)
+    for config in args.configs:
+        variant, few_shot = parse_config(config)
+        result = asyncio.run(
+            evaluate(records, variant, few_shot, args.model, args.concurrency)
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Cache LLM results by content hash.
+
+Every prompt in these apps runs at temperature=0, so the same input text sent with the
+same prompt template to the same model gets (near enough) the same answer. Results are
+kept in a bounded in-memory LRU in front of a local SQLite store, so popular practice
+sentences are only ever paid for once.
+
+Settings are read from the environment:
+
+- ``LLM_CACHE_PATH``: SQLite file, default ``.cache/llm_results.sqlite3``. Set to an
+  empty string to only cache in memory.
+- ``LLM_CACHE_MAX_ENTRIES``: size of the in-memory LRU, default 1024.
+- ``LLM_CACHE_MAX_DISK_ENTRIES``: rows kept on disk before the least recently used
+  are evicted, default 100000. Eviction runs every ``CACHE_EVICT_EVERY`` writes, so
+  the store can briefly hold up to that many rows more.
+- ``LLM_CACHE_TTL``: seconds a result stays valid, default 30 days. 0 disables expiry.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".cache/llm_results.sqlite3")
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1024))
+CACHE_MAX_DISK_ENTRIES = int(os.getenv("LLM_CACHE_MAX_DISK_ENTRIES", 100_000))
+CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 30 * 24 * 60 * 60))
+
+# Counting and expiring rows scans the table, so it is only done every this many writes
+CACHE_EVICT_EVERY = 100
+
+
+def normalise_text(text: str) -> str:
+    """Normalise text so trivially different inputs share a cache entry.
+
+    Unicode is NFC normalised (so 'ß' typed two ways is the same) and runs of
+    whitespace are collapsed. Case and punctuation are kept since they are exactly
+    what the tutor corrects.
+    """
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_key(
+    stage: str, text: str, template: str, model: str, temperature: float
+) -> str:
+    """Build a cache key for one LLM call.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the pipeline stage, e.g. 'classify' or 'correct'.
+    text : str
+        The user's input. Normalised with `normalise_text`.
+    template : str
+        The full prompt template (including any few-shot examples). It is hashed, so
+        editing a prompt automatically invalidates its old results.
+    model : str
+        Name of the OpenAI model.
+    temperature : float
+        Sampling temperature of the call.
+    """
+    payload = json.dumps(
+        {
+            "stage": stage,
+            "text": normalise_text(text),
+            "template": hashlib.sha256(template.encode()).hexdigest(),
+            "model": model,
+            "temperature": temperature,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    """In-memory LRU in front of an optional SQLite store. Safe to share between
+    Streamlit sessions (threads)."""
+
+    def __init__(
+        self,
+        path: str | Path | None = CACHE_PATH,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_disk_entries: int = CACHE_MAX_DISK_ENTRIES,
+        ttl: float = CACHE_TTL,
+    ):
+        """Initialize the cache.
+
+        Parameters
+        ----------
+        path : str | Path | None
+            SQLite file to persist results to. None or '' keeps results in memory only.
+        max_entries : int
+            Maximum number of results held in memory.
+        max_disk_entries : int
+            Maximum number of results held on disk.
+        ttl : float
+            Seconds a result stays valid. 0 means results never expire.
+        """
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed_at)"
+            )
+            self._db.commit()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return bool(self.ttl) and now - created_at > self.ttl
+
+    def get(self, key: str) -> str | None:
+        """Return the cached result for key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                value, created_at = self._memory[key]
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    self._db.execute(
+                        "UPDATE results SET accessed_at = ? WHERE key = ?", (now, key)
+                    )
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        """Store a result."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._writes += 1
+            if self._writes % CACHE_EVICT_EVERY == 0:
+                self._evict_disk(now)
+            self._db.commit()
+
+    def clear(self) -> None:
+        """Remove every stored result."""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM results")
+                self._db.commit()
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now: float) -> None:
+        if self.ttl:
+            self._db.execute(
+                "DELETE FROM results WHERE created_at < ?", (now - self.ttl,)
+            )
+        (count,) = self._db.execute("SELECT COUNT(*) FROM results").fetchone()
+        if count > self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_disk_entries,),
+            )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """Return the process-wide result cache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
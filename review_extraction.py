@@ -0,0 +1,485 @@
+"""Extract sentiment and attributes from product reviews in bulk.
+
+The notebooks in ``prompt_engineering/`` load ``data/product_reviews.csv`` with pandas
+and prompt for one review at a time. This pipeline scales the same extraction to
+millions of reviews:
+
+- The CSV is streamed, so memory doesn't grow with the file.
+- Several short reviews are packed into one prompt (up to ``REVIEWS_PACK_TOKENS``
+  tokens or ``REVIEWS_PACK_SIZE`` reviews) and the model reports every review through
+  one function call with a result per review id. The instructions and schema are then
+  paid for once per pack instead of once per review.
+- Packs run concurrently through the shared OpenAI client, which enforces
+  ``OPENAI_MAX_CONCURRENCY`` and ``OPENAI_REQUESTS_PER_MINUTE``.
+- Results are written as they complete, to JSONL or to a directory of Parquet parts
+  (needs ``pyarrow``). The output doubles as a checkpoint: run the same command again
+  and reviews that already succeeded are skipped.
+
+Records hold the review's row number in the CSV as ``id``, its product and the
+extracted fields (`FIELDS`), or an ``error``. Outputs are only appended to, so a review
+that failed and succeeded on a later run has a record for each; read them with
+`read_results`, which keeps one record per review.
+
+Example Usage
+------------------------
+    python review_extraction.py data/product_reviews.csv -o reviews.jsonl
+    python review_extraction.py reviews.csv -o reviews_parquet/ --concurrency 16
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Iterator
+
+import openai
+from dotenv import load_dotenv, find_dotenv
+
+from chat_history import count_tokens
+from result_cache import get_result_cache, make_key
+
+REVIEWS_PACK_TOKENS = int(os.getenv("REVIEWS_PACK_TOKENS", 1500))
+REVIEWS_PACK_SIZE = int(os.getenv("REVIEWS_PACK_SIZE", 10))
+
+# Parquet parts are written every this many records
+PARQUET_PART_ROWS = 10_000
+
+SYSTEM_PROMPT = """You analyse customer reviews of products. For every review below,
+report the result with the review's id. Reviews can be in any language; answer in
+English."""
+
+FIELDS = {
+    "sentiment": {
+        "type": "string",
+        "enum": ["positive", "negative", "neutral", "mixed"],
+    },
+    "anger": {
+        "type": "boolean",
+        "description": "Whether the reviewer expresses anger.",
+    },
+    "language": {"type": "string", "description": "Language of the review."},
+    "gift": {
+        "type": "boolean",
+        "description": "Whether the item was bought as a gift. False if unknown.",
+    },
+    "delivery_days": {
+        "type": "integer",
+        "description": "Days the product took to arrive, -1 if not mentioned.",
+    },
+    "price_value": {
+        "type": "array",
+        "items": {"type": "string"},
+        "description": "Sentences about the price or value.",
+    },
+    "summary": {"type": "string", "description": "The review in one sentence."},
+}
+
+EXTRACTION_FUNCTION = {
+    "name": "report_reviews",
+    "description": "Report the extracted information for every review.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "reviews": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"id": {"type": "string"}, **FIELDS},
+                    "required": ["id", *FIELDS],
+                },
+            }
+        },
+        "required": ["reviews"],
+    },
+}
+
+
+def read_reviews(path: str | Path) -> Iterator[dict]:
+    """Yield {'id': ..., 'product': ..., 'review': ...} from a CSV, one at a time.
+
+    The id is the review's row number, counting from 0.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        for index, row in enumerate(csv.DictReader(f)):
+            yield {"id": str(index), "product": row["Product"], "review": row["Review"]}
+
+
+def pack_reviews(
+    reviews: Iterable[dict],
+    max_tokens: int = REVIEWS_PACK_TOKENS,
+    max_reviews: int = REVIEWS_PACK_SIZE,
+) -> Iterator[list[dict]]:
+    """Group consecutive reviews into packs of at most max_tokens and max_reviews.
+
+    A review over max_tokens on its own is a pack by itself.
+
+    Example Usage
+    ------------------------
+    >>> review = {"id": "0", "product": "Waterproof Phone Pouch", "review": "Great"}
+    >>> [len(pack) for pack in pack_reviews([review] * 5, max_reviews=2)]
+    [2, 2, 1]
+    """
+    pack, tokens = [], 0
+    for review in reviews:
+        cost = count_tokens(format_review(review))
+        if pack and (tokens + cost > max_tokens or len(pack) >= max_reviews):
+            yield pack
+            pack, tokens = [], 0
+        pack.append(review)
+        tokens += cost
+    if pack:
+        yield pack
+
+
+def format_review(review: dict) -> str:
+    return (
+        f"id: {review['id']}\nproduct: {review['product']}\n"
+        f"review: {review['review']}"
+    )
+
+
+def get_messages(pack: list[dict]) -> list[dict]:
+    reviews = "\n\n".join(format_review(review) for review in pack)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Reviews:\n\n{reviews}"},
+    ]
+
+
+async def extract_pack(pack: list[dict], model: str = "gpt-3.5-turbo") -> dict:
+    """Extract `FIELDS` for every review of pack with one LLM call.
+
+    Returns
+    -------
+    dict
+        The results by review id under 'results' (reviews the model skipped are
+        missing) and the tokens the call used under 'tokens' (0 if cached).
+    """
+    from streamlit_helpers import achat_completion
+
+    messages = get_messages(pack)
+    cache = get_result_cache()
+    cache_key = make_key(
+        "reviews", json.dumps(messages), json.dumps(EXTRACTION_FUNCTION), model, 0
+    )
+    arguments, tokens = cache.get(cache_key), 0
+    if arguments is None:
+        completion = await achat_completion(
+            model=model,
+            messages=messages,
+            temperature=0,
+            functions=[EXTRACTION_FUNCTION],
+            function_call={"name": EXTRACTION_FUNCTION["name"]},
+        )
+        arguments = completion.choices[0].message.function_call.arguments
+        tokens = completion.usage.total_tokens
+        cache.set(cache_key, arguments)
+    results = {}
+    for item in json.loads(arguments)["reviews"]:
+        results[str(item.pop("id"))] = {name: item.get(name) for name in FIELDS}
+    return {"results": results, "tokens": tokens}
+
+
+async def extract_reviews(
+    reviews: Iterable[dict],
+    concurrency: int = 8,
+    skip_ids: set[str] = frozenset(),
+    max_tokens: int = REVIEWS_PACK_TOKENS,
+    max_reviews: int = REVIEWS_PACK_SIZE,
+) -> AsyncIterator[tuple[list[dict], int]]:
+    """Extract every review with at most concurrency packs in flight.
+
+    Reviews the model leaves out of a pack's answer are retried once on their own.
+
+    Parameters
+    ----------
+    reviews : Iterable[dict]
+        Reviews with 'id', 'product' and 'review', e.g. from `read_reviews`. Read
+        lazily.
+    concurrency : int
+        Maximum number of packs being extracted at once.
+    skip_ids : set[str]
+        Ids of reviews that are already done.
+    max_tokens : int
+        Token budget of the reviews in one pack.
+    max_reviews : int
+        Maximum number of reviews in one pack.
+
+    Yields
+    ------
+    tuple[list[dict], int]
+        The records of a pack as it completes, and the tokens it used.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_pack(pack: list[dict], retry: bool = True) -> tuple[list, int]:
+        try:
+            async with semaphore:
+                extracted = await extract_pack(pack)
+        except Exception as error:
+            records = [
+                {"id": r["id"], "product": r["product"], "error": repr(error)}
+                for r in pack
+            ]
+            return records, 0
+        records, tokens = [], extracted["tokens"]
+        for review in pack:
+            result = extracted["results"].get(review["id"])
+            if result is None and retry and len(pack) > 1:
+                retried, retry_tokens = await run_pack([review], retry=False)
+                records += retried
+                tokens += retry_tokens
+                continue
+            record = {"id": review["id"], "product": review["product"]}
+            if result is None:
+                record["error"] = "missing from the response"
+            else:
+                record.update(result)
+            records.append(record)
+        return records, tokens
+
+    todo = (review for review in reviews if review["id"] not in skip_ids)
+    # Don't read (and hold) the whole input at once
+    window = concurrency * 2
+    pending = set()
+    for pack in pack_reviews(todo, max_tokens, max_reviews):
+        pending.add(asyncio.ensure_future(run_pack(pack)))
+        if len(pending) >= window:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+
+class JSONLWriter:
+    """Appends records to a JSONL file."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._file = None
+
+    def done_ids(self) -> set[str]:
+        from batch_correct import read_done_ids
+
+        return read_done_ids(self.path)
+
+    def records(self) -> Iterator[dict]:
+        if not self.path.exists():
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by an interruption
+                    continue
+
+    def write(self, records: list[dict]) -> None:
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+def arrow_schema():
+    """The pyarrow schema of the records, built from `FIELDS`."""
+    import pyarrow as pa
+
+    types = {"string": pa.string(), "boolean": pa.bool_(), "integer": pa.int64()}
+    columns = [("id", pa.string()), ("product", pa.string())]
+    for name, spec in FIELDS.items():
+        if spec["type"] == "array":
+            columns.append((name, pa.list_(types[spec["items"]["type"]])))
+        else:
+            columns.append((name, types[spec["type"]]))
+    columns.append(("error", pa.string()))
+    return pa.schema(columns)
+
+
+class ParquetWriter:
+    """Writes records to a directory of Parquet files, one new part per flush.
+
+    Parquet files can't be appended to, so each run adds parts and never rewrites
+    earlier ones. Records buffered when the process dies are lost and redone on the
+    next run.
+    """
+
+    def __init__(self, path: str | Path, part_rows: int = PARQUET_PART_ROWS):
+        self.path = Path(path)
+        self.part_rows = part_rows
+        self._buffer = []
+
+    def done_ids(self) -> set[str]:
+        import pyarrow.parquet as pq
+
+        done = set()
+        for part in sorted(self.path.glob("part-*.parquet")):
+            table = pq.read_table(part, columns=["id", "error"])
+            for id_, error in zip(table["id"].to_pylist(), table["error"].to_pylist()):
+                if not error:
+                    done.add(id_)
+        return done
+
+    def records(self) -> Iterator[dict]:
+        import pyarrow.parquet as pq
+
+        for part in sorted(self.path.glob("part-*.parquet")):
+            yield from pq.read_table(part).to_pylist()
+
+    def write(self, records: list[dict]) -> None:
+        self._buffer += records
+        if len(self._buffer) >= self.part_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._buffer:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Every part gets the same schema, so the directory reads as one dataset even
+        # if a part has no errors or no delivery days (which would be inferred as null)
+        schema = arrow_schema()
+        rows = [{name: row.get(name) for name in schema.names} for row in self._buffer]
+        table = pa.Table.from_pylist(rows, schema=schema)
+        part = len(list(self.path.glob("part-*.parquet")))
+        pq.write_table(table, self.path / f"part-{part:05d}.parquet")
+        self._buffer = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+def get_writer(path: str | Path):
+    """A `JSONLWriter` for .jsonl paths, a `ParquetWriter` for anything else."""
+    if str(path).endswith(".jsonl"):
+        return JSONLWriter(path)
+    return ParquetWriter(path)
+
+
+def read_results(path: str | Path) -> Iterator[dict]:
+    """Yield one record per review from an output of `run_extraction`: the last
+    successful one, or the last failure if it never succeeded."""
+    results = {}
+    for record in get_writer(path).records():
+        previous = results.get(record["id"])
+        # A failure doesn't replace an earlier success
+        if record.get("error") and previous and not previous.get("error"):
+            continue
+        results[record["id"]] = record
+    yield from results.values()
+
+
+async def run_extraction_async(
+    input_path: str | Path,
+    output_path: str | Path,
+    concurrency: int = 8,
+    max_tokens: int = REVIEWS_PACK_TOKENS,
+    max_reviews: int = REVIEWS_PACK_SIZE,
+    progress: bool = True,
+) -> dict:
+    """Extract every review of input_path and write the records to output_path.
+
+    Parameters
+    ----------
+    input_path : str | Path
+        CSV with Product and Review columns, like data/product_reviews.csv.
+    output_path : str | Path
+        A .jsonl file, or a directory for Parquet parts. Reviews it already has
+        results for are skipped.
+    concurrency : int
+        Maximum number of packs being extracted at once.
+    max_tokens : int
+        Token budget of the reviews in one pack.
+    max_reviews : int
+        Maximum number of reviews in one pack.
+    progress : bool
+        Print progress to stderr.
+
+    Returns
+    -------
+    dict
+        Reviews written, skipped and failed, reviews per second and the LLM tokens
+        used per review (cached packs count as 0).
+    """
+    writer = get_writer(output_path)
+    skip_ids = writer.done_ids()
+    stats = {"written": 0, "skipped": len(skip_ids), "failed": 0, "tokens": 0}
+    start = time.perf_counter()
+    try:
+        async for records, tokens in extract_reviews(
+            read_reviews(input_path), concurrency, skip_ids, max_tokens, max_reviews
+        ):
+            writer.write(records)
+            stats["written"] += len(records)
+            stats["failed"] += sum(bool(record.get("error")) for record in records)
+            stats["tokens"] += tokens
+            if progress:
+                rate = stats["written"] / (time.perf_counter() - start)
+                print(
+                    f"\r{stats['written']} written ({stats['failed']} failed), "
+                    f"{rate:.2f} reviews/s, "
+                    f"{stats['tokens'] / stats['written']:.0f} tokens/review",
+                    end="",
+                    file=sys.stderr,
+                )
+    finally:
+        writer.close()
+    if progress:
+        print(file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    stats["reviews_per_second"] = stats["written"] / elapsed if elapsed else 0.0
+    stats["tokens_per_review"] = stats["tokens"] / max(stats["written"], 1)
+    return stats
+
+
+def run_extraction(*args, **kwargs) -> dict:
+    """Blocking version of `run_extraction_async`."""
+    return asyncio.run(run_extraction_async(*args, **kwargs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract review attributes in bulk.")
+    parser.add_argument("input", help="CSV with Product and Review columns.")
+    parser.add_argument(
+        "-o", "--output", required=True, help="JSONL file or Parquet directory."
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--pack-tokens", type=int, default=REVIEWS_PACK_TOKENS)
+    parser.add_argument("--pack-size", type=int, default=REVIEWS_PACK_SIZE)
+    parser.add_argument("--quiet", action="store_true", help="Don't show progress.")
+    args = parser.parse_args()
+
+    _ = load_dotenv(find_dotenv())
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    openai.organization = os.getenv("OPENAI_ORG_ID")
+    if openai.api_key is None:
+        sys.exit("Set OPENAI_API_KEY (e.g. in a .env file).")
+    stats = run_extraction(
+        args.input,
+        args.output,
+        concurrency=args.concurrency,
+        max_tokens=args.pack_tokens,
+        max_reviews=args.pack_size,
+        progress=not args.quiet,
+    )
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
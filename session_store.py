@@ -0,0 +1,419 @@
+"""Keep conversations compact in memory and persist them across restarts.
+
+Each app used to keep its conversation as a list of dicts in ``st.session_state``:
+memory grew with users × history length, every session held its own copy of the
+system prompt, and a redeploy lost everything. Now each conversation is a
+`Conversation`:
+
+- The app's opening messages (system prompt, greeting) are a shared prefix, stored
+  once per process and referenced by every session instead of copied.
+- Every other message is a `CompactMessage`: the role is interned, long contents are
+  zlib-compressed, and the token count is computed once and kept alongside.
+
+Conversations live in a `SessionStore`: an LRU of hot conversations in memory, capped
+at ``SESSION_MEMORY_CAP_MB``, in front of a backend. Cold conversations are evicted to
+the backend and loaded again when their session comes back. The session id is kept in
+the page URL (``?session=...``), so a reload or a redeploy resumes the conversation.
+Anyone with that URL can read and continue the conversation, so the id is a random
+token and ids that don't look like one are replaced with a new one.
+
+Settings are read from the environment:
+
+- ``SESSION_STORE_PATH``: SQLite file for conversations, default
+  ``.cache/sessions.sqlite3``. Set to an empty string to keep them in memory only,
+  compressed once evicted, and lost on restart.
+- ``SESSION_MEMORY_CAP_MB``: memory for hot conversations, default 64.
+- ``SESSION_TTL``: seconds an untouched conversation is kept, default 30 days.
+
+Example Usage
+------------------------
+>>> messages = get_conversation("waffle_bot", shared=initial_state)
+>>> messages.append({"role": "user", "content": "One waffle please"})
+>>> order = OrderSession.from_dict(messages.state.get("order"))
+>>> messages.set_state("order", order.to_dict())
+"""
+
+import json
+import os
+import re
+import secrets
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableSequence
+from pathlib import Path
+
+from chat_history import count_message_tokens
+
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", ".cache/sessions.sqlite3")
+SESSION_MEMORY_CAP_MB = float(os.getenv("SESSION_MEMORY_CAP_MB", 64))
+SESSION_TTL = float(os.getenv("SESSION_TTL", 30 * 24 * 60 * 60))
+
+# Contents shorter than this many bytes don't shrink enough to be worth compressing
+COMPRESS_MIN_BYTES = 200
+
+# Rough per-message overhead of the Python objects, for the memory cap
+MESSAGE_OVERHEAD_BYTES = 120
+
+# Session ids are secrets.token_urlsafe(SESSION_ID_BYTES): 43 URL-safe characters
+SESSION_ID_BYTES = 32
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{43}")
+
+
+class CompactMessage:
+    """One chat message, stored compactly. Use `to_dict` to get the message back."""
+
+    __slots__ = ("role", "_content", "_compressed", "_tokens", "extra")
+
+    def __init__(self, role: str, content: str, extra: dict | None = None):
+        self.role = sys.intern(role)
+        data = content.encode()
+        self._compressed = len(data) >= COMPRESS_MIN_BYTES
+        self._content = zlib.compress(data) if self._compressed else data
+        self._tokens = None
+        # Any other keys of the message, e.g. Langy's "level"
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, message: dict) -> "CompactMessage":
+        extra = {k: v for k, v in message.items() if k not in ("role", "content")}
+        return cls(message["role"], message["content"], extra)
+
+    @property
+    def content(self) -> str:
+        data = zlib.decompress(self._content) if self._compressed else self._content
+        return data.decode()
+
+    @property
+    def tokens(self) -> int:
+        """Token count of the message, counted on first use."""
+        if self._tokens is None:
+            self._tokens = count_message_tokens(self.to_dict())
+        return self._tokens
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._content) + MESSAGE_OVERHEAD_BYTES
+
+    def to_dict(self) -> dict:
+        message = {"role": self.role, "content": self.content}
+        if self.extra:
+            message.update(self.extra)
+        return message
+
+    def to_row(self) -> list:
+        return [self.role, self.content, self.extra, self._tokens]
+
+    @classmethod
+    def from_row(cls, row: list) -> "CompactMessage":
+        role, content, extra, tokens = row
+        message = cls(role, content, extra)
+        message._tokens = tokens
+        return message
+
+
+_shared_prefixes = {}
+_shared_lock = threading.Lock()
+
+
+def share_prefix(messages: list[dict]) -> tuple[dict, ...]:
+    """Return one process-wide copy of messages, so every session refers to it.
+
+    Streamlit builds a new ``initial_state`` list on every rerun; this maps equal
+    lists to the same tuple.
+    """
+    key = json.dumps(messages, sort_keys=True)
+    with _shared_lock:
+        if key not in _shared_prefixes:
+            _shared_prefixes[key] = tuple(dict(m) for m in messages)
+        return _shared_prefixes[key]
+
+
+class Conversation(MutableSequence):
+    """A conversation that behaves like a list of message dicts.
+
+    Indexing and iterating return fresh dicts, so a message changed in place has to
+    be assigned back (``messages[i] = message``) to be kept. The shared prefix can't
+    be changed, only the messages after it.
+
+    Anything else the app needs to resume the conversation, e.g. waffle_bot's order,
+    is kept in `state` (JSON-serialisable values, saved with `set_state`).
+    """
+
+    def __init__(self, shared: tuple[dict, ...] = (), on_change=None):
+        """Initialize the conversation.
+
+        Parameters
+        ----------
+        shared : tuple[dict, ...]
+            Opening messages shared with other sessions, see `share_prefix`.
+        on_change : Callable[[Conversation], None], optional
+            Called after every change, e.g. to persist the conversation.
+        """
+        self.shared = shared
+        self.on_change = on_change
+        self.messages: list[CompactMessage] = []
+        self.state: dict = {}
+        self._nbytes = None
+
+    def _changed(self) -> None:
+        self._nbytes = None
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def _own_index(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not len(self.shared) <= index < len(self):
+            raise IndexError("can only change messages after the shared prefix")
+        return index - len(self.shared)
+
+    def __len__(self) -> int:
+        return len(self.shared) + len(self.messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0:
+            raise IndexError("conversation index out of range")
+        if index < len(self.shared):
+            return dict(self.shared[index])
+        return self.messages[index - len(self.shared)].to_dict()
+
+    def __setitem__(self, index: int, message: dict) -> None:
+        self.messages[self._own_index(index)] = CompactMessage.from_dict(message)
+        self._changed()
+
+    def __delitem__(self, index: int) -> None:
+        del self.messages[self._own_index(index)]
+        self._changed()
+
+    def insert(self, index: int, message: dict) -> None:
+        index = max(index, len(self.shared)) - len(self.shared)
+        self.messages.insert(index, CompactMessage.from_dict(message))
+        self._changed()
+
+    def append(self, message: dict) -> None:
+        self.messages.append(CompactMessage.from_dict(message))
+        self._changed()
+
+    def extend(self, messages) -> None:
+        self.messages += [CompactMessage.from_dict(m) for m in messages]
+        self._changed()
+
+    def set_state(self, key: str, value) -> None:
+        self.state[key] = value
+        self._changed()
+
+    def reset(self) -> None:
+        """Drop everything after the shared prefix, and the state."""
+        self.messages = []
+        self.state = {}
+        self._changed()
+
+    def tokens(self, index: int) -> int:
+        """Token count of a message, cached for the conversation's own messages."""
+        if index < 0:
+            index += len(self)
+        if index < len(self.shared):
+            return count_message_tokens(self.shared[index])
+        return self.messages[index - len(self.shared)].tokens
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the conversation's own messages."""
+        if self._nbytes is None:
+            self._nbytes = sum(message.nbytes for message in self.messages)
+        return self._nbytes
+
+    def dumps(self) -> bytes:
+        """Serialise the own messages and the state; the shared prefix is supplied
+        again on load."""
+        rows = [message.to_row() for message in self.messages]
+        data = {"messages": rows, "state": self.state}
+        return zlib.compress(json.dumps(data).encode())
+
+    @classmethod
+    def loads(cls, data: bytes, shared: tuple[dict, ...] = ()) -> "Conversation":
+        conversation = cls(shared)
+        data = json.loads(zlib.decompress(data))
+        # Conversations saved before the state was added are a list of rows
+        if isinstance(data, list):
+            data = {"messages": data, "state": {}}
+        rows = data["messages"]
+        conversation.state = data["state"]
+        conversation.messages = [CompactMessage.from_row(row) for row in rows]
+        return conversation
+
+
+class MemorySessionBackend:
+    """Keeps evicted conversations as compressed blobs in memory."""
+
+    persistent = False
+
+    def __init__(self):
+        self._data = {}
+
+    def load(self, session_id: str) -> bytes | None:
+        return self._data.get(session_id)
+
+    def save(self, session_id: str, data: bytes) -> None:
+        self._data[session_id] = data
+
+    def delete(self, session_id: str) -> None:
+        self._data.pop(session_id, None)
+
+
+class SQLiteSessionBackend:
+    """Keeps conversations in a local SQLite file, so they survive restarts."""
+
+    persistent = True
+
+    def __init__(self, path: str | Path, ttl: float = SESSION_TTL):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)"
+        )
+        if ttl:
+            self._db.execute(
+                "DELETE FROM sessions WHERE updated_at < ?", (time.time() - ttl,)
+            )
+        self._db.commit()
+
+    def load(self, session_id: str) -> bytes | None:
+        row = self._db.execute(
+            "SELECT data FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, session_id: str, data: bytes) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+            (session_id, data, time.time()),
+        )
+        self._db.commit()
+
+    def delete(self, session_id: str) -> None:
+        self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        self._db.commit()
+
+
+class SessionStore:
+    """Hot conversations in an LRU under a memory cap, the rest in a backend. Safe
+    to share between Streamlit sessions (threads)."""
+
+    def __init__(
+        self,
+        path: str | Path | None = SESSION_STORE_PATH,
+        memory_cap_mb: float = SESSION_MEMORY_CAP_MB,
+    ):
+        """Initialize the store.
+
+        Parameters
+        ----------
+        path : str | Path | None
+            SQLite file to persist conversations to. None or '' keeps them in
+            memory only.
+        memory_cap_mb : float
+            Memory for hot conversations. The least recently used are evicted to the
+            backend when it is exceeded.
+        """
+        self.memory_cap = memory_cap_mb * 1024 * 1024
+        self.backend = SQLiteSessionBackend(path) if path else MemorySessionBackend()
+        self._hot = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, session_id: str, shared: tuple[dict, ...] = ()) -> Conversation:
+        """Return the conversation of session_id, loading or creating it."""
+        with self._lock:
+            conversation = self._hot.get(session_id)
+            if conversation is None:
+                data = self.backend.load(session_id)
+                if data is None:
+                    conversation = Conversation(shared)
+                else:
+                    conversation = Conversation.loads(data, shared)
+                    if not self.backend.persistent:
+                        self.backend.delete(session_id)
+                conversation.on_change = lambda c: self._save(session_id, c)
+                self._hot[session_id] = conversation
+            # The app may have changed its opening messages since the session started
+            conversation.shared = shared
+            self._hot.move_to_end(session_id)
+            self._evict()
+            return conversation
+
+    def _save(self, session_id: str, conversation: Conversation) -> None:
+        with self._lock:
+            if self.backend.persistent:
+                self.backend.save(session_id, conversation.dumps())
+            # A conversation evicted while its session was using it is hot again
+            self._hot[session_id] = conversation
+            self._hot.move_to_end(session_id)
+            self._evict()
+
+    def _evict(self) -> None:
+        used = sum(conversation.nbytes for conversation in self._hot.values())
+        # Always keep the most recently used conversation
+        while used > self.memory_cap and len(self._hot) > 1:
+            session_id, conversation = self._hot.popitem(last=False)
+            # A persistent backend is written through on every change already
+            if not self.backend.persistent:
+                self.backend.save(session_id, conversation.dumps())
+            used -= conversation.nbytes
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._hot.pop(session_id, None)
+            self.backend.delete(session_id)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """Return the process-wide session store, creating it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore()
+        return _store
+
+
+def get_session_id() -> str:
+    """Return the id of the browser session, kept in the page URL across reloads.
+
+    The id is the only thing protecting the conversation, so one that isn't a token
+    of the expected format (e.g. typed in or guessed) starts a new session instead.
+    """
+    import streamlit as st
+
+    session_id = st.query_params.get("session")
+    if not session_id or not SESSION_ID.fullmatch(session_id):
+        session_id = secrets.token_urlsafe(SESSION_ID_BYTES)
+        st.query_params["session"] = session_id
+    return session_id
+
+
+def get_conversation(app: str, shared: list[dict] = ()) -> Conversation:
+    """Return this browser session's conversation with app.
+
+    Parameters
+    ----------
+    app : str
+        Name of the app, so the apps can share one store.
+    shared : list[dict]
+        The app's opening messages, shared between all sessions.
+    """
+    return get_session_store().get(
+        f"{app}:{get_session_id()}", share_prefix(list(shared))
+    )
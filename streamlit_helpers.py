@@ -1,4 +1,15 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import weakref
+
+import aiohttp
 import openai
+import requests
 import streamlit as st
 from htbuilder import (
     HtmlElement,
@@ -17,22 +28,374 @@ from htbuilder import (
 from htbuilder.units import percent, px
 from htbuilder.funcs import rgba, rgb
 
+from chat_history import count_tokens
+from llm_tracing import get_tracer
+from result_cache import get_result_cache, make_key
+
+# Shared OpenAI client settings. Size OPENAI_REQUESTS_PER_MINUTE to the org's rate
+# limit.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 3500))
+OPENAI_REQUEST_TIMEOUT = float(os.getenv("OPENAI_REQUEST_TIMEOUT", 60))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+OPENAI_BACKOFF_BASE = 0.5
+OPENAI_BACKOFF_MAX = 30.0
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+)
+
+
+class TokenBucket:
+    """Thread-safe token bucket, shared by sync and async callers."""
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Take a token if one is available. Return how long to wait otherwise."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        while wait := self._take():
+            time.sleep(wait)
+
+    async def aacquire(self) -> None:
+        while wait := self._take():
+            await asyncio.sleep(wait)
+
+
+# Retries used by the last chat_completion call in this context, for tracing
+OPENAI_RETRIES = contextvars.ContextVar("OPENAI_RETRIES", default=0)
+
+_rate_limiter = TokenBucket(OPENAI_REQUESTS_PER_MINUTE)
+# Blocking calls share one limit, async calls one per event loop
+_concurrency = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+_aconcurrency = weakref.WeakKeyDictionary()
+_aiosessions = weakref.WeakKeyDictionary()
+_session_lock = threading.Lock()
+
+
+def _get_requests_session() -> requests.Session:
+    """Install one keep-alive connection pool for every blocking OpenAI call."""
+    with _session_lock:
+        if not isinstance(openai.requestssession, requests.Session):
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=OPENAI_MAX_CONCURRENCY,
+                pool_maxsize=OPENAI_MAX_CONCURRENCY,
+            )
+            session.mount("https://", adapter)
+            openai.requestssession = session
+        return openai.requestssession
+
+
+def _get_aconcurrency() -> asyncio.BoundedSemaphore:
+    """Return the concurrency limit of the running event loop."""
+    loop = asyncio.get_running_loop()
+    semaphore = _aconcurrency.get(loop)
+    if semaphore is None:
+        semaphore = _aconcurrency[loop] = asyncio.BoundedSemaphore(
+            OPENAI_MAX_CONCURRENCY
+        )
+    return semaphore
+
+
+async def _close_at_shutdown(session: aiohttp.ClientSession):
+    """An async generator that closes session when it is finalised.
+
+    The event loop finalises the async generators still open when it shuts down
+    (`asyncio.run` does this before closing the loop), which is the last chance to
+    close the session on that loop.
+    """
+    try:
+        yield
+    finally:
+        await session.close()
+
+
+async def _get_aiosession() -> aiohttp.ClientSession:
+    """Return a pooled aiohttp session for the running event loop.
+
+    aiohttp sessions are bound to the loop they were created on, and every
+    `asyncio.run` in a Streamlit rerun makes a new loop, so keep one per loop. It is
+    closed when its loop shuts down.
+    """
+    loop = asyncio.get_running_loop()
+    session, closer = _aiosessions.get(loop, (None, None))
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=OPENAI_MAX_CONCURRENCY)
+        )
+        closer = _close_at_shutdown(session)
+        await closer.__anext__()
+        _aiosessions[loop] = session, closer
+    return session
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, openai.error.APIError) and not isinstance(
+        error, (openai.error.ServiceUnavailableError, openai.error.Timeout)
+    ):
+        # Plain APIErrors are only worth retrying when the server fell over
+        return error.http_status is None or error.http_status >= 500
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def _backoff(error: Exception, attempt: int) -> float:
+    """Seconds to wait before the next attempt: Retry-After if the API sent one,
+    otherwise exponential backoff with full jitter."""
+    retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2**attempt))
+
+
+def _with_defaults(kwargs: dict) -> dict:
+    if kwargs.get("request_timeout") is None:
+        kwargs["request_timeout"] = OPENAI_REQUEST_TIMEOUT
+    return kwargs
+
+
+def _release_after(stream, semaphore):
+    """Hold the concurrency slot until a streamed response has been read."""
+    try:
+        yield from stream
+    finally:
+        semaphore.release()
+
+
+async def _arelease_after(stream, semaphore):
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        semaphore.release()
+
 
-def generate_response(prompt, temperature=0):
+def chat_completion(**kwargs):
+    """Call `openai.ChatCompletion.create` through the shared client layer.
+
+    Requests share a keep-alive connection pool, wait for the process-wide rate limit
+    and concurrency limit, time out after OPENAI_REQUEST_TIMEOUT seconds and are
+    retried with jittered exponential backoff on 429s, 5xx errors and timeouts.
+    Accepts the same keyword arguments as `openai.ChatCompletion.create`.
+    """
+    _get_requests_session()
+    kwargs = _with_defaults(kwargs)
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        OPENAI_RETRIES.set(attempt)
+        _rate_limiter.acquire()
+        _concurrency.acquire()
+        try:
+            response = openai.ChatCompletion.create(**kwargs)
+        except Exception as error:
+            _concurrency.release()
+            if attempt == OPENAI_MAX_RETRIES or not _is_retryable(error):
+                raise
+            time.sleep(_backoff(error, attempt))
+            continue
+        if kwargs.get("stream"):
+            return _release_after(response, _concurrency)
+        _concurrency.release()
+        return response
+
+
+async def achat_completion(**kwargs):
+    """Async version of `chat_completion`, wrapping `openai.ChatCompletion.acreate`.
+
+    The concurrency limit applies per event loop; the rate limit is process-wide.
+    """
+    openai.aiosession.set(await _get_aiosession())
+    concurrency = _get_aconcurrency()
+    kwargs = _with_defaults(kwargs)
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        OPENAI_RETRIES.set(attempt)
+        await _rate_limiter.aacquire()
+        await concurrency.acquire()
+        try:
+            response = await openai.ChatCompletion.acreate(**kwargs)
+        except asyncio.CancelledError:
+            concurrency.release()
+            raise
+        except Exception as error:
+            concurrency.release()
+            if attempt == OPENAI_MAX_RETRIES or not _is_retryable(error):
+                raise
+            await asyncio.sleep(_backoff(error, attempt))
+            continue
+        if kwargs.get("stream"):
+            return _arelease_after(response, concurrency)
+        concurrency.release()
+        return response
+
+
+class ChatCompletionClient:
+    """Drop-in for `openai.ChatCompletion` that goes through the shared client layer.
+
+    Example Usage
+    ------------------------
+    >>> llm = ChatOpenAI(temperature=0, max_retries=1)
+    >>> llm.client = ChatCompletionClient
+    """
+
+    create = staticmethod(chat_completion)
+    acreate = staticmethod(achat_completion)
+
+
+def generate_response(
+    prompt, temperature=0, use_cache=True, history=None, stage="chat"
+):
     """Send prompt to OpenAI and return the response. Add the prompt and response to
-    the session state."""
-    st.session_state["messages"].append({"role": "user", "content": prompt})
+    the session state.
 
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=st.session_state["messages"],
-        temperature=temperature,
-    )
-    response = completion.choices[0].message.content
+    Responses are cached by the content of the whole conversation, so sending the same
+    conversation again (e.g. the same text to language_tutor) doesn't call OpenAI.
+
+    Parameters
+    ----------
+    prompt : str
+        The user's message.
+    temperature : float
+        Sampling temperature.
+    use_cache : bool
+        Whether to look up and store the response in the result cache.
+    history : chat_history.RollingHistory, optional
+        Or anything else with a ``build(messages)`` method, like
+        `waffle_orders.OrderSession`. If given, only the messages it returns (within
+        its token budget) are sent instead of the whole conversation.
+    stage : str
+        Name the call is traced under, see `llm_tracing`.
+    """
+    st.session_state["messages"].append({"role": "user", "content": prompt})
+    messages = list(st.session_state["messages"])
+    if history is not None:
+        messages = history.build(messages)
+    response = complete_chat(messages, temperature, use_cache, stage)
     st.session_state["messages"].append({"role": "assistant", "content": response})
     return response
 
 
+def complete_chat(messages, temperature=0, use_cache=True, stage="chat"):
+    """Send messages to OpenAI and return the response, going through the result
+    cache. Unlike `generate_response` this doesn't touch the session state, so it can
+    run outside the Streamlit script thread."""
+    model = "gpt-3.5-turbo"
+    cache = get_result_cache()
+    cache_key = make_key("chat", json.dumps(messages), "", model, temperature)
+    with get_tracer().span(stage, model) as span:
+        response = cache.get(cache_key) if use_cache else None
+        if response is not None:
+            span.cache = "hit"
+        else:
+            span.cache = "miss" if use_cache else None
+            completion = chat_completion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+            )
+            response = completion.choices[0].message.content
+            span.retries = OPENAI_RETRIES.get()
+            span.prompt_tokens = completion.usage.prompt_tokens
+            span.completion_tokens = completion.usage.completion_tokens
+            if use_cache:
+                cache.set(cache_key, response)
+    return response
+
+
+def chat_job(messages, emit, temperature=0, use_cache=True, stage="chat"):
+    """Run `complete_chat` as a `jobs.JobManager` job. The reply is the job's result."""
+    return complete_chat(messages, temperature, use_cache, stage)
+
+
+def stream_function_arguments(
+    messages, function, temperature=0, use_cache=True, stage="function_call"
+):
+    """Call function with OpenAI function calling and yield its JSON arguments as they
+    stream in.
+
+    Parameters
+    ----------
+    messages : list[dict]
+        The messages to send.
+    function : dict
+        The function definition (name, description and JSON schema parameters). The
+        model is forced to call it.
+    temperature : float
+        Sampling temperature.
+    use_cache : bool
+        Whether to look up and store the arguments in the result cache. A hit is
+        yielded in one go.
+    stage : str
+        Name the call is traced under, see `llm_tracing`.
+    """
+    model = "gpt-3.5-turbo"
+    cache = get_result_cache()
+    cache_key = make_key(
+        "function_call", json.dumps(messages), json.dumps(function), model, temperature
+    )
+    with get_tracer().span(stage, model) as span:
+        arguments = cache.get(cache_key) if use_cache else None
+        if arguments is not None:
+            span.cache = "hit"
+            yield arguments
+            return
+        span.cache = "miss" if use_cache else None
+        start = time.perf_counter()
+        chunks = []
+        for chunk in chat_completion(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            functions=[function],
+            function_call={"name": function["name"]},
+            stream=True,
+        ):
+            delta = chunk.choices[0].delta.get("function_call", {}).get("arguments")
+            if not delta:
+                continue
+            if span.ttft is None:
+                span.ttft = time.perf_counter() - start
+            chunks.append(delta)
+            yield delta
+        span.retries = OPENAI_RETRIES.get()
+        arguments = "".join(chunks)
+        span.prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+        span.completion_tokens = count_tokens(arguments)
+        if use_cache:
+            cache.set(cache_key, arguments)
+
+
+def function_arguments_job(messages, function, emit, stage="function_call"):
+    """Run `stream_function_arguments` as a `jobs.JobManager` job. Each chunk of the
+    arguments is emitted as an event and the whole JSON string is the result."""
+    chunks = []
+    for chunk in stream_function_arguments(messages, function, stage=stage):
+        emit(chunk)
+        chunks.append(chunk)
+    return "".join(chunks)
+
+
 def image(src_as_string, **style):
     return img(src=src_as_string, style=styles(**style))
 
@@ -0,0 +1,140 @@
+"""Diff a text against its corrected version, sentence by sentence.
+
+Diffing a whole essay word by word is slow and allocates heavily. `diff_texts` first
+aligns the two texts sentence by sentence, and only diffs the sentences that changed at
+word level. Results are memoised by a hash of both texts, so redrawing a page doesn't
+diff the same texts again.
+
+The markdown uses the same red strike-through / green highlighting as Redlines, and
+`Diff.edits` lists each change so it can be referred to without the HTML.
+"""
+
+import difflib
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+DELETED = (
+    "<span style='color:red;font-weight:700;text-decoration:line-through;'>{}</span>"
+)
+INSERTED = "<span style='color:green;font-weight:700;'>{}</span>"
+
+# A sentence ends at . ! ? (plus closing quotes/brackets) followed by whitespace, or at
+# a line break. The whitespace is kept with the sentence so texts rebuild exactly.
+SENTENCE = re.compile(r".*?(?:[.!?]+[\"'”»)\]]*(?:\s+|$)|\n+|$)", re.S)
+WORD = re.compile(r"\S+\s*|\s+")
+# Whitespace that contains a line break, or leads a run of words
+LINE_BREAK = re.compile(r"(^\s+|\s*\n\s*)")
+
+MEMO_SIZE = 256
+
+
+@dataclass(frozen=True)
+class Edit:
+    """One change between the original and corrected text."""
+
+    original: str
+    corrected: str
+    sentence: int
+
+
+@dataclass(frozen=True)
+class Diff:
+    markdown: str
+    edits: list[Edit] = field(default_factory=list)
+
+
+def split_sentences(text: str) -> list[str]:
+    """Split text into sentences, keeping trailing whitespace with each sentence."""
+    return [s for s in SENTENCE.findall(text) if s]
+
+
+def _highlight(template: str, text: str) -> str:
+    """Wrap text in template, leaving line breaks outside the spans. A span around a
+    blank line would merge the paragraphs on either side of it."""
+    parts = LINE_BREAK.split(text)
+    return "".join(part if part.isspace() else template.format(part) for part in parts)
+
+
+def _diff_words(original: str, corrected: str, sentence: int, markdown, edits):
+    before, after = WORD.findall(original), WORD.findall(corrected)
+    matcher = difflib.SequenceMatcher(
+        None, [w.strip() for w in before], [w.strip() for w in after], autojunk=False
+    )
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        old, new = "".join(before[i1:i2]), "".join(after[j1:j2])
+        if op == "equal":
+            markdown.append(new)
+            continue
+        # The whitespace after the change goes after the spans, taken from the
+        # corrected text if there is one
+        space = new[len(new.rstrip()) :] if new else old[len(old.rstrip()) :]
+        old, new = old.rstrip(), new.rstrip()
+        if old:
+            markdown.append(_highlight(DELETED, old))
+        if old and new:
+            markdown.append(" ")
+        if new:
+            markdown.append(_highlight(INSERTED, new))
+        markdown.append(space)
+        edits.append(Edit(old.strip(), new.strip(), sentence))
+
+
+def _compute_diff(original: str, corrected: str) -> Diff:
+    before, after = split_sentences(original), split_sentences(corrected)
+    # Compare sentences ignoring trailing whitespace, which the model often changes
+    matcher = difflib.SequenceMatcher(
+        None, [s.strip() for s in before], [s.strip() for s in after], autojunk=False
+    )
+    markdown, edits = [], []
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "equal":
+            markdown.extend(after[j1:j2])
+        elif op == "replace" and i2 - i1 == j2 - j1:
+            for offset in range(i2 - i1):
+                _diff_words(
+                    before[i1 + offset],
+                    after[j1 + offset],
+                    i1 + offset,
+                    markdown,
+                    edits,
+                )
+        else:
+            # Sentences were split, merged, added or removed
+            _diff_words(
+                "".join(before[i1:i2]), "".join(after[j1:j2]), i1, markdown, edits
+            )
+    return Diff(markdown="".join(markdown), edits=edits)
+
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def diff_texts(original: str, corrected: str) -> Diff:
+    """Diff original against corrected. Memoised on a hash of both texts.
+
+    Example Usage
+    ------------------------
+    >>> diff_texts("Ich habe 25 Jahre alt. Gut.", "Ich bin 25 Jahre alt. Gut.").edits
+    [Edit(original='habe', corrected='bin', sentence=0)]
+
+    Paragraph breaks next to a change stay outside the highlighting:
+
+    >>> diff = diff_texts("Ich habe Hunger\\n\\nGut.", "Ich habe Hunger.\\n\\nGut.")
+    >>> diff.markdown.endswith("Hunger.</span>\\n\\nGut.")
+    True
+    """
+    key = hashlib.sha256(f"{len(original)}:{original}{corrected}".encode()).digest()
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+    diff = _compute_diff(original, corrected)
+    with _memo_lock:
+        _memo[key] = diff
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return diff
@@ -1,47 +1,28 @@
 """A chatbot that helps the user order food from a restaurant."""
 
+import json
 import os
 
 import openai
 import streamlit as st
 from dotenv import load_dotenv, find_dotenv
 from streamlit_chat import message
-from streamlit_helpers import generate_response, footer
+
+from chat_history import count_tokens
+from history_view import render_history
+from jobs import JobCancelled, JobFailed, get_job_manager
+from llm_tracing import get_tracer, render_trace_panel
+from session_store import get_conversation
+from streamlit_helpers import chat_job, footer
+from waffle_bot_prompts import GREETING, get_system_prompt
+from waffle_orders import OrderSession
+from warmup import warm_up
 
 # Set org ID and API key
 _ = load_dotenv(find_dotenv())
 openai.api_key = os.getenv("OPENAI_API_KEY")
 openai.organization = os.getenv("OPENAI_ORG_ID")
 
-
-def get_system_prompt():
-    """Define system prompt for the chatbot."""
-    system_prompt = """You are the Waffle House order bot. You are a helpful assistant and will help 
-    the customer order their meal. Be friendly and kind at all times. 
-    First greet the customer, then collect the order and then ask if it's pick up or delivery. \
-    You wait to collect the entire order, then summarize it and check for a final time if the \
-    customer wants to add anything else. \
-    Always summarize the entire order before collecting payment. \
-    If it's a delivery, ask them for their address. \
-    If it's pick up, tell them our address: 123 Waffle House Lane, London. \
-    Finally collect the payment. Ask if they want to pay by credit card or cash. \
-    If they say credit card say 'Please click the link below to pay by credit card'. \
-    If they say cash, say they can pay when they pick up the order or pay the delivery driver. \
-    Make sure to clarify all options, extras and sizes to uniquely identify the order. \
-    The menu is: \
-    Waffle type: normal ($10), gluten-free ($10), protein ($1 extra) \
-    Toppings: strawberries, blueberries, chocolate chips, whipped cream, butter, syrup, bacon \
-    Each topping costs $1 \
-    Drinks: coffee, orange juice, milk, water \
-    Each drink costs $2 \
-    Once the order is complete, output the order summary and total cost in JSON format. \
-    Itemize the price for each item. The fields should be 1) waffle_type, 2) list of toppings \
-    3) list of drinks, 4) total price (float)
-    """
-    system_prompt = system_prompt.replace("\n", " ")
-    return system_prompt
-
-
 # Top matter
 st.set_page_config(page_title="Waffle House Order Bot", page_icon=":waffle:")
 st.title("Waffle House Order Bot 🧇")
@@ -51,22 +32,32 @@ intro = """Welcome to the Waffle House, the place where all your waffle filled d
 Start chatting with WaffleBot below to find out what you can order, how much it costs, and how to pay."""
 st.markdown(intro)
 
+# Load the tokenizer while the user reads the intro
+warm_up("tokenizer", count_tokens, "")
+
 # Add footer
 source_link = "https://github.com/codeananda/ChatGPT_Projects/blob/main/waffle_bot.py"
 footer(source_link)
 
 initial_state = [
     {"role": "system", "content": get_system_prompt()},
-    {"role": "assistant", "content": "👋 Welcome to Waffle House! What can I get for you?"},
+    {"role": "assistant", "content": GREETING},
 ]
 
-if "messages" not in st.session_state:
-    st.session_state["messages"] = initial_state
+# The system prompt and greeting are stored once and shared by every session
+messages = get_conversation("waffle_bot", initial_state)
 
 # Let user clear the current conversation
 clear_button = st.sidebar.button("Clear Conversation", key="clear")
 if clear_button:
-    st.session_state["messages"] = initial_state
+    messages.reset()
+    if "job" in st.session_state:
+        get_job_manager().cancel(st.session_state.pop("job"))
+
+# The order is kept with the conversation, so it comes back with it after a restart
+order = OrderSession.from_dict(messages.state.get("order"))
+
+render_trace_panel()
 
 # Chat history container
 response_container = st.container()
@@ -79,12 +70,47 @@ with input_container:
         submit_button = st.form_submit_button(label="Send")
 
     if submit_button and user_input:
-        output = generate_response(user_input)
-
-if st.session_state["messages"]:
+        # Common turns are handled by the order engine, the rest by the LLM
+        output = order.handle(user_input)
+        messages.set_state("order", order.to_dict())
+        messages.append({"role": "user", "content": user_input})
+        if output is None:
+            # The LLM reply is generated in the background and survives reruns
+            to_send = order.build(messages)
+            st.session_state["job"] = get_job_manager().submit(
+                chat_job,
+                to_send,
+                stage="waffle_chat",
+                key="waffle_chat:" + json.dumps(to_send),
+            )
+        else:
+            get_tracer().increment("waffle_local_turns_total", "waffle_chat")
+            messages.append({"role": "assistant", "content": output})
+
+    if "job" in st.session_state:
+        manager = get_job_manager()
+        with st.spinner("WaffleBot is typing..."):
+            for _ in manager.stream(st.session_state["job"]):
+                pass
+        try:
+            output = manager.result(st.session_state.pop("job"))
+        except (JobCancelled, JobFailed):
+            output = "Sorry, something went wrong. Please send that again."
+        messages.append({"role": "assistant", "content": output})
+
+
+def render_message(index, message_):
+    if message_["role"] == "user":
+        message(message_["content"], is_user=True, key=f"message_{index}")
+    else:
+        message(message_["content"], avatar_style="thumbs", key=f"message_{index}")
+
+
+if messages:
     with response_container:
-        for message_ in st.session_state.messages:
-            if message_["role"] == "user":
-                message(message_["content"], is_user=True)
-            elif message_["role"] == "assistant":
-                message(message_["content"], avatar_style="thumbs")
+        render_history(
+            messages,
+            render_message,
+            labels={"user": "You", "assistant": "WaffleBot"},
+            escape=True,
+        )
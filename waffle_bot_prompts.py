@@ -0,0 +1,35 @@
+"""Prompts for the Waffle House order bot (waffle_bot.py).
+
+Kept out of the Streamlit script so they can be imported without running the app.
+"""
+
+from waffle_orders import DRINKS, PICKUP_ADDRESS, TOPPINGS, WAFFLES
+
+GREETING = "👋 Welcome to Waffle House! What can I get for you?"
+
+
+def get_system_prompt():
+    """Define system prompt for the chatbot.
+
+    The order itself is tracked by `waffle_orders.OrderSession`, which prices it and
+    handles the usual ordering steps. The model only sees this prompt when a message
+    needs a free-form reply, along with the order so far.
+    """
+    waffles = ", ".join(
+        f"{name} (${price / 100:.0f})" for name, price in WAFFLES.items()
+    )
+    system_prompt = f"""You are the Waffle House order bot. You are a helpful assistant and will help 
+    the customer order their meal. Be friendly and kind at all times. \
+    The ordering system keeps track of the order and its prices, and tells you the current \
+    order and the next step in a system message. Never compute prices yourself, use the \
+    order it gives you. Answer the customer's questions, then guide them back to the next step. \
+    Our address for pick up is {PICKUP_ADDRESS}. \
+    The menu is: \
+    Waffle type: {waffles} \
+    Toppings: {", ".join(TOPPINGS)} \
+    Each topping costs $1 \
+    Drinks: {", ".join(DRINKS)} \
+    Each drink costs $2 \
+    """
+    system_prompt = system_prompt.replace("\n", " ")
+    return system_prompt
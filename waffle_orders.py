@@ -0,0 +1,523 @@
+"""Keep track of a Waffle House order without asking the LLM.
+
+The menu, the cart and the prices live here, so totals are computed exactly instead of
+by the model. `OrderSession.handle` understands the common turns locally (adding or
+removing waffles, toppings and drinks, pick up or delivery, the address, the payment
+method) and walks the customer through the ordering steps. Anything it can't fully
+understand falls back to the LLM, which gets the current order as one compact system
+message and only the latest messages that fit in ``WAFFLE_HISTORY_TOKEN_BUDGET`` tokens
+(default 1500) instead of the whole conversation.
+"""
+
+import copy
+import json
+import os
+import re
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+
+from chat_history import RollingHistory
+
+# Prices in cents
+WAFFLES = {"normal": 1000, "gluten-free": 1000, "protein": 1100}
+TOPPINGS = {
+    "strawberries": 100,
+    "blueberries": 100,
+    "chocolate chips": 100,
+    "whipped cream": 100,
+    "butter": 100,
+    "syrup": 100,
+    "bacon": 100,
+}
+DRINKS = {"coffee": 200, "orange juice": 200, "milk": 200, "water": 200}
+PICKUP_ADDRESS = "123 Waffle House Lane, London"
+
+# Max prompt tokens when the LLM is asked to reply. The latest messages that fit are
+# sent; older ones are dropped, the cart keeps what they ordered.
+HISTORY_TOKEN_BUDGET = int(os.getenv("WAFFLE_HISTORY_TOKEN_BUDGET", 1500))
+
+# Other ways customers say menu items, fulfilment and payment. Longest phrases first.
+ALIASES = {
+    "gluten free": "gluten-free",
+    "glutenfree": "gluten-free",
+    "regular": "normal",
+    "plain": "normal",
+    "classic": "normal",
+    "strawberry": "strawberries",
+    "blueberry": "blueberries",
+    "choc chips": "chocolate chips",
+    "chocolate chip": "chocolate chips",
+    "maple syrup": "syrup",
+    "coffees": "coffee",
+    "oj": "orange juice",
+    "orange juices": "orange juice",
+    "waters": "water",
+    "waffles": "waffle",
+    "hold on": "wait",
+    "hang on": "wait",
+    "do not": "don't",
+    "dont": "don't",
+    "pick up": "pickup",
+    "pick-up": "pickup",
+    "collect": "pickup",
+    "collection": "pickup",
+    "take away": "pickup",
+    "takeaway": "pickup",
+    "deliver": "delivery",
+    "delivered": "delivery",
+    "credit card": "card",
+    "debit card": "card",
+    "that's everything": "done",
+    "thats everything": "done",
+    "that's all": "done",
+    "thats all": "done",
+    "that's it": "done",
+    "thats it": "done",
+    "nothing else": "done",
+    "no thanks": "no",
+    "no thank you": "no",
+    "nope": "no",
+    "nah": "no",
+}
+NUMBERS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5}
+NEGATIONS = {
+    "no",
+    "not",
+    "don't",
+    "without",
+    "remove",
+    "minus",
+    "hold",
+    "cancel",
+    "drop",
+    "off",
+}
+# Words that end a negation, e.g. "no bacon but add syrup"
+POSITIVES = {"with", "add", "plus", "but", "also"}
+YES = {"yes", "yeah", "yep", "sure"}
+# Words that carry no order information
+FILLER = set(
+    """i i'd id i'll ill i'm im we we'd like want would please can could get have and
+    some it it's its for me to hi hello hey thanks thank you ok okay the of on top
+    extra just too as well be is this that my order will go take make instead drink
+    drinks pay by in great perfect good fine then same again actually wait""".split()
+)
+
+WORD = re.compile(r"[a-z0-9_'-]+")
+
+
+def _format_price(cents: int) -> str:
+    return f"${cents / 100:.2f}"
+
+
+@dataclass
+class Waffle:
+    waffle_type: str | None = None
+    toppings: list[str] = field(default_factory=list)
+
+    @property
+    def price(self) -> int:
+        base = WAFFLES.get(self.waffle_type, WAFFLES["normal"])
+        return base + sum(TOPPINGS[topping] for topping in self.toppings)
+
+    def describe(self) -> str:
+        if self.waffle_type:
+            name = f"{self.waffle_type} waffle"
+        else:
+            name = "waffle (type to be chosen)"
+        if self.toppings:
+            name += " with " + ", ".join(self.toppings)
+        return name
+
+
+@dataclass
+class Cart:
+    waffles: list[Waffle] = field(default_factory=list)
+    drinks: list[str] = field(default_factory=list)
+    fulfilment: str | None = None
+    address: str | None = None
+    payment: str | None = None
+
+    @property
+    def total(self) -> int:
+        return sum(w.price for w in self.waffles) + sum(DRINKS[d] for d in self.drinks)
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.waffles and not self.drinks
+
+    def summary(self) -> str:
+        """The order as a short markdown list with prices."""
+        lines = [f"- {w.describe()}: {_format_price(w.price)}" for w in self.waffles]
+        lines += [f"- {drink}: {_format_price(DRINKS[drink])}" for drink in self.drinks]
+        lines.append(f"- **Total: {_format_price(self.total)}**")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Cart":
+        waffles = [Waffle(**waffle) for waffle in data.get("waffles", [])]
+        return cls(**{**data, "waffles": waffles})
+
+    def compact(self) -> str:
+        """The order in one line, for the LLM's context."""
+        items = [w.describe() for w in self.waffles] + list(self.drinks)
+        parts = ["; ".join(items) or "nothing yet"]
+        parts.append(f"total {_format_price(self.total)}")
+        if self.fulfilment:
+            parts.append(self.fulfilment)
+        if self.address:
+            parts.append(f"address: {self.address}")
+        if self.payment:
+            parts.append(f"paying by {self.payment}")
+        return ", ".join(parts)
+
+    def to_json(self) -> str:
+        """The order in the JSON layout the original prompt asked the model for."""
+        return json.dumps(
+            {
+                "waffles": [
+                    {
+                        "waffle_type": w.waffle_type,
+                        "toppings": w.toppings,
+                        "price": w.price / 100,
+                    }
+                    for w in self.waffles
+                ],
+                "drinks": [
+                    {"drink": drink, "price": DRINKS[drink] / 100}
+                    for drink in self.drinks
+                ],
+                "fulfilment": self.fulfilment,
+                "total_price": self.total / 100,
+            },
+            indent=2,
+        )
+
+
+@dataclass
+class Intent:
+    """What a customer message asks for."""
+
+    added: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    # Items named after a negation, whether or not they were in the order
+    negated: list[str] = field(default_factory=list)
+    fulfilment: str | None = None
+    payment: str | None = None
+    done: bool = False
+    yes: bool = False
+    no: bool = False
+    # Words that weren't understood. If any, the LLM replies.
+    unknown: list[str] = field(default_factory=list)
+
+
+def _quantity(n: int, item: str) -> str:
+    return item if n == 1 else f"{n} x {item}"
+
+
+def _normalise(text: str) -> str:
+    text = text.lower().replace("’", "'")
+    for alias in sorted(ALIASES, key=len, reverse=True):
+        text = re.sub(rf"\b{re.escape(alias)}\b", ALIASES[alias], text)
+    return text
+
+
+def parse_intent(text: str, cart: Cart) -> Intent:
+    """Parse a customer message and apply the items it names to cart.
+
+    Example Usage
+    ------------------------
+    >>> cart = Cart()
+    >>> parse_intent("A normal waffle with syrup and bacon please", cart).unknown
+    []
+    >>> cart.compact()
+    'normal waffle with syrup, bacon, total $12.00'
+
+    Waffles ordered without a type get the type named next:
+
+    >>> cart = Cart()
+    >>> _ = parse_intent("two waffles", cart), parse_intent("protein", cart)
+    >>> cart.compact()
+    'protein waffle; protein waffle, total $22.00'
+    """
+    intent = Intent()
+    text = _normalise(text)
+    # Multi-word menu items become single tokens while scanning
+    phrases = [p for p in (*TOPPINGS, *DRINKS) if " " in p]
+    for phrase in phrases:
+        text = text.replace(phrase, phrase.replace(" ", "_"))
+    negate, quantity, counted, typed_waffle = False, 1, False, False
+    # Toppings go on the waffles named last in the message, or else the last waffle.
+    # Removed toppings come off the waffles named, or else every waffle.
+    current, named = cart.waffles[-1:], False
+    previous = None
+    for word in WORD.findall(text):
+        item = word.replace("_", " ")
+        if word in NUMBERS or word.isdigit():
+            quantity = NUMBERS.get(word) or min(int(word), 10)
+            counted = True
+            continue
+        if item in NEGATIONS:
+            negate = True
+            if item == "no":
+                intent.no = True
+        elif item in POSITIVES:
+            # "don't add syrup" is still a negation, "no bacon but add syrup" isn't
+            negate = negate and previous in NEGATIONS
+        elif item in WAFFLES:
+            # Answer "which waffle?" for the waffles ordered without a type first. A
+            # type without a count, e.g. "normal", is for all of them.
+            untyped = [w for w in cart.waffles if w.waffle_type is None]
+            current = untyped[:quantity] if counted else untyped
+            for waffle in current:
+                waffle.waffle_type = item
+            new = [Waffle(item) for _ in range(quantity - len(current))]
+            cart.waffles.extend(new)
+            current += new
+            named = True
+            intent.added.append(_quantity(len(current), f"{item} waffle"))
+            typed_waffle = True
+        elif item == "waffle":
+            if not typed_waffle:
+                # The type is asked for next
+                current = [Waffle() for _ in range(quantity)]
+                cart.waffles.extend(current)
+                named = True
+                intent.added.append(_quantity(quantity, "waffle"))
+            typed_waffle = False
+        elif item in TOPPINGS:
+            if negate:
+                intent.negated.append(item)
+                for waffle in current if named else cart.waffles:
+                    if item in waffle.toppings:
+                        waffle.toppings.remove(item)
+                        intent.removed.append(item)
+            else:
+                if not current:
+                    current = [Waffle()]
+                    cart.waffles.extend(current)
+                for waffle in current:
+                    if item not in waffle.toppings:
+                        waffle.toppings.append(item)
+                intent.added.append(item)
+        elif item in DRINKS:
+            if negate:
+                intent.negated.append(item)
+                if item in cart.drinks:
+                    cart.drinks.remove(item)
+                    intent.removed.append(item)
+            else:
+                cart.drinks.extend([item] * quantity)
+                intent.added.append(_quantity(quantity, item))
+        elif item in ("pickup", "delivery"):
+            intent.fulfilment = item
+        elif item in ("cash", "card") and not negate:
+            intent.payment = item
+        elif item == "done":
+            intent.done = True
+        elif item in YES:
+            intent.yes = True
+        elif item not in FILLER:
+            intent.unknown.append(word)
+        quantity, counted, previous = 1, False, item
+    return intent
+
+
+class OrderSession:
+    """Walks one customer through ordering: items, pick up or delivery, address,
+    confirmation and payment.
+
+    Also works as the ``history`` of `streamlit_helpers.generate_response`: `build`
+    gives the LLM the system prompt, the order so far and the latest messages.
+
+    Example Usage
+    ------------------------
+    >>> order = OrderSession()
+    >>> reply = order.handle(user_input)
+    >>> if reply is None:  # Not understood locally, let the LLM answer
+    ...     reply = generate_response(user_input, history=order)
+    """
+
+    def __init__(self, token_budget: int = HISTORY_TOKEN_BUDGET):
+        # The cart replaces the running summary, so older turns are just dropped
+        self.history = RollingHistory(token_budget=token_budget, summarise=None)
+        self.reset()
+
+    def reset(self) -> None:
+        self.cart = Cart()
+        self.finished_ordering = False
+        self.confirmed = False
+
+    @property
+    def state(self) -> str:
+        cart = self.cart
+        if (
+            cart.is_empty
+            or any(w.waffle_type is None for w in cart.waffles)
+            or not self.finished_ordering
+        ):
+            return "ordering"
+        if cart.fulfilment is None:
+            return "fulfilment"
+        if cart.fulfilment == "delivery" and not cart.address:
+            return "address"
+        if not self.confirmed:
+            return "confirm"
+        if cart.payment is None:
+            return "payment"
+        return "complete"
+
+    def handle(self, text: str) -> str | None:
+        """Update the order from a customer message and reply to it.
+
+        Returns
+        -------
+        str | None
+            The reply, or None if the message wasn't fully understood and the LLM
+            should reply instead. The order is only changed if it was understood.
+        """
+        state = self.state
+        if state == "complete":
+            return None
+        if state == "address":
+            intent = parse_intent(text, copy.deepcopy(self.cart))
+            changes = (
+                intent.added
+                or intent.negated
+                or intent.fulfilment
+                or intent.payment
+                or intent.done
+            )
+            if not changes:
+                self.cart.address = text.strip()
+                return self._next_step()
+            if intent.unknown:
+                # E.g. "5 Water Lane", or "no, send it to my office"
+                return None
+
+        # Parse into a copy: a message with words we don't know might mean something
+        # else entirely ("I'd rather not have bacon after all"), so the LLM answers it
+        cart = copy.deepcopy(self.cart)
+        intent = parse_intent(text, cart)
+        if intent.unknown:
+            return None
+        self.cart = cart
+        if intent.fulfilment:
+            self.cart.fulfilment = intent.fulfilment
+        if intent.payment:
+            self.cart.payment = intent.payment
+        if intent.added or intent.removed:
+            self.confirmed = False
+        if intent.done:
+            self.finished_ordering = True
+        elif state == "confirm" and (intent.no or intent.payment):
+            if not intent.negated:
+                self.confirmed = True
+        elif state == "confirm" and intent.yes and not intent.added:
+            self.finished_ordering = False
+        elif state == "ordering" and intent.no and not intent.negated:
+            # "No" to "anything else?"
+            self.finished_ordering = True
+        if not (
+            intent.added
+            or intent.negated
+            or intent.fulfilment
+            or intent.payment
+            or intent.done
+            or intent.yes
+            or intent.no
+        ):
+            return None
+
+        reply = []
+        if intent.added:
+            reply.append(f"Added {', '.join(intent.added)}.")
+        if intent.removed:
+            removed = [
+                f"{item} from {n} waffles" if item in TOPPINGS and n > 1 else item
+                for item, n in Counter(intent.removed).items()
+            ]
+            reply.append(f"Removed {', '.join(removed)}.")
+        missing = [item for item in intent.negated if item not in intent.removed]
+        if missing:
+            reply.append(f"There's no {', '.join(missing)} in your order.")
+        if intent.fulfilment == "pickup":
+            reply.append(f"Pick up it is, from {PICKUP_ADDRESS}.")
+        elif intent.fulfilment == "delivery":
+            reply.append("Delivery it is.")
+        if intent.payment:
+            reply.append(f"Paying by {intent.payment}, noted.")
+        reply.append(self._next_step())
+        return " ".join(reply)
+
+    def _next_step(self) -> str:
+        """Ask for whatever the order needs next."""
+        cart, state = self.cart, self.state
+        if state == "ordering":
+            if cart.is_empty:
+                return (
+                    "What can I get for you? We have normal, gluten-free and protein "
+                    "waffles, toppings and drinks."
+                )
+            if any(w.waffle_type is None for w in cart.waffles):
+                return (
+                    "Which waffle would you like: normal ($10), gluten-free ($10) or "
+                    "protein ($11)?"
+                )
+            return (
+                "Would you like anything else, like more toppings or a drink? Let me "
+                "know when that's everything."
+            )
+        if state == "fulfilment":
+            return "Is this for pick up or delivery?"
+        if state == "address":
+            return "What address should we deliver to?"
+        if state == "confirm":
+            return (
+                f"Here's your order:\n\n{cart.summary()}\n\n"
+                "Would you like to add anything else?"
+            )
+        if state == "payment":
+            return "Would you like to pay by credit card or cash?"
+        if cart.payment == "card":
+            payment = "Please click the link below to pay by credit card."
+        elif cart.fulfilment == "pickup":
+            payment = "You can pay when you pick up your order."
+        else:
+            payment = "You can pay the delivery driver."
+        return (
+            f"Thank you! {payment}\n\n{cart.summary()}\n\n"
+            f"```json\n{cart.to_json()}\n```"
+        )
+
+    def to_dict(self) -> dict:
+        """The order, to be kept with the conversation, see `from_dict`."""
+        return {
+            "cart": self.cart.to_dict(),
+            "finished_ordering": self.finished_ordering,
+            "confirmed": self.confirmed,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict | None) -> "OrderSession":
+        order = cls()
+        if data:
+            order.cart = Cart.from_dict(data["cart"])
+            order.finished_ordering = data["finished_ordering"]
+            order.confirmed = data["confirmed"]
+        return order
+
+    def build(self, messages: list[dict]) -> list[dict]:
+        """Return the messages to send to the LLM: the system prompt, the order so
+        far and the latest messages that fit in the token budget."""
+        order = {
+            "role": "system",
+            "content": (
+                f"Current order, kept up to date by the ordering system: "
+                f"{self.cart.compact()}. Next step: {self._next_step()}"
+            ),
+        }
+        return self.history.build(messages, pinned=[order])
@@ -0,0 +1,50 @@
+"""Load slow modules and build clients in the background when an app starts.
+
+Streamlit only shows a page once the script reaches it, so anything imported or built
+before the intro delays the first paint, and the first request pays for whatever is
+still cold. The apps import heavy modules (LangChain, pydantic, tiktoken) where they
+are used instead of at the top, and start loading them with `warm_up` right after the
+intro is on screen. By the time the user has typed something they are ready; if not,
+the first use simply waits for the import already in progress.
+
+Example Usage
+------------------------
+>>> warm_up("tokenizer", count_tokens, "")
+>>> wait("tokenizer", timeout=5)
+True
+"""
+
+import threading
+from typing import Any, Callable
+
+_threads = {}
+_lock = threading.Lock()
+
+
+def warm_up(name: str, fn: Callable[..., Any], *args) -> None:
+    """Run fn(*args) in a background thread, once per process for each name.
+
+    Errors are ignored: whatever failed fails again, visibly, when the app uses it.
+    """
+    with _lock:
+        if name in _threads:
+            return
+
+        def run():
+            try:
+                fn(*args)
+            except Exception:
+                pass
+
+        thread = threading.Thread(target=run, name=f"warm-up-{name}", daemon=True)
+        _threads[name] = thread
+        thread.start()
+
+
+def wait(name: str, timeout: float | None = None) -> bool:
+    """Wait for the warm-up called name. Returns False if it is still running."""
+    thread = _threads.get(name)
+    if thread is not None:
+        thread.join(timeout)
+        return not thread.is_alive()
+    return True